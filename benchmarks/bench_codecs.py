@@ -0,0 +1,37 @@
+import os
+import sys
+import time
+import timeit
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.variables import *
+from common.codec import CODECS
+from common.utils import encode_frame, route_header
+
+# Набор типичных сообщений протокола JIM
+MESSAGES = {
+    'presence': {ACTION: PRESENCE, TIME: time.time(), USER: {ACCOUNT_NAME: 'user_12345'},
+                 FRAMING: FRAMING_LENGTH_PREFIX, CODEC: CODEC_BINARY},
+    'response': {RESPONSE: 200},
+    'short message': {ACTION: MESSAGE, SENDER: 'user_12345', DESTINATION: 'user_54321', TIME: time.time(),
+                      MESSAGE_TEXT: 'Привет! Как дела?'},
+    'long message': {ACTION: MESSAGE, SENDER: 'user_12345', DESTINATION: 'user_54321', TIME: time.time(),
+                     MESSAGE_TEXT: 'Lorem ipsum dolor sit amet. ' * 150},
+    'exit': {ACTION: EXIT, TIME: time.time(), ACCOUNT_NAME: 'user_12345'},
+}
+
+
+# Сравнение кодеков: размер сообщения на проводе (с заголовком кадра) и время кодирования/декодирования.
+def main(number=20000):
+    print(f'{"сообщение":<15}{"кодек":<8}{"байт":>8}{"encode, мкс":>14}{"decode, мкс":>14}')
+    for title, message in MESSAGES.items():
+        for codec in CODECS.values():
+            encoded = codec.encode(message)
+            assert codec.decode(encoded) == message
+            encode_time = timeit.timeit(lambda: codec.encode(message), number=number) / number * 1e6
+            decode_time = timeit.timeit(lambda: codec.decode(encoded), number=number) / number * 1e6
+            wire_size = len(encode_frame(encoded, route_header(message)))
+            print(f'{title:<15}{codec.name:<8}{wire_size:>8}{encode_time:>14.2f}{decode_time:>14.2f}')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,74 @@
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.variables import *
+from server_archive import MessageArchive
+from server_search import SearchIndex
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+# Замер индекса поиска: скорость построения (запись в архив, затем дочитывание архива индексом с записью сегментов
+# на диск и фоновым объединением) и время поисковых запросов из 1-3 слов. Слова сообщений выбираются из словаря
+# по закону Ципфа, поэтому в запросах встречаются и частые, и редкие слова.
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--messages', default=200000, type=int)
+    parser.add_argument('-u', '--users', default=100, type=int)
+    parser.add_argument('-q', '--queries', default=1000, type=int)
+    parser.add_argument('--words', default=20000, type=int)
+    args = parser.parse_args()
+
+    random_generator = random.Random(1)
+    vocabulary = [f'слово{index}' for index in range(args.words)]
+    weights = [1 / (rank + 1) for rank in range(args.words)]
+    users = [f'user{index}' for index in range(args.users)]
+    messages = []
+    for _ in range(args.messages):
+        sender, destination = random_generator.sample(users, 2)
+        text = ' '.join(random_generator.choices(vocabulary, weights, k=random_generator.randint(3, 15)))
+        messages.append({ACTION: MESSAGE, SENDER: sender, DESTINATION: destination, TIME: time.time(),
+                         MESSAGE_TEXT: text})
+
+    directory = tempfile.mkdtemp()
+    try:
+        archive = MessageArchive(directory)
+        index = SearchIndex(archive)
+        started = time.perf_counter()
+        for message in messages:
+            archive.append(message)
+        routed = time.perf_counter() - started
+        index.update()
+        index.flush(wait=True)
+        built = time.perf_counter() - started
+        print(f'Сообщений: {args.messages}, в секунду при маршрутизации (запись в архив): {args.messages / routed:.0f}, '
+              f'с индексированием, записью и объединением сегментов: {args.messages / built:.0f}, '
+              f'сегментов: {len(index.segments)}')
+
+        for terms in (1, 2, 3):
+            latencies = []
+            found = 0
+            for _ in range(args.queries):
+                query = ' '.join(random_generator.choices(vocabulary, weights, k=terms))
+                user = random_generator.choice(users)
+                started = time.perf_counter()
+                found += len(index.search(user, query, SEARCH_MAX_RESULTS))
+                latencies.append(time.perf_counter() - started)
+            print(f'Запросы из {terms} слов: p50 {percentile(latencies, 0.5) * 1000:.2f} мс, '
+                  f'p99 {percentile(latencies, 0.99) * 1000:.2f} мс, найдено в среднем {found / args.queries:.1f}')
+        index.close()
+        archive.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
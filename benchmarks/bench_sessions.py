@@ -0,0 +1,111 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import resource
+import tempfile
+import multiprocessing
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.variables import *
+from common.utils import encode_message
+from load_test import run_server, wait_for_server, current_commit
+
+# Замер памяти сервера на одно простаивающее подключение. Сервер запускается в отдельном процессе, к нему
+# открывается N подключений (по умолчанию с приветствием в режиме с кадрированием), после чего сравнивается
+# резидентная память процесса сервера до и после.
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description='Память сервера на одно простаивающее подключение.')
+    parser.add_argument('-c', '--connections', default=100000, type=int, help='количество подключений')
+    parser.add_argument('-e', '--engine', default='asyncio', choices=('select', 'asyncio'))
+    parser.add_argument('-p', '--port', default=17778, type=int)
+    parser.add_argument('--anonymous', action='store_true', help='только подключение, без приветствия')
+    parser.add_argument('--log-level', default='WARNING', help='уровень логирования сервера во время теста')
+    return parser.parse_args(sys.argv[1:])
+
+
+# Резидентная память процесса в байтах (Linux)
+def process_rss(pid):
+    with open(f'/proc/{pid}/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return None
+
+
+# Количество подключений, которое позволяет лимит открытых файлов. Лимит поднимается до максимального,
+# процесс сервера наследует его.
+def connection_limit(wanted):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        return min(wanted, hard - 100)
+    return wanted
+
+
+# Открытие подключений. Адрес источника чередуется по 127.0.0.0/8, чтобы не исчерпать локальные порты.
+def open_connections(args, count):
+    connections = []
+    for index in range(count):
+        connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        connection.bind((f'127.0.{index // 250 % 250}.{index % 250 + 1}', 0))
+        connection.connect(('127.0.0.1', args.port))
+        if not args.anonymous:
+            connection.sendall(encode_message({
+                ACTION: PRESENCE, TIME: time.time(), USER: {ACCOUNT_NAME: f'idle_{index}'},
+                FRAMING: FRAMING_LENGTH_PREFIX, CODEC: CODEC_BINARY}))
+        connections.append(connection)
+    # Дожидаемся ответов на приветствие, чтобы сервер точно обработал все подключения.
+    if not args.anonymous:
+        for connection in connections:
+            connection.settimeout(30)
+            if not connection.recv(READ_BUFFER_SIZE):
+                raise ConnectionError
+    return connections
+
+
+def main():
+    args = arg_parser()
+    count = connection_limit(args.connections)
+    if count < args.connections:
+        print(f'Лимит открытых файлов позволяет только {count} подключений.')
+
+    db_dir = tempfile.mkdtemp()
+    server_process = multiprocessing.Process(
+        target=run_server, args=(args.engine, args.port, f'sqlite:///{db_dir}/bench.db3', args.log_level),
+        daemon=True)
+    server_process.start()
+    try:
+        wait_for_server(args.port)
+        time.sleep(1)
+        rss_before = process_rss(server_process.pid)
+        started = time.monotonic()
+        connections = open_connections(args, count)
+        connect_time = time.monotonic() - started
+        # Даём потоку записи в БД обработать входы пользователей.
+        time.sleep(2)
+        rss_after = process_rss(server_process.pid)
+    finally:
+        server_process.terminate()
+
+    result = {
+        'commit': current_commit(),
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'engine': args.engine,
+        'connections': len(connections),
+        'anonymous': args.anonymous,
+        'connections_per_sec': round(len(connections) / connect_time, 1),
+        'rss_before_mb': round(rss_before / 2 ** 20, 1),
+        'rss_after_mb': round(rss_after / 2 ** 20, 1),
+        'bytes_per_connection': round((rss_after - rss_before) / len(connections)),
+    }
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    for connection in connections:
+        connection.close()
+
+
+if __name__ == '__main__':
+    main()
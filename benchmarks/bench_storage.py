@@ -0,0 +1,69 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.variables import *
+from server_database import STORAGES, create_storage
+
+
+# Время одной операции в микросекундах: количество операций за вызов function делится на общее время.
+def measure(function, count):
+    started = time.perf_counter()
+    function()
+    return (time.perf_counter() - started) / count * 1e6
+
+
+# Замер стоимости операций хранилищ данных сервера на временной БД: вход и выход пользователей (время постановки
+# в очередь вместе с записью потоком записи до flush), списки пользователей и пользователей онлайн, история
+# входов одного пользователя и страница общей истории. Хранилище открывается как общее для нескольких процессов,
+# поэтому список пользователей читается из БД, а не из кэша.
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-u', '--users', default=1000, type=int)
+    parser.add_argument('-r', '--rounds', default=5, type=int, help='входов каждого пользователя')
+    parser.add_argument('-q', '--queries', default=200, type=int, help='повторов каждого запроса')
+    parser.add_argument('-b', '--backend', action='append', choices=tuple(STORAGES), help='по умолчанию - все')
+    args = parser.parse_args()
+
+    users = [f'user{index}' for index in range(args.users)]
+    for backend in args.backend or STORAGES:
+        directory = tempfile.mkdtemp()
+        try:
+            storage = create_storage('sqlite:///' + os.path.join(directory, 'server.db3'), True, backend)
+            results = dict()
+
+            def login():
+                for _ in range(args.rounds):
+                    for index, user in enumerate(users):
+                        storage.user_login(user, '127.0.0.1', index)
+                storage.flush()
+
+            def logout():
+                for user in users:
+                    storage.user_logout(user)
+                storage.flush()
+
+            def query(function, *function_args):
+                return lambda: [function(*function_args) for _ in range(args.queries)]
+
+            results['user_login'] = measure(login, args.rounds * args.users)
+            results['active_users_list'] = measure(query(storage.active_users_list), args.queries)
+            results['users_list'] = measure(query(storage.users_list), args.queries)
+            results['login_history(user)'] = measure(query(storage.login_history, users[-1]), args.queries)
+            results['login_history(page)'] = measure(
+                query(storage.login_history, None, None, None, HISTORY_PAGE_SIZE), args.queries)
+            results['user_logout'] = measure(logout, args.users)
+            storage.close()
+        finally:
+            shutil.rmtree(directory)
+
+        print(f'Хранилище {backend}, пользователей: {args.users}, записей истории: {args.rounds * args.users}')
+        for operation, microseconds in results.items():
+            print(f'  {operation}: {microseconds:.1f} мкс')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import logging
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.variables import *
+from common.utils import FrameDecoder, encode_message, frame_body
+from common.codec import CODECS
+
+# Нагрузочный тест сервера. Запускает сервер на loopback в отдельном процессе, имитирует N клиентов с настоящим
+# приветствием и сообщениями JIM, измеряет пропускную способность и задержку доставки. Результаты дописываются
+# строкой JSON в файл, чтобы их можно было сравнивать между коммитами.
+
+# Шаблоны нагрузки:
+# pairs - каждый клиент пишет следующему по кругу
+# hot - все клиенты пишут одному получателю
+# churn - половина клиентов постоянно входит, отправляет сообщение и выходит, остальные только принимают
+PATTERNS = ('pairs', 'hot', 'churn')
+
+# Файл результатов по умолчанию - в каталоге тестов, независимо от текущего каталога.
+RESULTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_results.jsonl')
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест сервера.')
+    parser.add_argument('-c', '--clients', default=50, type=int, help='количество клиентов')
+    parser.add_argument('-d', '--duration', default=10.0, type=float, help='длительность отправки, секунд')
+    parser.add_argument('-r', '--rate', default=0, type=float,
+                        help='сообщений в секунду от одного клиента, 0 - без ограничения')
+    parser.add_argument('-s', '--size', default=100, type=int, help='длинна текста сообщения')
+    parser.add_argument('-P', '--pattern', default='pairs', choices=PATTERNS)
+    parser.add_argument('-e', '--engine', default='select', choices=('select', 'asyncio'))
+    parser.add_argument('--codec', default=CODEC_JSON, choices=tuple(CODECS))
+    parser.add_argument('-p', '--port', default=17777, type=int)
+    parser.add_argument('--log-level', default='WARNING', help='уровень логирования сервера во время теста')
+    parser.add_argument('-o', '--output', default=RESULTS_FILE, help='файл для результатов')
+    return parser.parse_args(sys.argv[1:])
+
+
+# Процесс сервера: временная БД, выбранный движок, уровень логирования.
+def run_server(engine, port, db_url, log_level):
+    import server
+    from server_database import create_storage
+    logging.getLogger('server').setLevel(log_level)
+    server_class = server.AsyncServer if engine == 'asyncio' else server.Server
+    server_class('127.0.0.1', port, create_storage(db_url)).run()
+
+
+# Статистика теста, общая для всех клиентов.
+class Stats:
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self.logins = 0
+        self.latencies = []
+
+    # Перцентиль задержки в миллисекундах
+    def percentile(self, fraction):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] * 1000, 3)
+
+
+# Имитация одного клиента.
+class LoadClient:
+    def __init__(self, name, args, stats):
+        self.name = name
+        self.args = args
+        self.stats = stats
+        self.decoder = FrameDecoder()
+        self.codec = None
+
+    # Подключение и приветствие, клиент всегда предлагает кадрирование и выбранный кодек.
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection('127.0.0.1', self.args.port)
+        self.writer.write(encode_message({
+            ACTION: PRESENCE, TIME: time.time(), USER: {ACCOUNT_NAME: self.name},
+            FRAMING: FRAMING_LENGTH_PREFIX, CODEC: self.args.codec}))
+        while not self.decoder.frames:
+            data = await self.reader.read(READ_BUFFER_SIZE)
+            if not data:
+                raise ConnectionError
+            self.decoder.feed(data)
+        response = self.decoder.codec.decode(frame_body(self.decoder.frames.popleft()))
+        if response.get(RESPONSE) != 200:
+            raise ConnectionError(response)
+        self.codec = self.decoder.codec = CODECS[response.get(CODEC, CODEC_JSON)]
+        self.stats.logins += 1
+
+    async def close(self):
+        self.writer.write(encode_message({ACTION: EXIT, TIME: time.time(), ACCOUNT_NAME: self.name}, self.codec))
+        await self.writer.drain()
+        self.writer.close()
+
+    # Приём сообщений до закрытия соединения, задержка считается по времени отправки в сообщении.
+    async def receive(self):
+        while True:
+            data = await self.reader.read(READ_BUFFER_SIZE)
+            if not data:
+                return
+            self.decoder.feed(data)
+            now = time.time()
+            while self.decoder.frames:
+                message = self.codec.decode(frame_body(self.decoder.frames.popleft()))
+                if message.get(ACTION) == MESSAGE:
+                    self.stats.received += 1
+                    self.stats.latencies.append(now - message[TIME])
+
+    def message(self, destination):
+        return encode_message({
+            ACTION: MESSAGE, SENDER: self.name, DESTINATION: destination, TIME: time.time(),
+            MESSAGE_TEXT: 'x' * self.args.size}, self.codec)
+
+    # Отправка сообщений выбранным получателям до окончания теста.
+    async def send(self, destinations, deadline):
+        interval = 1 / self.args.rate if self.args.rate else 0
+        while time.monotonic() < deadline:
+            self.writer.write(self.message(random.choice(destinations)))
+            self.stats.sent += 1
+            await self.writer.drain()
+            await asyncio.sleep(interval)
+
+
+# Клиент шаблона churn: вход, одно сообщение, выход - до окончания теста.
+async def churn(name, args, stats, destinations, deadline):
+    while time.monotonic() < deadline:
+        client = LoadClient(name, args, stats)
+        await client.connect()
+        client.writer.write(client.message(random.choice(destinations)))
+        stats.sent += 1
+        await client.close()
+        await asyncio.sleep(1 / args.rate if args.rate else 0)
+
+
+async def run_load(args, stats):
+    names = [f'load_{index}' for index in range(args.clients)]
+    if args.pattern == 'churn':
+        receivers = names[:max(1, args.clients // 2)]
+        senders = names[len(receivers):]
+    else:
+        receivers = senders = names
+
+    clients = {name: LoadClient(name, args, stats) for name in receivers}
+    for client in clients.values():
+        await client.connect()
+    receive_tasks = [asyncio.create_task(client.receive()) for client in clients.values()]
+
+    deadline = time.monotonic() + args.duration
+    if args.pattern == 'churn':
+        tasks = [churn(name, args, stats, receivers, deadline) for name in senders]
+    elif args.pattern == 'hot':
+        tasks = [client.send(names[:1], deadline) for client in clients.values()]
+    else:
+        tasks = [client.send([names[(index + 1) % len(names)]], deadline) for index, client in
+                 enumerate(clients.values())]
+    started = time.monotonic()
+    await asyncio.gather(*tasks)
+    send_time = time.monotonic() - started
+
+    # Ждём доставки отправленного, но не дольше секунды после последнего принятого сообщения.
+    last = -1
+    while stats.received != last:
+        last = stats.received
+        await asyncio.sleep(1)
+    for client in clients.values():
+        await client.close()
+    for task in receive_tasks:
+        task.cancel()
+    return send_time
+
+
+# Ожидание, пока сервер начнёт принимать подключения.
+def wait_for_server(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+# Хэш текущего коммита, чтобы результаты можно было сопоставлять между коммитами.
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    args = arg_parser()
+    db_dir = tempfile.mkdtemp()
+    server_process = multiprocessing.Process(
+        target=run_server, args=(args.engine, args.port, f'sqlite:///{db_dir}/bench.db3', args.log_level),
+        daemon=True)
+    server_process.start()
+    wait_for_server(args.port)
+
+    stats = Stats()
+    try:
+        send_time = asyncio.run(run_load(args, stats))
+    finally:
+        server_process.terminate()
+
+    result = {
+        'commit': current_commit(),
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'params': {key: value for key, value in vars(args).items() if key not in ('port', 'output')},
+        'sent': stats.sent,
+        'received': stats.received,
+        'logins': stats.logins,
+        'messages_per_sec': round(stats.received / send_time, 1),
+        'logins_per_sec': round(stats.logins / send_time, 1),
+        'latency_ms': {'p50': stats.percentile(0.5), 'p99': stats.percentile(0.99),
+                       'p999': stats.percentile(0.999)},
+    }
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+    # Сравнение с последним результатом с теми же параметрами.
+    if os.path.exists(args.output):
+        with open(args.output, encoding=ENCODING) as results:
+            previous = [json.loads(line) for line in results if line.strip()]
+        previous = [item for item in previous if item['params'] == result['params']]
+        if previous:
+            print(f'Предыдущий результат ({previous[-1]["commit"]}): {previous[-1]["messages_per_sec"]} сообщ./с, '
+                  f'p99 {previous[-1]["latency_ms"]["p99"]} мс')
+    with open(args.output, 'a', encoding=ENCODING) as results:
+        results.write(json.dumps(result, ensure_ascii=False) + '\n')
+
+
+if __name__ == '__main__':
+    main()
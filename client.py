@@ -3,12 +3,14 @@ import json
 import socket
 import time
 import dis
+import select
 import argparse
 import logging
 import threading
 import logs.config_client_log
 from common.variables import *
 from common.utils import *
+from common.codec import CODECS
 from errors import IncorrectDataRecivedError, ReqFieldMissingError, ServerError
 from decos import log
 from metaclasses import ClientMaker
@@ -19,11 +21,20 @@ logger = logging.getLogger('client')
 
 # Класс формировки и отправки сообщений на сервер и взаимодействия с пользователем.
 class ClientSender(threading.Thread, metaclass=ClientMaker):
-    def __init__(self, account_name, sock):
+    def __init__(self, account_name, sock, codec=None, lock=None):
         self.account_name = account_name
         self.sock = sock
+        # Кодек, согласованный с сервером для режима с префиксом длинны, или None
+        self.codec = codec
+        # Блокировка записи в сокет, общая с приёмником, который тоже отправляет ping и ответы на него
+        self.lock = lock or threading.Lock()
         super().__init__()
 
+    # Функция отправки сообщения на сервер в согласованном режиме
+    def send(self, message):
+        with self.lock:
+            send_message(self.sock, message, self.codec)
+
     # Функция создаёт словарь с сообщением о выходе.
     def create_exit_message(self):
         return {
@@ -45,12 +56,133 @@ class ClientSender(threading.Thread, metaclass=ClientMaker):
         }
         logger.debug(f'Сформирован словарь сообщения: {message_dict}')
         try:
-            send_message(self.sock, message_dict)
+            self.send(message_dict)
             logger.info(f'Отправлено сообщение для пользователя {to}')
         except:
             logger.critical('Потеряно соединение с сервером.')
             exit(1)
 
+    # Функция запрашивает имя группы и сообщение и отправляет его всем участникам группы.
+    def create_group_message(self):
+        group = input('Введите имя группы: ')
+        message = input('Введите сообщение для отправки: ')
+        message_dict = {
+            ACTION: GROUP_MESSAGE,
+            SENDER: self.account_name,
+            GROUP: group,
+            TIME: time.time(),
+            MESSAGE_TEXT: message
+        }
+        logger.debug(f'Сформирован словарь сообщения группе: {message_dict}')
+        try:
+            self.send(message_dict)
+            logger.info(f'Отправлено сообщение группе {group}')
+        except:
+            logger.critical('Потеряно соединение с сервером.')
+            exit(1)
+
+    # Функция запрашивает имя группы и отправляет запрос на создание группы, вступление в неё или выход.
+    def change_group(self, action):
+        group = input('Введите имя группы: ')
+        try:
+            self.send({
+                ACTION: action,
+                TIME: time.time(),
+                ACCOUNT_NAME: self.account_name,
+                GROUP: group
+            })
+            logger.info(f'Отправлен запрос {action} для группы {group}')
+        except:
+            logger.critical('Потеряно соединение с сервером.')
+            exit(1)
+
+    # Функция запрашивает имя собеседника и количество сообщений и запрашивает у сервера историю переписки с ним.
+    def request_history(self):
+        user = input('Введите имя собеседника: ')
+        try:
+            count = int(input('Сколько последних сообщений показать: '))
+        except ValueError:
+            print('Количество должно быть числом.')
+            return
+        try:
+            self.send({
+                ACTION: HISTORY,
+                TIME: time.time(),
+                ACCOUNT_NAME: self.account_name,
+                USER: user,
+                COUNT: count
+            })
+            logger.info(f'Запрошена история переписки с пользователем {user}')
+        except:
+            logger.critical('Потеряно соединение с сервером.')
+            exit(1)
+
+    # Функция запроса списка контактов с их состоянием (в сети или нет).
+    def request_contacts(self):
+        try:
+            self.send({
+                ACTION: GET_CONTACTS,
+                TIME: time.time(),
+                ACCOUNT_NAME: self.account_name
+            })
+            logger.info('Запрошен список контактов')
+        except:
+            logger.critical('Потеряно соединение с сервером.')
+            exit(1)
+
+    # Функция запрашивает имя пользователя и добавляет его в контакты или удаляет из них.
+    def change_contact(self, action):
+        user = input('Введите имя пользователя: ')
+        try:
+            self.send({
+                ACTION: action,
+                TIME: time.time(),
+                ACCOUNT_NAME: self.account_name,
+                USER: user
+            })
+            logger.info(f'Отправлен запрос {action} для контакта {user}')
+        except:
+            logger.critical('Потеряно соединение с сервером.')
+            exit(1)
+
+    # Функция запрашивает слова для поиска и ищет на сервере сообщения переписки пользователя, содержащие их все.
+    def request_search(self):
+        query = input('Введите слова для поиска: ')
+        try:
+            self.send({
+                ACTION: SEARCH,
+                TIME: time.time(),
+                ACCOUNT_NAME: self.account_name,
+                QUERY: query,
+                LIMIT: SEARCH_MAX_RESULTS
+            })
+            logger.info(f'Отправлен поисковый запрос: {query}')
+        except:
+            logger.critical('Потеряно соединение с сервером.')
+            exit(1)
+
+    # Функция отправки многих сообщений пакетами: принимает список пар (получатель, текст), каждые MAX_BATCH_SIZE
+    # сообщений отправляются на сервер одним запросом.
+    def send_batch(self, messages):
+        for start in range(0, len(messages), MAX_BATCH_SIZE):
+            self.send(create_batch(self.account_name, messages[start:start + MAX_BATCH_SIZE]))
+        logger.info(f'Отправлено пакетом сообщений: {len(messages)}')
+
+    # Функция запрашивает имя файла со строками вида "получатель;текст" и отправляет сообщения из него пакетами.
+    def create_batch_from_file(self):
+        file_name = input('Введите имя файла с сообщениями (строки вида получатель;текст): ')
+        try:
+            with open(file_name, encoding=ENCODING) as file:
+                messages = [line.rstrip('\n').split(';', 1) for line in file if ';' in line]
+        except OSError as error:
+            print(f'Не удалось прочитать файл: {error}')
+            return
+        try:
+            self.send_batch(messages)
+        except:
+            logger.critical('Потеряно соединение с сервером.')
+            exit(1)
+
     # Функция взаимодействия с пользователем, запрашивает команды, отправляет сообщения
     def run(self):
         self.print_help()
@@ -58,11 +190,31 @@ class ClientSender(threading.Thread, metaclass=ClientMaker):
             command = input('Введите команду: ')
             if command == 'message':
                 self.create_message()
+            elif command == 'batch':
+                self.create_batch_from_file()
+            elif command == 'group':
+                self.create_group_message()
+            elif command == 'create':
+                self.change_group(CREATE_GROUP)
+            elif command == 'join':
+                self.change_group(JOIN_GROUP)
+            elif command == 'leave':
+                self.change_group(LEAVE_GROUP)
+            elif command == 'contacts':
+                self.request_contacts()
+            elif command == 'add':
+                self.change_contact(ADD_CONTACT)
+            elif command == 'del':
+                self.change_contact(REMOVE_CONTACT)
+            elif command == 'history':
+                self.request_history()
+            elif command == 'search':
+                self.request_search()
             elif command == 'help':
                 self.print_help()
             elif command == 'exit':
                 try:
-                    send_message(self.sock, self.create_exit_message())
+                    self.send(self.create_exit_message())
                 except:
                     pass
                 print('Завершение соединения.')
@@ -77,38 +229,131 @@ class ClientSender(threading.Thread, metaclass=ClientMaker):
     def print_help(self):
         print('Поддерживаемые команды:')
         print('message - отправить сообщение. Кому и текст будет запрошены отдельно.')
+        print('batch - отправить сообщения из файла пакетами. Имя файла будет запрошено.')
+        print('group - отправить сообщение группе. Группа и текст будут запрошены отдельно.')
+        print('create, join, leave - создать группу, вступить в группу, выйти из группы.')
+        print('contacts - список контактов: кто из них в сети. О входе и выходе контактов сервер сообщает сам.')
+        print('add, del - добавить пользователя в контакты, удалить из контактов.')
+        print('history - история переписки с пользователем. Собеседник и количество сообщений будут запрошены.')
+        print('search - поиск сообщений в своей переписке по словам. Слова будут запрошены.')
         print('help - вывести подсказки по командам')
         print('exit - выход из программы')
 
 
 # Класс-приёмник сообщений с сервера. Принимает сообщения, выводит в консоль.
 class ClientReader(threading.Thread , metaclass=ClientMaker):
-    def __init__(self, account_name, sock):
+    def __init__(self, account_name, sock, decoder=None, resume=None, lock=None):
         self.account_name = account_name
         self.sock = sock
+        # Декодер кадров, если с сервером согласован режим с префиксом длинны
+        self.decoder = decoder
+        # Функция восстановления сессии после обрыва соединения: принимает количество полученных кадров, возвращает
+        # новый сокет, декодер и признак того, что сессия восстановлена, а не начата заново
+        self.resume = resume
+        # Количество кадров, полученных в текущей сессии
+        self.received = 0
+        # Блокировка записи в сокет, общая с отправителем
+        self.lock = lock or threading.Lock()
         super().__init__()
 
-    # Основной цикл приёмника сообщений, принимает сообщения, выводит в консоль. Завершается при потере соединения.
+    # Функция отправки служебного сообщения (ping и ответа на него) на сервер. В них сообщается количество
+    # полученных кадров, чтобы сервер не хранил их для повторной отправки.
+    def send(self, message):
+        with self.lock:
+            send_message(self.sock, message, self.decoder.codec if self.decoder else None)
+
+    # Ожидание данных от сервера в режиме с кадрированием. Если сервер молчит HEARTBEAT_INTERVAL секунд, ему
+    # отправляется ping, если нет ответа и за HEARTBEAT_TIMEOUT - соединение считается оборванным.
+    def wait_for_data(self):
+        if self.decoder.frames or select.select([self.sock], [], [], HEARTBEAT_INTERVAL)[0]:
+            return
+        self.send({ACTION: PING, TIME: time.time(), LAST_SEQ: self.received})
+        if not select.select([self.sock], [], [], HEARTBEAT_TIMEOUT)[0]:
+            raise ConnectionError
+
+    # Восстановление сессии после обрыва соединения. Возвращает False, если восстановить соединение не удалось.
+    def reconnect(self):
+        for attempt in range(RESUME_ATTEMPTS):
+            time.sleep(RESUME_RETRY_DELAY)
+            try:
+                self.sock, self.decoder, resumed = self.resume(self.received)
+            except (OSError, ServerError, ReqFieldMissingError, IncorrectDataRecivedError, json.JSONDecodeError):
+                logger.info(f'Попытка восстановления соединения {attempt + 1} не удалась.')
+                continue
+            if not resumed:
+                self.received = 0
+            logger.info(f'Соединение с сервером восстановлено, сессия {"продолжена" if resumed else "начата заново"}.')
+            return True
+        return False
+
+    # Основной цикл приёмника сообщений, принимает сообщения, выводит в консоль. При потере соединения пытается
+    # восстановить сессию, если это не удалось - завершается.
     def run(self):
         while True:
             try:
-                message = get_message(self.sock)
+                if self.decoder is not None:
+                    self.wait_for_data()
+                message = get_message(self.sock, self.decoder)
+                if self.decoder is not None:
+                    self.received += 1
                 if ACTION in message and message[ACTION] == MESSAGE and SENDER in message and DESTINATION in message \
                         and MESSAGE_TEXT in message and message[DESTINATION] == self.account_name:
                     print(f'\nПолучено сообщение от пользователя {message[SENDER]}:\n{message[MESSAGE_TEXT]}')
                     logger.info(f'Получено сообщение от пользователя {message[SENDER]}:\n{message[MESSAGE_TEXT]}')
+                elif ACTION in message and message[ACTION] == GROUP_MESSAGE and SENDER in message \
+                        and GROUP in message and MESSAGE_TEXT in message:
+                    print(f'\nПолучено сообщение в группе {message[GROUP]} от пользователя {message[SENDER]}:'
+                          f'\n{message[MESSAGE_TEXT]}')
+                    logger.info(f'Получено сообщение в группе {message[GROUP]} от пользователя {message[SENDER]}')
+                elif ACTION in message and message[ACTION] == PRESENCE_UPDATE and CONTACTS in message:
+                    for item in message[CONTACTS]:
+                        state = 'в сети' if item.get(STATUS) == ONLINE else 'вышел из сети'
+                        print(f'\nКонтакт {item.get(ACCOUNT_NAME)} {state}.')
+                elif ACTION in message and message[ACTION] == PING:
+                    # сервер проверяет, что соединение живо
+                    self.send({ACTION: PONG, TIME: time.time(), LAST_SEQ: self.received})
+                elif ACTION in message and message[ACTION] == PONG:
+                    logger.debug('Сервер ответил на ping.')
+                elif RESPONSE in message:
+                    # ответы сервера на запросы: об успехе только в лог, ошибки показываем пользователю
+                    if message[RESPONSE] == 200:
+                        logger.debug(f'Сервер подтвердил запрос: {message}')
+                    elif message[RESPONSE] == 202 and CONTACTS in message:
+                        print(f'\nКонтактов: {len(message[CONTACTS])}')
+                        for item in message[CONTACTS]:
+                            state = 'в сети' if item.get(STATUS) == ONLINE else 'не в сети'
+                            print(f'{item.get(ACCOUNT_NAME)} - {state}')
+                    elif message[RESPONSE] == 202 and MESSAGES in message:
+                        if QUERY in message:
+                            print(f'\nНайдено сообщений по запросу "{message[QUERY]}": {len(message[MESSAGES])}')
+                        else:
+                            print(f'\nИстория переписки с пользователем {message.get(USER)}:')
+                        for item in message[MESSAGES]:
+                            moment = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(item.get(TIME, 0)))
+                            print(f'{moment} {item.get(SENDER)}: {item.get(MESSAGE_TEXT)}')
+                    else:
+                        print(f'\nОшибка сервера: {message.get(ERROR)}')
+                        logger.error(f'Сервер вернул ошибку: {message}')
                 else:
                     logger.error(f'Получено некорректное сообщение с сервера: {message}')
             except IncorrectDataRecivedError:
+                # кадр принят, хотя и не декодирован, в нумерации кадров он учитывается
+                if self.decoder is not None:
+                    self.received += 1
                 logger.error(f'Не удалось декодировать полученное сообщение.')
             except (OSError, ConnectionError, ConnectionAbortedError, ConnectionResetError, json.JSONDecodeError):
+                if self.resume is not None and self.decoder is not None:
+                    logger.warning(f'Потеряно соединение с сервером, восстанавливаем сессию.')
+                    if self.reconnect():
+                        continue
                 logger.critical(f'Потеряно соединение с сервером.')
                 break
 
 
-# Функция генерирует запрос о присутствии клиента
+# Функция генерирует запрос о присутствии клиента, при необходимости предлагая серверу режим передачи сообщений
+# и кодек
 @log
-def create_presence(account_name):
+def create_presence(account_name, framing=None, codec=None, resume_token=None, last_seq=None):
     out = {
         ACTION: PRESENCE,
         TIME: time.time(),
@@ -116,10 +361,35 @@ def create_presence(account_name):
             ACCOUNT_NAME: account_name
         }
     }
+    if framing:
+        out[FRAMING] = framing
+    if codec:
+        out[CODEC] = codec
+    # для восстановления сессии передаётся токен и количество уже полученных кадров
+    if resume_token:
+        out[RESUME_TOKEN] = resume_token
+        out[LAST_SEQ] = last_seq or 0
     logger.debug(f'Сформировано {PRESENCE} сообщение для пользователя {account_name}')
     return out
 
 
+# Функция генерирует пакет сообщений из списка пар (получатель, текст)
+@log
+def create_batch(account_name, messages):
+    now = time.time()
+    return {
+        ACTION: BATCH,
+        TIME: now,
+        MESSAGES: [{
+            ACTION: MESSAGE,
+            SENDER: account_name,
+            DESTINATION: to,
+            TIME: now,
+            MESSAGE_TEXT: text
+        } for to, text in messages]
+    }
+
+
 # Функция разбирает ответ сервера на сообщение о присутствии, возращает 200 если все ОК или генерирует исключение при\
 # ошибке.
 @log
@@ -133,6 +403,20 @@ def process_response_ans(message):
     raise ReqFieldMissingError(RESPONSE)
 
 
+# Функция подключения к серверу: отправляет сообщение о присутствии с предложением режима с префиксом длинны
+# и двоичного кодека (и токеном, если сессия восстанавливается), возвращает сокет, ответ сервера и декодер кадров.
+@log
+def connect_server(server_address, server_port, account_name, resume_token=None, last_seq=None):
+    transport = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    transport.connect((server_address, server_port))
+    send_message(transport, create_presence(account_name, FRAMING_LENGTH_PREFIX, CODEC_BINARY, resume_token, last_seq))
+    decoder = FrameDecoder()
+    response = get_handshake_response(transport, decoder)
+    # Сервер, не поддерживающий предложенный кодек, не укажет его в ответе, тогда используем JSON.
+    decoder.codec = CODECS.get(response.get(CODEC), CODECS[CODEC_JSON])
+    return transport, response, decoder
+
+
 # Парсер аргументов коммандной строки
 @log
 def arg_parser():
@@ -172,10 +456,10 @@ def main():
 
     # Инициализация сокета и сообщение серверу о нашем появлении
     try:
-        transport = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        transport.connect((server_address, server_port))
-        send_message(transport, create_presence(client_name))
-        answer = process_response_ans(get_message(transport))
+        transport, response, decoder = connect_server(server_address, server_port, client_name)
+        answer = process_response_ans(response)
+        # Сервер, не поддерживающий кадрирование, не подтвердит режим, тогда работаем по-старому.
+        framed = response.get(FRAMING) == FRAMING_LENGTH_PREFIX
         logger.info(f'Установлено соединение с сервером. Ответ сервера: {answer}')
         print(f'Установлено соединение с сервером.')
     except json.JSONDecodeError:
@@ -192,14 +476,33 @@ def main():
             f'Не удалось подключиться к серверу {server_address}:{server_port}, конечный компьютер отверг запрос на подключение.')
         exit(1)
     else:
+        # Токен для восстановления сессии после обрыва соединения, если сервер его выдал.
+        resume_token = response.get(RESUME_TOKEN)
+
+        # Восстановление сессии: новое подключение с токеном, сокет заменяется и у отправителя.
+        def resume(last_seq):
+            nonlocal resume_token
+            new_transport, new_response, new_decoder = connect_server(
+                server_address, server_port, client_name, resume_token, last_seq)
+            process_response_ans(new_response)
+            resumed = new_response.get(RESUME_TOKEN) == resume_token
+            resume_token = new_response.get(RESUME_TOKEN)
+            module_sender.sock = new_transport
+            module_sender.codec = new_decoder.codec
+            return new_transport, new_decoder, resumed
+
+        # Запись в сокет из обоих потоков выполняется под общей блокировкой, чтобы сообщения не перемешались.
+        sock_lock = threading.Lock()
+
         # Если соединение с сервером установлено корректно, запускаем клиенский процесс приёма сообщний
-        module_reciver = ClientReader(client_name , transport)
+        module_reciver = ClientReader(client_name , transport, decoder if framed else None,
+                                      resume if resume_token else None, sock_lock)
         module_reciver.daemon = True
-        module_reciver.start()
 
         # затем запускаем отправку сообщений и взаимодействие с пользователем.
-        module_sender = ClientSender(client_name , transport)
+        module_sender = ClientSender(client_name , transport, decoder.codec if framed else None, sock_lock)
         module_sender.daemon = True
+        module_reciver.start()
         module_sender.start()
         logger.debug('Запущены процессы')
 
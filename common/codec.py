@@ -0,0 +1,160 @@
+import json
+import struct
+import sys
+sys.path.append('../')
+from common.variables import *
+from errors import IncorrectDataRecivedError
+
+
+# Исключения, которыми завершается декодирование некорректных данных любым из кодеков
+DECODE_ERRORS = (IncorrectDataRecivedError, ValueError, RecursionError)
+
+
+# Кодек JSON - основной формат протокола JIM.
+class JsonCodec:
+    name = CODEC_JSON
+
+    def encode(self, message):
+        return json.dumps(message).encode(ENCODING)
+
+    def decode(self, data):
+        message = json.loads(data.decode(ENCODING))
+        if not isinstance(message, dict):
+            raise IncorrectDataRecivedError
+        return message
+
+
+# Компактный двоичный кодек. Ключи протокола передаются однобайтовыми метками, частые значения (названия действий)
+# - однобайтовыми константами, время - упакованным float. Каждое значение предваряется байтом типа.
+class BinaryCodec:
+    name = CODEC_BINARY
+
+    # Метки ключей протокола. Метка 0 означает, что следом передаётся сам ключ строкой.
+    key_tags = {key: tag for tag, key in enumerate((
+        ACTION, TIME, USER, ACCOUNT_NAME, SENDER, DESTINATION, MESSAGE_TEXT,
+        RESPONSE, ERROR, FRAMING, CODEC, GROUP, MESSAGES, RESUME_TOKEN, LAST_SEQ), 1)}
+    tag_keys = {tag: key for key, tag in key_tags.items()}
+
+    # Часто передаваемые строковые значения
+    constants = (PRESENCE, MESSAGE, EXIT, FRAMING_LENGTH_PREFIX, CODEC_JSON, CODEC_BINARY,
+                 CREATE_GROUP, JOIN_GROUP, LEAVE_GROUP, GROUP_MESSAGE, BATCH, PING, PONG)
+    constant_tags = {value: tag for tag, value in enumerate(constants)}
+
+    # Байты типов значений, при кодировании используются в виде готовых байтовых литералов
+    NONE, TRUE, FALSE, INT, FLOAT, STR, LONG_STR, DICT, LIST, CONST = range(10)
+
+    type_byte = struct.Struct('!B')
+    short_len = struct.Struct('!H')
+    long_len = struct.Struct('!I')
+    int_value = struct.Struct('!q')
+    float_value = struct.Struct('!d')
+
+    def encode(self, message):
+        if not isinstance(message, dict):
+            raise IncorrectDataRecivedError
+        parts = []
+        self._encode_value(message, parts)
+        return b''.join(parts)
+
+    def decode(self, data):
+        try:
+            message, offset = self._decode_value(data, 0)
+        except (struct.error, IndexError, KeyError, UnicodeDecodeError):
+            raise IncorrectDataRecivedError
+        if offset != len(data) or not isinstance(message, dict):
+            raise IncorrectDataRecivedError
+        return message
+
+    def _encode_value(self, value, parts):
+        if value is None:
+            parts.append(b'\x00')
+        elif value is True:
+            parts.append(b'\x01')
+        elif value is False:
+            parts.append(b'\x02')
+        elif isinstance(value, int):
+            parts.append(b'\x03' + self.int_value.pack(value))
+        elif isinstance(value, float):
+            parts.append(b'\x04' + self.float_value.pack(value))
+        elif isinstance(value, str):
+            tag = self.constant_tags.get(value)
+            if tag is not None:
+                parts.append(bytes((self.CONST, tag)))
+                return
+            encoded = value.encode(ENCODING)
+            if len(encoded) < 0x10000:
+                parts.append(b'\x05' + self.short_len.pack(len(encoded)))
+            else:
+                parts.append(b'\x06' + self.long_len.pack(len(encoded)))
+            parts.append(encoded)
+        elif isinstance(value, dict):
+            parts.append(b'\x07' + self.short_len.pack(len(value)))
+            for key, item in value.items():
+                tag = self.key_tags.get(key)
+                if tag is None:
+                    encoded = str(key).encode(ENCODING)
+                    parts.append(b'\x00' + self.short_len.pack(len(encoded)) + encoded)
+                else:
+                    parts.append(self.type_byte.pack(tag))
+                self._encode_value(item, parts)
+        elif isinstance(value, (list, tuple)):
+            parts.append(b'\x08' + self.long_len.pack(len(value)))
+            for item in value:
+                self._encode_value(item, parts)
+        else:
+            raise IncorrectDataRecivedError
+
+    def _decode_value(self, data, offset):
+        value_type = data[offset]
+        offset += 1
+        if value_type == self.NONE:
+            return None, offset
+        if value_type == self.TRUE:
+            return True, offset
+        if value_type == self.FALSE:
+            return False, offset
+        if value_type == self.INT:
+            return self.int_value.unpack_from(data, offset)[0], offset + 8
+        if value_type == self.FLOAT:
+            return self.float_value.unpack_from(data, offset)[0], offset + 8
+        if value_type == self.CONST:
+            return self.constants[data[offset]], offset + 1
+        if value_type == self.STR or value_type == self.LONG_STR:
+            return self._decode_str(data, offset, self.short_len if value_type == self.STR else self.long_len)
+        if value_type == self.DICT:
+            count = self.short_len.unpack_from(data, offset)[0]
+            offset += 2
+            result = {}
+            for _ in range(count):
+                tag = data[offset]
+                offset += 1
+                if tag:
+                    key = self.tag_keys[tag]
+                else:
+                    key, offset = self._decode_str(data, offset, self.short_len)
+                result[key], offset = self._decode_value(data, offset)
+            return result, offset
+        if value_type == self.LIST:
+            count = self.long_len.unpack_from(data, offset)[0]
+            offset += 4
+            result = []
+            for _ in range(count):
+                item, offset = self._decode_value(data, offset)
+                result.append(item)
+            return result, offset
+        raise IncorrectDataRecivedError
+
+    def _decode_str(self, data, offset, length_struct):
+        length = length_struct.unpack_from(data, offset)[0]
+        offset += length_struct.size
+        end = offset + length
+        if end > len(data):
+            raise IncorrectDataRecivedError
+        return bytes(data[offset:end]).decode(ENCODING), end
+
+
+JSON_CODEC = JsonCodec()
+BINARY_CODEC = BinaryCodec()
+
+# Поддерживаемые кодеки по именам, используемым при согласовании
+CODECS = {codec.name: codec for codec in (JSON_CODEC, BINARY_CODEC)}
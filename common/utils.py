@@ -1,16 +1,47 @@
 from common.variables import *
 from errors import IncorrectDataRecivedError, NonDictInputError
+from common.codec import JSON_CODEC
 import json
+import struct
 import sys
+from collections import deque
+from itertools import islice
 sys.path.append('../')
 from decos import log
 
 
 # Утилита приёма и декодирования сообщения
 # принимает байты выдаёт словарь, если приняточто-то другое отдаёт ошибку значения
+# Если передан декодер кадров, сообщение читается в режиме с префиксом длинны и декодируется кодеком декодера.
 @log
-def get_message(client):
-    encoded_response = client.recv(MAX_PACKAGE_LENGTH)
+def get_message(client, decoder=None):
+    if decoder is None:
+        encoded_response = client.recv(MAX_PACKAGE_LENGTH)
+        return decode_message(encoded_response)
+    while not decoder.frames:
+        data = client.recv(READ_BUFFER_SIZE)
+        if not data:
+            raise ConnectionError
+        decoder.feed(data)
+    return decoder.codec.decode(frame_body(decoder.frames.popleft()))
+
+
+# Утилита приёма ответа на сообщение о присутствии. Сервер, подтвердивший режим с префиксом длинны, присылает ответ
+# уже кадром, и всё, что пришло следом, остаётся в декодере. Ответ сервера без кадрирования разбирается как обычно.
+@log
+def get_handshake_response(client, decoder):
+    data = client.recv(READ_BUFFER_SIZE)
+    if not data:
+        raise ConnectionError
+    if data[:1] == b'{':
+        return decode_message(data)
+    decoder.feed(data)
+    return get_message(client, decoder)
+
+
+# Утилита декодирования уже принятых байт в словарь, используется там, где чтение из сокета выполняется отдельно
+# (например, в asyncio-сервере).
+def decode_message(encoded_response):
     if isinstance(encoded_response, bytes):
         json_response = encoded_response.decode(ENCODING)
         response = json.loads(json_response)
@@ -24,10 +55,129 @@ def get_message(client):
 
 # Утилита кодирования и отправки сообщения
 # принимает словарь и отправляет его
+# если передан кодек, сообщение кодируется им и отправляется кадром с префиксом длинны
 @log
-def send_message(sock, message):
+def send_message(sock, message, codec=None):
+    send_all(sock, encode_message(message, codec))
+
+
+# Утилита кодирования сообщения в байты для отправки, без кодека - в JSON без кадрирования
+def encode_message(message, codec=None):
     if not isinstance(message, dict):
         raise NonDictInputError
-    js_message = json.dumps(message)
-    encoded_message = js_message.encode(ENCODING)
-    sock.send(encoded_message)
+    if codec is None:
+        js_message = json.dumps(message)
+        return js_message.encode(ENCODING)
+    return encode_frame(codec.encode(message), route_header(message))
+
+
+# Утилита отправки байт целиком, с учётом частичной записи в сокет
+def send_all(sock, data):
+    data = memoryview(data)
+    while data:
+        sent = sock.send(data)
+        data = data[sent:]
+
+
+# Утилита формирования кадра: заголовок, заголовок маршрута (может быть пустым) и полезная нагрузка
+def encode_frame(payload, route=b''):
+    length = len(route) + len(payload)
+    if length > MAX_FRAME_LENGTH:
+        raise ValueError(f'Длинна кадра {length} превышает допустимую {MAX_FRAME_LENGTH}')
+    return struct.pack(FRAME_HEADER, length, len(route)) + route + payload
+
+
+# Утилита формирования заголовка маршрута. Заголовок есть только у сообщений пользователям, по нему сервер
+# пересылает кадр получателю, не разбирая само сообщение.
+def route_header(message):
+    if message.get(ACTION) == MESSAGE and DESTINATION in message and SENDER in message:
+        return message[DESTINATION].encode(ENCODING) + ROUTE_SEPARATOR + message[SENDER].encode(ENCODING)
+    return b''
+
+
+# Утилита разбора заголовка маршрута кадра, возвращает кортеж (получатель, отправитель) или None,
+# если кадр не содержит заголовка маршрута.
+def frame_route(frame):
+    route_length = struct.unpack_from(FRAME_HEADER, frame)[1]
+    if not route_length:
+        return None
+    route = frame[FrameDecoder.header_size:FrameDecoder.header_size + route_length]
+    destination, _, sender = route.partition(ROUTE_SEPARATOR)
+    return destination.decode(ENCODING), sender.decode(ENCODING)
+
+
+# Утилита выделения полезной нагрузки кадра
+def frame_body(frame):
+    route_length = struct.unpack_from(FRAME_HEADER, frame)[1]
+    return frame[FrameDecoder.header_size + route_length:]
+
+
+# Потоковый декодер кадров одного соединения. Принимает прочитанные из сокета блоки произвольного размера,
+# выделяет из них все целые кадры, а незавершённый остаток хранит до следующего чтения.
+class FrameDecoder:
+    header_size = struct.calcsize(FRAME_HEADER)
+
+    def __init__(self, codec=JSON_CODEC):
+        # Кодек сообщений соединения
+        self.codec = codec
+        self.buffer = bytearray()
+        # Очередь целиком принятых кадров вместе с заголовками
+        self.frames = deque()
+
+    # Добавляет прочитанные байты, возвращает количество выделенных кадров.
+    def feed(self, data):
+        buffer = self.buffer
+        buffer += data
+        offset = 0
+        count = 0
+        while len(buffer) - offset >= self.header_size:
+            length, route_length = struct.unpack_from(FRAME_HEADER, buffer, offset)
+            if length > MAX_FRAME_LENGTH or route_length > length:
+                raise IncorrectDataRecivedError
+            end = offset + self.header_size + length
+            if end > len(buffer):
+                break
+            self.frames.append(bytes(buffer[offset:end]))
+            offset = end
+            count += 1
+        if offset:
+            del buffer[:offset]
+        return count
+
+
+# Буфер исходящих данных одного соединения. Данные накапливаются и отправляются, когда сокет готов к записи,
+# несколько кадров - одной операцией записи. Сокет должен быть неблокирующим.
+class OutboundBuffer:
+    def __init__(self, coalesce=True):
+        self.chunks = deque()
+        # Количество байт, ожидающих отправки
+        self.size = 0
+        # Объединять ли кадры при записи. Сообщения без кадрирования отправляются по одному, иначе получатель
+        # не сможет их разделить.
+        self.coalesce = coalesce
+
+    def append(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+
+    # Отправляет сколько возможно без блокировки. Возвращает True, если буфер опустошён.
+    def flush(self, sock):
+        chunks = self.chunks
+        while chunks:
+            try:
+                if not self.coalesce:
+                    sent = sock.send(chunks[0])
+                elif hasattr(sock, 'sendmsg'):
+                    sent = sock.sendmsg(list(islice(chunks, MAX_WRITE_BATCH)))
+                else:
+                    sent = sock.send(b''.join(islice(chunks, MAX_WRITE_BATCH)))
+            except (BlockingIOError, InterruptedError):
+                return False
+            self.size -= sent
+            while sent:
+                if len(chunks[0]) <= sent:
+                    sent -= len(chunks.popleft())
+                else:
+                    chunks[0] = memoryview(chunks[0])[sent:]
+                    sent = 0
+        return True
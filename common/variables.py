@@ -2,16 +2,72 @@ import logging
 
 # Порт поумолчанию для сетевого ваимодействия
 DEFAULT_PORT = 7777
+# Порт по умолчанию для выдачи метрик сервера в текстовом формате (0 - не запускать). Выдача включается явно
+# ключом -m, чтобы несколько серверов на одном компьютере не конфликтовали из-за порта.
+DEFAULT_METRICS_PORT = 0
 # IP адрес по умолчанию для подключения клиента
 DEFAULT_IP_ADDRESS = '127.0.0.1'
-# Максимальная очередь подключений
-MAX_CONNECTIONS = 5
+# Максимальная очередь подключений, ожидающих приёма сервером
+MAX_CONNECTIONS = 1024
+# Количество процессов-обработчиков сервера по умолчанию
+DEFAULT_WORKERS = 1
+# Номер процесса-обработчика, который ведёт общий архив сообщений и индекс поиска в режиме нескольких процессов
+ARCHIVE_WORKER = 0
+# Управляющий сокет Unix, через который новый процесс сервера, запущенный на том же порту, получает у работающего
+# процесса слушающий сокет и подключения клиентов (шаблон имени файла)
+CONTROL_SOCKET = 'server_{port}.ctl'
+# Время ожидания передачи подключений между процессами сервера, в секундах
+HANDOFF_TIMEOUT = 30
+# Количество дескрипторов, передаваемых одним сообщением управляющего сокета (в Linux не более 253)
+HANDOFF_FDS_PER_MESSAGE = 250
+# Минимальный интервал между уведомлениями одного пользователя о входе и выходе его контактов, в секундах.
+# Изменения за интервал объединяются в одно уведомление.
+PRESENCE_INTERVAL = 1
+# Интервал повторного подключения к соседнему узлу сервера после обрыва канала связи, в секундах
+PEER_RETRY_INTERVAL = 2
 # Максимальная длинна сообщения в байтах
 MAX_PACKAGE_LENGTH = 1024
+# Размер блока чтения из сокета в режиме с кадрированием
+READ_BUFFER_SIZE = 65536
+# Заголовок кадра - длинна полезной нагрузки (4 байта, сетевой порядок) и длинна заголовка маршрута в её начале
+# (2 байта). Заголовок маршрута есть только у кадров с сообщениями пользователям: получатель и отправитель,
+# разделённые нулевым байтом, за ними следует само сообщение.
+FRAME_HEADER = '!IH'
+# Разделитель получателя и отправителя в заголовке маршрута
+ROUTE_SEPARATOR = b'\x00'
+# Порог заполнения буфера исходящих данных соединения в байтах, при превышении применяется политика переполнения
+OUTBOUND_HIGH_WATER = 1024 * 1024
+# Уровень, до которого должен освободиться буфер, чтобы возобновить чтение от приостановленных отправителей
+OUTBOUND_LOW_WATER = 256 * 1024
+# Максимальное количество кадров, отправляемых одной операцией записи
+MAX_WRITE_BATCH = 1024
+# Максимальное количество сообщений в одном пакете
+MAX_BATCH_SIZE = 10000
+# Время, в течение которого клиент может восстановить сессию по токену после обрыва соединения, в секундах
+RESUME_GRACE_PERIOD = 30
+# Объём последних неподтверждённых клиентом блоков кадров, хранимых сервером для повторной отправки
+# при восстановлении сессии, в байтах
+RESUME_LOG_BYTES = 1024 * 1024
+# Количество попыток восстановления сессии клиентом и пауза между ними, в секундах
+RESUME_ATTEMPTS = 5
+RESUME_RETRY_DELAY = 1
+# Максимальное время ожидания событий сетевого цикла сервера, после которого выполняются периодические проверки
+SERVER_TICK = 0.5
+# Время простоя соединения, после которого сервер (и клиент) отправляет ping, и время ожидания ответа на него,
+# после которого соединение считается оборванным, в секундах
+HEARTBEAT_INTERVAL = 30
+HEARTBEAT_TIMEOUT = 10
+# Длительность такта и количество ячеек колеса таймеров простоя соединений
+TIMER_WHEEL_TICK = 1
+TIMER_WHEEL_SLOTS = 64
+# Максимальная длинна полезной нагрузки одного кадра в байтах
+MAX_FRAME_LENGTH = 16 * 1024 * 1024
 # Кодировка проекта
 ENCODING = 'utf-8'
 # Текущий уровень логирования
 LOGGING_LEVEL = logging.DEBUG
+# Доля вызовов функций, записываемых в лог декоратором log (1 - все вызовы)
+LOG_CALL_SAMPLE_RATE = 1.0
 
 # Прококол JIM основные ключи:
 ACTION = 'action'
@@ -28,6 +84,80 @@ ERROR = 'error'
 MESSAGE = 'message'
 MESSAGE_TEXT = 'mess_text'
 EXIT = 'exit'
+FRAMING = 'framing'
+CODEC = 'codec'
+GROUP = 'group'
+# Действия с группами: создание, вступление, выход и сообщение всем участникам группы
+CREATE_GROUP = 'create_group'
+JOIN_GROUP = 'join_group'
+LEAVE_GROUP = 'leave_group'
+GROUP_MESSAGE = 'group_message'
+# Пакет сообщений: список сообщений пользователям, переданный одним запросом
+BATCH = 'batch'
+MESSAGES = 'messages'
+# Токен восстановления сессии и номер последнего кадра, полученного клиентом
+RESUME_TOKEN = 'resume_token'
+LAST_SEQ = 'last_seq'
+# Запрос истории переписки с пользователем: количество последних сообщений и момент, раньше которого они
+# заархивированы (необязательно)
+HISTORY = 'history'
+COUNT = 'count'
+BEFORE = 'before'
+# Поиск по истории переписки: слова запроса (ищутся сообщения, содержащие все слова), количество сообщений
+# в ответе и сколько найденных сообщений пропустить
+SEARCH = 'search'
+QUERY = 'query'
+LIMIT = 'limit'
+OFFSET = 'offset'
+# Сообщения других обработчиков для общего архива и ответ обработчика архива на запрос истории или поиска,
+# переданный им пользователю ACCOUNT_NAME
+ARCHIVE = 'archive'
+REPLY = 'reply'
+# Список контактов пользователя: запрос списка, добавление и удаление контакта (имя контакта - в USER), список
+# контактов с их состоянием в ответе и в уведомлениях о входе и выходе контактов
+GET_CONTACTS = 'get_contacts'
+ADD_CONTACT = 'add_contact'
+REMOVE_CONTACT = 'remove_contact'
+CONTACTS = 'contacts'
+PRESENCE_UPDATE = 'presence_update'
+# Проверка соединения: запрос и ответ
+PING = 'ping'
+PONG = 'pong'
+# Служебное сообщение между процессами-обработчиками и узлами сервера: изменение состояния пользователя
+# отправившего его обработчика или узла (в сети, ожидает восстановления сессии, не в сети)
+ROUTE = 'route'
+STATUS = 'status'
+ONLINE = 'online'
+DETACHED = 'detached'
+OFFLINE = 'offline'
+# Приветствие соседнего узла сервера: имя узла и общий ключ узлов
+PEER = 'peer'
+NODE = 'node'
+PEER_KEY = 'peer_key'
+# Служебный ключ сервера: исходный кадр сообщения, пересылаемый получателю без перекодирования
+RAW_FRAME = 'raw_frame'
+# Служебный ключ сервера: кодек, которым закодирован исходный кадр
+RAW_CODEC = 'raw_codec'
+# Служебный ключ сервера: сообщение переслано другим процессом-обработчиком и повторно не пересылается
+FORWARDED = 'forwarded'
+
+# Режимы передачи сообщений
+# Сообщения с префиксом длинны
+FRAMING_LENGTH_PREFIX = 'length_prefix'
+
+# Политики переполнения буфера исходящих данных получателя:
+# приостановить чтение от отправителя до освобождения буфера
+OUTBOUND_PAUSE = 'pause'
+# отбросить сообщение
+OUTBOUND_DROP = 'drop'
+# отключить медленного получателя
+OUTBOUND_DISCONNECT = 'disconnect'
+# Текущая политика переполнения
+OUTBOUND_POLICY = OUTBOUND_PAUSE
+
+# Кодеки сообщений в режиме с префиксом длинны
+CODEC_JSON = 'json'
+CODEC_BINARY = 'binary'
 
 # Словари - ответы:
 # 200
@@ -40,4 +170,43 @@ RESPONSE_400 = {
 
 # База данных для хранения данных сервера:
 SERVER_DB = 'sqlite:///server_db.db3'
+# Хранилище данных сервера: SQLAlchemy ORM (любая БД, которую поддерживает SQLAlchemy) или модуль sqlite3
+# с подготовленными запросами (только файл SQLite, быстрее)
+STORAGE_SQLALCHEMY = 'sqlalchemy'
+STORAGE_SQLITE = 'sqlite'
+STORAGE_BACKEND = STORAGE_SQLALCHEMY
+# Количество сохранённых сообщений, читаемых из БД за один запрос при доставке пользователю, вошедшему в сеть
+STORED_BATCH_SIZE = 500
+# Максимальное количество событий входа/выхода, записываемых в БД одной транзакцией
+WRITE_BATCH_SIZE = 1000
+# Максимальное время накопления пачки событий перед записью в БД, в секундах
+WRITE_BATCH_INTERVAL = 0.05
+# Максимальное количество пользователей в кэше справочника пользователей сервера
+USER_CACHE_SIZE = 100000
+# Количество записей истории входов на одной странице вывода
+HISTORY_PAGE_SIZE = 50
+# Время, в течение которого списки пользователей и пользователей онлайн выдаются из кэша без запроса к БД, в секундах
+LISTING_CACHE_TTL = 1
+# Каталог архива сообщений пользователям
+ARCHIVE_DIR = 'archive'
+# Максимальный размер одного сегмента журнала архива в байтах
+ARCHIVE_SEGMENT_SIZE = 64 * 1024 * 1024
+# Интервал сброса журнала и индекса архива на диск, в секундах
+ARCHIVE_FLUSH_INTERVAL = 1
+# Максимальное количество сегментов архива, одновременно отображённых в память
+ARCHIVE_MAPPED_SEGMENTS = 16
+# Максимальное количество сообщений в ответе на запрос истории переписки
+HISTORY_MAX_COUNT = 1000
+# Интервал, с которым индекс поиска дочитывает новые сообщения архива, в секундах
+SEARCH_INDEX_INTERVAL = 1
+# Количество сообщений в сегменте индекса поиска, после которого он записывается на диск, и интервал записи
+# неполного сегмента, в секундах
+SEARCH_SEGMENT_DOCS = 10000
+SEARCH_FLUSH_INTERVAL = 10
+# Количество сегментов индекса поиска одного уровня, которые объединяются в один
+SEARCH_MERGE_FACTOR = 4
+# Максимальная длинна индексируемого слова
+SEARCH_MAX_TERM_LENGTH = 64
+# Максимальное количество сообщений в ответе на поисковый запрос
+SEARCH_MAX_RESULTS = 100
 
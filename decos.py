@@ -1,7 +1,9 @@
 import sys
+import random
+import logging
 import logs.config_server_log
 import logs.config_client_log
-import logging
+from common.variables import LOG_CALL_SAMPLE_RATE
 
 # метод определения модуля, источника запуска.
 if sys.argv[0].find('client') == -1:
@@ -12,9 +14,16 @@ else:
     logger = logging.getLogger('client')
 
 
-def log(func_to_log):
+# Декоратор логирования вызовов. Строка с параметрами формируется, только если уровень DEBUG включён, и только для
+# доли вызовов sample_rate. Можно применять как @log, так и @log(sample_rate=0.01).
+def log(func_to_log=None, sample_rate=LOG_CALL_SAMPLE_RATE):
+    if func_to_log is None:
+        return lambda func: log(func, sample_rate)
+
     def log_saver(*args , **kwargs):
-        logger.debug(f'Была вызвана функция {func_to_log.__name__} c параметрами {args} , {kwargs}. Вызов из модуля {func_to_log.__module__}')
+        if logger.isEnabledFor(logging.DEBUG) and (sample_rate >= 1 or random.random() < sample_rate):
+            logger.debug('Была вызвана функция %s c параметрами %s , %s. Вызов из модуля %s',
+                         func_to_log.__name__, args, kwargs, func_to_log.__module__)
         ret = func_to_log(*args , **kwargs)
         return ret
-    return log_saver
\ No newline at end of file
+    return log_saver
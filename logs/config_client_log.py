@@ -2,6 +2,9 @@ import sys
 import os
 sys.path.append('../')
 import logging
+import logging.handlers
+import queue
+import atexit
 from common.variables import LOGGING_LEVEL
 
 # создаём формировщик логов (formatter):
@@ -20,8 +23,13 @@ log_file.setFormatter(client_formatter)
 
 # создаём регистратор и настраиваем его
 logger = logging.getLogger('client')
-logger.addHandler(steam)
-logger.addHandler(log_file)
+# запись в поток и файл выполняется отдельным потоком, регистратор только кладёт записи в очередь
+log_queue = queue.Queue()
+listener = logging.handlers.QueueListener(log_queue, steam, log_file, respect_handler_level=True)
+listener.start()
+atexit.register(listener.stop)
+
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
 logger.setLevel(LOGGING_LEVEL)
 
 # отладка
@@ -3,6 +3,8 @@ sys.path.append('../')
 import logging
 import logging.handlers
 import os
+import queue
+import atexit
 from common.variables import LOGGING_LEVEL
 
 # создаём формировщик логов (formatter):
@@ -21,8 +23,13 @@ log_file.setFormatter(server_formatter)
 
 # создаём регистратор и настраиваем его
 logger = logging.getLogger('server')
-logger.addHandler(steam)
-logger.addHandler(log_file)
+# запись в поток и файл выполняется отдельным потоком, регистратор только кладёт записи в очередь
+log_queue = queue.Queue()
+listener = logging.handlers.QueueListener(log_queue, steam, log_file, respect_handler_level=True)
+listener.start()
+atexit.register(listener.stop)
+
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
 logger.setLevel(LOGGING_LEVEL)
 
 # отладка
@@ -8,6 +8,9 @@ class ServerMaker(type):
         attrs = []
 
         for func in clsdict:
+            # Строковые атрибуты класса dis попытался бы скомпилировать как исходный код.
+            if isinstance(clsdict[func], str):
+                continue
             try:
                 ret = dis.get_instructions(clsdict[func])
             except TypeError:
@@ -25,7 +28,9 @@ class ServerMaker(type):
 
         if 'connect' in methods:
             raise TypeError('Использование метода connect недопустимо в серверном классе')
-        if not ('SOCK_STREAM' in attrs and 'AF_INET' in attrs):
+        # Наследник уже проверенного сервера может использовать инициализацию сокета предка.
+        inherited = any(isinstance(base, ServerMaker) for base in bases)
+        if not inherited and not ('SOCK_STREAM' in attrs and 'AF_INET' in attrs):
             raise TypeError('Некорректная инициализация сокета.')
 
         super().__init__(clsname, bases, clsdict)
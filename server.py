@@ -1,19 +1,36 @@
 import socket
 import sys
 import argparse
+import asyncio
+import datetime
+import errno
 import json
 import logging
-import select
+import multiprocessing
+import os
+import pickle
+import queue
+import selectors
+import secrets
+import signal
+import struct
 import time
 import threading
+from collections import OrderedDict, deque
 import logs.config_server_log
 from errors import IncorrectDataRecivedError
 from common.variables import *
 from common.utils import *
+from common.codec import CODECS, DECODE_ERRORS
 from decos import log
 from descriptors import Port
 from metaclasses import ServerMaker
-from server_database import ServerStorage
+from server_archive import MessageArchive
+from server_database import create_storage
+from server_metrics import METRICS, start_metrics_server
+from server_registry import SessionRegistry
+from server_search import SearchIndex
+from server_timers import TimerWheel
 
 # Инициализация логирования сервера.
 logger = logging.getLogger('server')
@@ -25,141 +42,1663 @@ def arg_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('-p', default=DEFAULT_PORT, type=int, nargs='?')
     parser.add_argument('-a', default='', nargs='?')
+    parser.add_argument('-e', '--engine', default='select', choices=('select', 'asyncio'))
+    parser.add_argument('-m', '--metrics-port', default=DEFAULT_METRICS_PORT, type=int)
+    parser.add_argument('-w', '--workers', default=DEFAULT_WORKERS, type=int)
+    parser.add_argument('--peer', action='append', default=[])
+    parser.add_argument('--peer-key', default=None)
+    parser.add_argument('-c', '--control', default=None)
+    parser.add_argument('--reload', action='store_true')
+    parser.add_argument('--archive', default=ARCHIVE_DIR)
     namespace = parser.parse_args(sys.argv[1:])
     listen_address = namespace.a
     listen_port = namespace.p
-    return listen_address, listen_port
+    engine = namespace.engine
+    metrics_port = namespace.metrics_port
+    workers = max(1, namespace.workers)
+    peers = namespace.peer
+    peer_key = namespace.peer_key
+    # Пустое имя управляющего сокета отключает передачу подключений между процессами.
+    control = CONTROL_SOCKET.format(port=listen_port) if namespace.control is None else namespace.control
+    # Пустое имя каталога архива отключает архивирование сообщений.
+    archive = namespace.archive
+    # Подключения у работающего сервера принимаются только по явному запросу.
+    reload = namespace.reload
+    return listen_address, listen_port, engine, metrics_port, workers, peers, peer_key, control, archive, reload
+
+
+# Состояние сессии, которую клиент может восстановить по токену после обрыва соединения. Кадры, поставленные
+# в буфер клиента после ответа на приветствие, нумеруются подряд, клиент считает полученные кадры так же.
+class ResumeState:
+    __slots__ = ('name', 'token', 'codec', 'seq', 'log', 'log_size', 'detached', 'held')
+
+    def __init__(self, name, token, codec):
+        self.name = name
+        self.token = token
+        # Кодек сессии, повторно отправляемые кадры уже закодированы им
+        self.codec = codec
+        # Номер последнего кадра, поставленного в буфер клиента
+        self.seq = 0
+        # Последние блоки кадров, ещё не подтверждённые клиентом: (номер первого кадра, данные, количество кадров).
+        # Создаётся при первой отправке, занимает не больше RESUME_LOG_BYTES байт.
+        self.log = None
+        self.log_size = 0
+        # Время обрыва соединения или None, пока клиент подключён
+        self.detached = None
+        # Сообщения, пришедшие клиенту, пока он не подключён
+        self.held = []
+
+    def record(self, data, count):
+        if self.log is None:
+            self.log = deque()
+        self.log.append((self.seq + 1, data, count))
+        self.log_size += len(data)
+        self.seq += count
+        while self.log_size > RESUME_LOG_BYTES:
+            self.log_size -= len(self.log.popleft()[1])
+
+    # Клиент подтвердил получение кадров по last_seq включительно (в ping и ответе на ping): полностью полученные
+    # блоки больше не понадобятся для повторной отправки.
+    def acknowledge(self, last_seq):
+        if not self.log or not isinstance(last_seq, int) or not 0 <= last_seq <= self.seq:
+            return
+        while self.log and self.log[0][0] + self.log[0][2] - 1 <= last_seq:
+            self.log_size -= len(self.log.popleft()[1])
+
+    # Блоки кадров после кадра last_seq или None, если клиент не мог получить кадр с таким номером.
+    def replay(self, last_seq):
+        if not 0 <= last_seq <= self.seq:
+            return None
+        chunks = []
+        for first, data, count in reversed(self.log or ()):
+            if first + count - 1 <= last_seq:
+                break
+            # Блок получен частично - отправляем только недостающие кадры из него.
+            if first <= last_seq:
+                decoder = FrameDecoder()
+                decoder.feed(data)
+                data = b''.join(list(decoder.frames)[last_seq - first + 1:])
+            chunks.append(data)
+        chunks.reverse()
+        return chunks
+
+    # Состояние сессии в виде простых структур для передачи новому процессу сервера: кодек передаётся по имени.
+    def dump(self):
+        return (self.name, self.token, self.codec.name, self.seq, None if self.log is None else list(self.log),
+                self.detached, [dump_message(message) for message in self.held])
+
+    @classmethod
+    def load(cls, data):
+        name, token, codec, seq, log, detached, held = data
+        state = cls(name, token, CODECS[codec])
+        state.seq = seq
+        if log is not None:
+            state.log = deque(log)
+            state.log_size = sum(len(data) for first, data, count in state.log)
+        state.detached = detached
+        state.held = [load_message(message) for message in held]
+        return state
+
+
+# Проверка сообщения пользователю: действие, обязательные поля, имена отправителя и получателя - строки (имена
+# используются как ключи словарей сервера).
+def is_user_message(message):
+    return isinstance(message, dict) and message.get(ACTION) == MESSAGE and TIME in message \
+        and MESSAGE_TEXT in message and isinstance(message.get(SENDER), str) \
+        and isinstance(message.get(DESTINATION), str)
+
+
+# Функции преобразования сообщения из очереди сервера для передачи новому процессу сервера и обратно: кодек
+# исходного кадра передаётся по имени.
+def dump_message(message):
+    if RAW_CODEC in message:
+        message = dict(message)
+        message[RAW_CODEC] = message[RAW_CODEC].name
+    return message
+
+
+def load_message(message):
+    if RAW_CODEC in message:
+        message[RAW_CODEC] = CODECS[message[RAW_CODEC]]
+    return message
 
 
 # Основной класс сервера
 class Server(threading.Thread, metaclass=ServerMaker):
     port = Port()
 
-    def __init__(self, listen_address, listen_port, database):
+    # worker и links задаются в режиме нескольких процессов: номер этого процесса-обработчика и сокеты каналов связи
+    # с остальными обработчиками по их номерам. peers - адреса (хост:порт) соседних узлов, к которым сервер
+    # подключается сам, peer_key - общий ключ узлов, без него подключения соседних узлов не принимаются.
+    # control - путь управляющего сокета, через который подключения передаются новому процессу сервера.
+    # archive - архив сообщений пользователям (MessageArchive), без него сообщения не архивируются, search - индекс
+    # поиска по архиву (SearchIndex). archive_worker - номер обработчика, который ведёт общий архив, если его ведёт
+    # не этот обработчик.
+    def __init__(self, listen_address, listen_port, database, worker=None, links=None, peers=None, peer_key=None,
+                 control=None, archive=None, search=None, archive_worker=None):
         # Параментры подключения
         self.addr = listen_address
         self.port = listen_port
+        # Слушающий сокет. Задаётся до запуска, если получен от прежнего процесса сервера.
+        self.sock = None
+
+        # Управляющий сокет и путь к нему
+        self.control_path = control
+        self.control = None
+
+        # Номер процесса-обработчика и каналы связи с другими обработчиками и узлами (сессии по номеру
+        # обработчика или имени узла).
+        self.worker = worker
+        self.links = links or dict()
+        self.peer_links = dict()
+
+        # Соседние узлы: имя этого узла, адреса узлов для подключения и время следующей попытки подключения.
+        self.node = f'{listen_address or socket.gethostname()}:{listen_port}'
+        self.peers = [peer for peer in peers or () if peer != self.node]
+        self.peer_key = peer_key
+        self.peers_retry = 0
+
+        # Таблица маршрутизации: имя пользователя, подключенного к другому обработчику или узлу -> (номер
+        # обработчика или имя узла, True - в сети, False - ожидает восстановления сессии). Обработчики и узлы
+        # сообщают друг другу об изменениях.
+        self.routes = dict()
 
         # База данных сервера
         self.database = database
+        # Архив сообщений и индекс поиска по нему
+        self.archive = archive
+        self.search = search
+        # В режиме нескольких процессов архив один на все обработчики. Остальные обработчики передают ему принятые
+        # сообщения пакетом за каждый проход цикла, а запросы истории и поиска - вместе с именем пользователя.
+        self.archive_worker = archive_worker
+        self.archive_pending = []
+        # Поисковые запросы (клиент, имя, запрос, limit, offset) выполняет отдельный поток, он запускается при первом
+        # запросе. Готовые ответы (клиент, имя, ответ) отправляет клиентам цикл сервера, поток будит его через
+        # wake_loop: в сервере на select - записью в сокет пробуждения, который слушает селектор.
+        self.search_requests = queue.Queue()
+        self.search_results = queue.SimpleQueue()
+        self.searcher = None
+        self.wakeup = None
 
-        # Список подключённых клиентов.
-        self.clients = []
+        # Реестр подключённых клиентов: сессии по дескриптору сокета и по имени пользователя. Подключения
+        # регистрируются в селекторе (epoll, где он есть), который ждёт событий основного цикла.
+        self.registry = SessionRegistry(self.create_selector())
+
+        # Пользователи этого обработчика в сети (включая ожидающих восстановления сессии): имя -> (адрес, порт,
+        # время входа). Отсюда же консоль сервера выводит список подключенных.
+        self.presence = dict()
+        # Уведомления о входе и выходе контактов: для каждого получателя - изменения, накопленные с последнего
+        # уведомления (имя контакта -> состояние). Получатель уведомляется не чаще раза в PRESENCE_INTERVAL:
+        # presence_sent - время последнего уведомления получателей, которым новое пока не положено, presence_waiting -
+        # очередь (срок, получатель) в порядке отправки, presence_ready - получатели, которых можно уведомить сейчас.
+        self.presence_updates = dict()
+        self.presence_sent = dict()
+        self.presence_waiting = deque()
+        self.presence_ready = []
 
         # Список сообщений на отправку.
         self.messages = []
 
-        # Словарь содержащий сопоставленные имена и соответствующие им сокеты.
-        self.names = dict()
+        # Клиенты, у которых в буфере исходящих данных есть неотправленные данные.
+        self.pending = set()
+
+        # Клиенты, чтение от которых приостановлено из-за переполнения буфера получателя, и для каждого
+        # переполненного получателя - приостановленные им отправители.
+        self.paused = set()
+        self.blocked_by = dict()
+
+        # Отключившиеся сессии, которые можно восстановить по токену, в порядке обрыва соединения. Хранятся, пока
+        # не истечёт RESUME_GRACE_PERIOD.
+        self.detached = OrderedDict()
+
+        # Доставка сохранённых сообщений: имя пользователя -> номера сообщений, поставленных в буфер клиента.
+        # Сообщения удаляются из БД, когда буфер будет полностью отправлен, после этого ставится следующая пачка.
+        self.stored_delivery = dict()
+
+        # Признак работы сервера. Сбрасывается по сигналу завершения, цикл сервера завершается в конце итерации.
+        self.running = True
+
+        # Таймеры простоя подключений. По таймеру проверяется, были ли данные от клиента: простаивающему клиенту
+        # отправляется ping, не ответивший на него отключается.
+        self.timers = TimerWheel(TIMER_WHEEL_TICK, TIMER_WHEEL_SLOTS)
+
+        # Метрики сервера
+        self.connections_total = METRICS.counter('connections_total', 'Принято подключений')
+        self.messages_routed = METRICS.counter('messages_routed_total', 'Сообщений передано в буферы получателей')
+        self.messages_stored = METRICS.counter('messages_stored_total', 'Сообщений сохранено для пользователей не в сети')
+        self.messages_dropped = METRICS.counter('messages_dropped_total', 'Сообщений отброшено')
+        self.messages_forwarded = METRICS.counter('messages_forwarded_total', 'Сообщений передано другим обработчикам')
+        self.sessions_evicted = METRICS.counter('sessions_evicted_total', 'Отключено клиентов, не ответивших на ping')
+        self.bytes_received = METRICS.counter('bytes_received_total', 'Байт принято от клиентов')
+        self.bytes_sent = METRICS.counter('bytes_sent_total', 'Байт отправлено клиентам')
+        self.backlog = METRICS.gauge('messages_backlog', 'Сообщений в очереди на маршрутизацию')
+        self.loop_time = METRICS.histogram('loop_iteration_seconds', 'Время обработки одной итерации цикла, секунд')
+        METRICS.gauge('connections_active', 'Подключено клиентов').function = lambda: len(self.registry)
+        METRICS.gauge('users_online', 'Пользователей в сети').function = lambda: len(self.registry.by_name)
+        METRICS.gauge('outbound_pending_bytes', 'Байт в буферах исходящих данных').function = \
+            lambda: sum(client.outbound.size for client in list(self.pending) if client.outbound)
+        METRICS.gauge('clients_paused', 'Клиентов с приостановленным чтением').function = lambda: len(self.paused)
 
         # Конструктор предка
         super().__init__()
 
+    # Название движка в сообщении о запуске
+    engine = 'сервер'
+
     def init_socket(self):
         logger.info(
-            f'Запущен сервер, порт для подключений: {self.port} , адрес с которого принимаются подключения: {self.addr}. Если адрес не указан, принимаются соединения с любых адресов.')
-        # Готовим сокет
-        transport = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        transport.bind((self.addr, self.port))
-        transport.settimeout(0.5)
+            f'Запущен {self.engine}, порт для подключений: {self.port} , адрес с которого принимаются подключения: {self.addr}. Если адрес не указан, принимаются соединения с любых адресов.')
+        # Сокет, полученный от прежнего процесса, уже слушает порт.
+        if self.sock is None:
+            # Готовим сокет
+            transport = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            transport.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            # Обработчики слушают один порт, подключения между ними распределяет ядро.
+            if self.worker is not None:
+                transport.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            transport.bind((self.addr, self.port))
+
+            # Начинаем слушать сокет.
+            self.sock = transport
+            self.sock.listen(MAX_CONNECTIONS)
+        self.init_listener()
+
+    # Режим слушающего сокета: селектор сообщает о новых подключениях, accept ждёт не дольше таймаута.
+    def init_listener(self):
+        self.sock.settimeout(0.5)
+
+    # Управляющий сокет Unix. Доступен только владельцу: через него можно получить все подключения сервера.
+    # Файл создаётся с правами 0600 (маска на время создания), поэтому другие пользователи не успеют к нему
+    # подключиться. Файл, оставшийся от прежнего процесса, удаляется.
+    def init_control(self):
+        if not self.control_path:
+            return
+        if os.path.exists(self.control_path):
+            os.unlink(self.control_path)
+        control = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o177)
+        try:
+            control.bind(self.control_path)
+        finally:
+            os.umask(umask)
+        control.listen(1)
+        control.setblocking(False)
+        self.control = control
 
-        # Начинаем слушать сокет.
-        self.sock = transport
-        self.sock.listen()
+    # Каналы связи с другими обработчиками регистрируются как подключения в режиме с кадрированием и двоичным
+    # кодеком, их сообщения разбираются тем же кодом, что и сообщения клиентов.
+    def init_links(self):
+        for worker, sock in self.links.items():
+            sock.setblocking(False)
+            self.add_link(self.registry.add(sock), worker)
+        self.connect_peers()
+
+    # Функция регистрирует подключение как канал связи с обработчиком или узлом peer.
+    def add_link(self, link, peer):
+        link.peer = peer
+        if link.decoder is None:
+            link.decoder = FrameDecoder()
+            link.decoder.codec = CODECS[CODEC_BINARY]
+        self.peer_links[peer] = link
+
+    # Функция подключения к соседним узлам, с которыми ещё нет канала связи, не чаще раза в PEER_RETRY_INTERVAL.
+    # Подключение неблокирующее: приветствие и список пользователей узла ставятся в буфер канала и отправляются,
+    # когда соединение будет установлено. При ошибке канал закрывается, и подключение повторяется позже.
+    def connect_peers(self):
+        now = time.monotonic()
+        if not self.peers or now < self.peers_retry:
+            return
+        self.peers_retry = now + PEER_RETRY_INTERVAL
+        for peer in self.peers:
+            if peer in self.peer_links:
+                continue
+            host, port = peer.rsplit(':', 1)
+            transport = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            transport.setblocking(False)
+            error = transport.connect_ex((host, int(port)))
+            if error not in (0, errno.EINPROGRESS):
+                transport.close()
+                continue
+            link = self.registry.add(transport)
+            self.add_link(link, peer)
+            self.timers.schedule(link, HEARTBEAT_INTERVAL)
+            self.send_to(link, {ACTION: PEER, TIME: time.time(), NODE: self.node, PEER_KEY: self.peer_key})
+            self.sync_routes(link)
+            logger.info(f'Подключение к узлу {peer}.')
+        self.flush_pending()
+
+    # Функция передаёт по новому каналу связи состояние всех пользователей этого узла.
+    def sync_routes(self, link):
+        for client in list(self.registry.by_name.values()):
+            self.queue_data(link, encode_message({ACTION: ROUTE, ACCOUNT_NAME: client.name, STATUS: ONLINE},
+                                                 link.decoder.codec))
+        for name in self.detached:
+            self.queue_data(link, encode_message({ACTION: ROUTE, ACCOUNT_NAME: name, STATUS: DETACHED},
+                                                 link.decoder.codec))
 
     def run(self):
         # Инициализация Сокета
         self.init_socket()
+        self.init_control()
+        self.init_links()
+        selector = self.registry.selector
+        selector.register(self.sock, selectors.EVENT_READ, self.sock)
+        if self.control is not None:
+            selector.register(self.control, selectors.EVENT_READ, self.control)
+        if self.search is not None:
+            self.wakeup = socket.socketpair()
+            for sock in self.wakeup:
+                sock.setblocking(False)
+            selector.register(self.wakeup[0], selectors.EVENT_READ, self.wakeup[0])
 
         # Основной цикл программы сервера
+        while self.running:
+            takeover = False
+            # Ждём новых подключений, сообщений от клиентов (кроме приостановленных) и готовности к записи
+            # клиентов с неотправленными данными. Селектор возвращает только готовые подключения.
+            ready = selector.select(SERVER_TICK)
+            started = time.perf_counter()
+
+            # принимаем сообщения и если ошибка, исключаем клиента.
+            for key, events in ready:
+                client_with_message = key.data
+                if client_with_message is self.sock:
+                    self.accept_client()
+                    continue
+                if client_with_message is self.control:
+                    takeover = True
+                    continue
+                # Готовы ответы на поисковые запросы, они отправляются ниже.
+                if self.wakeup is not None and client_with_message is self.wakeup[0]:
+                    try:
+                        self.wakeup[0].recv(READ_BUFFER_SIZE)
+                    except OSError:
+                        pass
+                    continue
+                # Клиент мог быть отключён или приостановлен при обработке предыдущих.
+                if not events & selectors.EVENT_READ or client_with_message not in self.registry \
+                        or client_with_message in self.paused:
+                    continue
+                try:
+                    self.process_client_data(client_with_message.sock.recv(READ_BUFFER_SIZE), client_with_message)
+                except Exception:
+                    logger.info(f'Клиент {client_with_message} отключился от сервера.')
+                    self.remove_client(client_with_message)
+
+            # Если есть сообщения, обрабатываем каждое, затем отправляем накопленное в буферах.
+            self.route_messages()
+            self.deliver_search_results()
+            self.flush_pending()
+            self.expire_sessions()
+            self.check_heartbeats()
+            self.connect_peers()
+            self.flush_archive()
+            self.flush_presence()
+            self.loop_time.observe(time.perf_counter() - started)
+
+            # Запрос нового процесса сервера обрабатывается в конце итерации, когда очередь сообщений пуста.
+            if takeover:
+                try:
+                    conn, _ = self.control.accept()
+                except OSError:
+                    continue
+                self.handoff(conn)
+
+    # Селектор для реестра подключений, ждёт событий основного цикла.
+    def create_selector(self):
+        return selectors.DefaultSelector()
+
+    # Функция изменения событий, которых селектор ждёт от подключения: чтения, если оно не приостановлено,
+    # и готовности к записи, если в буфере есть неотправленные данные.
+    def update_events(self, client):
+        if self.registry.selector is None or client not in self.registry:
+            return
+        events = 0 if client in self.paused else selectors.EVENT_READ
+        if client in self.pending:
+            events |= selectors.EVENT_WRITE
+        self.registry.watch(client, events)
+
+    # Функция завершения работы сервера по сигналу. Вызывается из обработчика сигнала, поэтому только отмечает,
+    # что цикл нужно остановить.
+    def shutdown(self):
+        self.running = False
+
+    # Функция принимает новое подключение. Клиенты без кадрирования не отвечают на ping, обрыв соединения с ними
+    # обнаруживается по TCP keepalive.
+    def accept_client(self):
+        try:
+            client, client_address = self.sock.accept()
+        except OSError:
+            return
+        logger.info(f'Установлено соедение с ПК {client_address}')
+        client.setblocking(False)
+        client.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.timers.schedule(self.registry.add(client), HEARTBEAT_INTERVAL)
+        self.connections_total.inc()
+
+    # Функция передаёт слушающий сокет и подключения клиентов новому процессу сервера, подключившемуся к
+    # управляющему сокету: снимок состояния сессий (pickle, с префиксом длинны), затем дескрипторы сокетов
+    # (SCM_RIGHTS), слушающий - первым. После подтверждения приёма процесс завершается, закрывая свои копии
+    # сокетов без shutdown, поэтому соединения клиентов не разрываются. Каналы связи с другими узлами не передаются,
+    # новый процесс устанавливает их заново. Если новый процесс не подтвердил приём, сервер продолжает работу.
+    def handoff(self, conn):
+        logger.info('Передача подключений новому процессу сервера.')
+        conn.settimeout(HANDOFF_TIMEOUT)
+        # События входа и выхода, ещё не записанные в БД, и архив сообщений должны быть видны новому процессу.
+        self.database.flush()
+        if self.archive is not None:
+            self.archive.flush()
+        if self.search is not None:
+            self.stop_searcher()
+            self.search.stop()
+            self.search.flush(wait=True)
+        self.flush_pending()
+        clients = [client for client in self.registry if client.peer is None]
+        try:
+            data = pickle.dumps(self.snapshot(clients))
+            conn.sendall(struct.pack('!I', len(data)) + data)
+            fds = [self.sock.fileno()] + [client.fd for client in clients]
+            for start in range(0, len(fds), HANDOFF_FDS_PER_MESSAGE):
+                socket.send_fds(conn, [b'F'], fds[start:start + HANDOFF_FDS_PER_MESSAGE])
+            if conn.recv(1) != b'K':
+                raise ConnectionError('нет подтверждения приёма')
+        except OSError as error:
+            logger.error(f'Не удалось передать подключения новому процессу сервера: {error}')
+            conn.close()
+            if self.search is not None:
+                self.search.start()
+            return
+        logger.info(f'Новому процессу сервера передано подключений: {len(clients)}. Процесс завершается.')
+        for client in self.registry:
+            client.sock.close()
+        self.sock.close()
+        self.control.close()
+        self.database.close()
+        if self.search is not None:
+            self.search.close()
+        if self.archive is not None:
+            self.archive.close()
+        logs.config_server_log.listener.stop()
+        # Поток консоли ждёт ввода, поэтому процесс завершается сразу.
+        os._exit(0)
+
+    # Снимок состояния сервера для передачи новому процессу: сессии клиентов в порядке передачи их сокетов
+    # (имя, кодек, недоразобранные данные, неотправленные данные, состояние восстановления), сессии, ожидающие
+    # восстановления, и сообщения в очереди.
+    def snapshot(self, clients):
+        sessions = []
+        for client in clients:
+            decoder = client.decoder
+            sessions.append({
+                'name': client.name,
+                'codec': None if decoder is None else decoder.codec.name,
+                'buffer': b'' if decoder is None else bytes(decoder.buffer),
+                'frames': [] if decoder is None else list(decoder.frames),
+                'outbound': [] if client.outbound is None else [bytes(chunk) for chunk in client.outbound.chunks],
+                'resume': None if client.resume is None else client.resume.dump(),
+            })
+        return {
+            'sessions': sessions,
+            'detached': [state.dump() for state in self.detached.values()],
+            'messages': [dump_message(message) for message in self.messages],
+            'presence': self.presence,
+            'stored_delivery': self.stored_delivery,
+        }
+
+    # Функция восстанавливает состояние, полученное от прежнего процесса сервера, до запуска сервера. Сроки
+    # проверки простоя подключений отсчитываются заново.
+    def restore(self, snapshot, listen_sock, client_socks):
+        self.sock = listen_sock
+        for session, sock in zip(snapshot['sessions'], client_socks):
+            sock.setblocking(False)
+            client = self.registry.add(sock)
+            if session['name'] is not None:
+                self.registry.bind(client, session['name'])
+            if session['codec'] is not None:
+                client.decoder = FrameDecoder(CODECS[session['codec']])
+                client.decoder.buffer += session['buffer']
+                client.decoder.frames.extend(session['frames'])
+            if session['outbound']:
+                client.outbound = OutboundBuffer(client.decoder is not None)
+                for chunk in session['outbound']:
+                    client.outbound.append(chunk)
+                self.pending.add(client)
+                self.update_events(client)
+            if session['resume'] is not None:
+                client.resume = ResumeState.load(session['resume'])
+            self.timers.schedule(client, HEARTBEAT_INTERVAL)
+        for data in snapshot['detached']:
+            state = ResumeState.load(data)
+            self.detached[state.name] = state
+        self.messages.extend(load_message(message) for message in snapshot['messages'])
+        self.presence.update(snapshot.get('presence', ()))
+        self.stored_delivery.update(snapshot.get('stored_delivery', ()))
+
+    # Функция ставит накопленные сообщения в буферы адресатов. Принятые сообщения записываются в архив.
+    # Сообщение, которое пришлось декодировать, но не удалось, отбрасывается: получатель за него не отвечает
+    # и не отключается. Ошибки архива на доставку не влияют.
+    def route_messages(self):
+        self.backlog.set(len(self.messages))
+        try:
+            for message in self.messages:
+                try:
+                    routed = self.process_message(message)
+                except DECODE_ERRORS:
+                    self.messages_dropped.inc()
+                    logger.error(f'Некорректное сообщение от {message[SENDER]} для {message[DESTINATION]} отброшено.')
+                    continue
+                # Ошибка при обработке одного сообщения не должна останавливать цикл сервера.
+                except Exception as error:
+                    self.messages_dropped.inc()
+                    logger.exception(f'Ошибка при обработке сообщения, сообщение отброшено: {error}')
+                    continue
+                if routed:
+                    self.archive_message(message, FORWARDED in message)
+        finally:
+            self.messages.clear()
+        if self.archive_pending:
+            self.send_archive()
+
+    # Функция записывает сообщение в архив без декодирования. Индекс поиска дочитывает архив в своём потоке.
+    # В режиме нескольких процессов сообщение, полученное от другого обработчика (forwarded), уже передано в архив
+    # им, а обработчик без архива копит сообщения для обработчика архива: канал связи передаёт их декодированными.
+    def archive_message(self, message, forwarded=False):
+        if forwarded and self.worker is not None:
+            return
+        try:
+            if self.archive_worker is not None:
+                self.archive_pending.append(self.decode_routed(message))
+            elif self.archive is not None:
+                self.archive.append(message)
+        except DECODE_ERRORS:
+            logger.error(f'Некорректное сообщение от {message[SENDER]} не записано в архив.')
+        except (OSError, ValueError, struct.error) as error:
+            logger.error(f'Не удалось записать сообщение в архив: {error}')
+
+    # Функция передаёт накопленные сообщения обработчику архива пакетами не больше MAX_BATCH_SIZE.
+    def send_archive(self):
+        pending, self.archive_pending = self.archive_pending, []
+        for start in range(0, len(pending), MAX_BATCH_SIZE):
+            messages = pending[start:start + MAX_BATCH_SIZE]
+            if not self.send_to_worker(self.archive_worker, {ACTION: ARCHIVE, TIME: time.time(), MESSAGES: messages}):
+                logger.error(f'Нет связи с обработчиком архива, не записано в архив сообщений: {len(messages)}.')
+
+    # Функция возвращает ответ на запрос истории переписки: последние сообщения с собеседником из архива.
+    def history_response(self, message):
+        history = self.archive.history(message[ACCOUNT_NAME], str(message[USER]),
+                                       max(0, min(message[COUNT], HISTORY_MAX_COUNT)), message.get(BEFORE))
+        return {RESPONSE: 202, USER: message[USER], MESSAGES: history}
+
+    # Функция ставит поисковый запрос пользователя name в очередь потока поиска: чтение индекса и архива
+    # не задерживает цикл сервера. Запрос от другого обработчика (client - канал связи) выполняется для его
+    # пользователя.
+    def start_search(self, client, name, query, limit, offset):
+        if self.searcher is None:
+            self.searcher = threading.Thread(target=self.search_loop, daemon=True)
+            self.searcher.start()
+        self.search_requests.put((client, name, query, limit, offset))
+
+    # Поток поиска: выполняет запросы по очереди, пока не получит None.
+    def search_loop(self):
         while True:
-            # Ждём подключения, если таймаут вышел, ловим исключение.
+            request = self.search_requests.get()
+            if request is None:
+                return
+            client, name, query, limit, offset = request
+            try:
+                response = {RESPONSE: 202, QUERY: query, MESSAGES: self.search.search(name, query, limit, offset)}
+            except (OSError, ValueError, struct.error) as error:
+                logger.error(f'Не удалось выполнить поиск: {error}')
+                response = {RESPONSE: 400, ERROR: 'Поиск недоступен.'}
+            self.search_results.put((client, name, response))
+            self.wake_loop()
+
+    # Функция пробуждает цикл сервера, ожидающий событий селектора. Если буфер сокета пробуждения заполнен,
+    # цикл и так проснётся.
+    def wake_loop(self):
+        if self.wakeup is not None:
             try:
-                client, client_address = self.sock.accept()
+                self.wakeup[1].send(b'\0')
             except OSError:
                 pass
-            else:
-                logger.info(f'Установлено соедение с ПК {client_address}')
-                self.clients.append(client)
 
-            recv_data_lst = []
-            send_data_lst = []
-            err_lst = []
-            # Проверяем на наличие ждущих клиентов
+    # Функция отправляет клиентам готовые ответы на поисковые запросы. Клиент мог отключиться, пока шёл поиск.
+    # Ответ на запрос другого обработчика передаётся ему для его пользователя.
+    def deliver_search_results(self):
+        while not self.search_results.empty():
+            client, name, response = self.search_results.get()
+            if client not in self.registry:
+                continue
+            if client.peer is not None:
+                response = dict(response, **{ACTION: REPLY, ACCOUNT_NAME: name})
+            self.send_to(client, response)
+
+    # Функция останавливает поток поиска, дождавшись выполнения запросов из очереди, и отправляет ответы.
+    def stop_searcher(self):
+        if self.searcher is not None:
+            self.search_requests.put(None)
+            self.searcher.join()
+            self.searcher = None
+        self.deliver_search_results()
+
+    # Функция периодической записи архива и индекса поиска на диск.
+    def flush_archive(self):
+        if self.archive is not None:
+            self.archive.flush_if_due()
+        if self.search is not None:
+            self.search.flush_if_due()
+
+    # Функция отправляет данные из буферов клиентов, сколько возможно без блокировки.
+    def flush_pending(self):
+        for client in list(self.pending):
+            self.flush_client(client)
+
+    # Функция отправки данных из буфера клиента. Если буфер освободился, возобновляет чтение от отправителей,
+    # приостановленных из-за этого клиента. Возвращает True, если буфер опустошён.
+    def flush_client(self, client):
+        buffer = client.outbound
+        if buffer is None:
+            self.pending.discard(client)
+            self.update_events(client)
+            return True
+        size = buffer.size
+        try:
+            done = buffer.flush(client.sock)
+        except OSError:
+            logger.info(f'Связь с клиентом {client} была потеряна')
+            self.remove_client(client)
+            return True
+        self.bytes_sent.inc(size - buffer.size)
+        if done:
+            # Пустой буфер не храним, чтобы простаивающее подключение не занимало память.
+            self.pending.discard(client)
+            client.outbound = None
+            self.update_events(client)
+            # Сохранённые сообщения, поставленные в буфер, отправлены - ставим следующие.
+            if client.name in self.stored_delivery and self.registry.find(client.name) is client:
+                self.feed_stored(client.name, client)
+                done = client.outbound is None
+        if buffer.size <= OUTBOUND_LOW_WATER and client in self.blocked_by:
+            for sender in self.blocked_by.pop(client):
+                self.resume_reading(sender)
+        return done
+
+    # Функция ставит данные в буфер клиента, применяя политику переполнения. sender - клиент, от которого пришли
+    # данные, при политике приостановки чтение от него останавливается, пока буфер получателя не освободится.
+    # count - количество кадров в данных, учитывается при нумерации кадров восстанавливаемой сессии.
+    def queue_data(self, client, data, sender=None, count=1):
+        buffer = client.outbound
+        if buffer is None:
+            buffer = client.outbound = OutboundBuffer(client.decoder is not None)
+        if buffer.size >= OUTBOUND_HIGH_WATER:
+            if OUTBOUND_POLICY == OUTBOUND_DROP:
+                logger.warning(f'Буфер клиента {client} переполнен, сообщение отброшено.')
+                self.messages_dropped.inc()
+                return
+            # Канал связи с другим обработчиком не отключается, вместо этого приостанавливается отправитель.
+            if OUTBOUND_POLICY == OUTBOUND_DISCONNECT and client.peer is None:
+                logger.warning(f'Буфер клиента {client} переполнен, клиент отключён.')
+                self.messages_dropped.inc()
+                self.remove_client(client)
+                return
+            if sender is not None:
+                self.blocked_by.setdefault(client, set()).add(sender)
+                self.pause_reading(sender)
+        buffer.append(data)
+        if client not in self.pending:
+            self.pending.add(client)
+            self.update_events(client)
+        if client.resume is not None:
+            client.resume.record(data, count)
+
+    # Функции приостановки и возобновления чтения от клиента.
+    def pause_reading(self, client):
+        if client not in self.paused:
+            self.paused.add(client)
+            self.update_events(client)
+
+    def resume_reading(self, client):
+        if client in self.paused:
+            self.paused.discard(client)
+            self.update_events(client)
+
+    # Функция разбирает прочитанные от клиента байты. В режиме с кадрированием обрабатываются все целые кадры
+    # из прочитанного блока, иначе блок считается одним сообщением. Кадры сообщений пользователям, которые можно
+    # передать получателю без разбора, не декодируются: по заголовку маршрута они ставятся в очередь на отправку
+    # как есть. Остальные декодируются и проверяются сразу, так что за некорректное сообщение отвечает отправитель.
+    def process_client_data(self, data, client):
+        if not data:
+            raise ConnectionError
+        self.bytes_received.inc(len(data))
+        client.active = time.monotonic()
+        decoder = client.decoder
+        if decoder is None:
+            # Клиент начинает с приветствия в JSON, соседний узел сразу передаёт кадры в двоичном кодеке.
+            if client.name is not None or data[:1] == b'{':
+                self.process_client_message(decode_message(data), client)
+                return
+            decoder = client.decoder = FrameDecoder()
+            decoder.codec = CODECS[CODEC_BINARY]
+        decoder.feed(data)
+        while decoder.frames and client in self.registry:
+            frame = decoder.frames.popleft()
+            route = frame_route(frame)
+            if route is None:
+                self.process_client_message(decoder.codec.decode(frame_body(frame)), client)
+                continue
+            # Клиент отправляет сообщения только от своего имени и только после входа. Имя отправителя в самом
+            # сообщении сверяется с заголовком маршрута при разборе.
+            if client.peer is None and route[1] != client.name:
+                self.reject_sender(client, route[1])
+                continue
+            message = {ACTION: MESSAGE, DESTINATION: route[0], SENDER: route[1],
+                       RAW_FRAME: frame, RAW_CODEC: decoder.codec}
+            if client.peer is not None:
+                message[FORWARDED] = True
+            if not self.forwards_raw(route[0], decoder.codec, client.peer is not None):
+                try:
+                    decoded = self.check_routed(decoder.codec.decode(frame_body(frame)), route)
+                except DECODE_ERRORS:
+                    # Клиент, приславший некорректное сообщение, отключается. Канал связи из-за одного сообщения
+                    # не разрывается: сообщение отбрасывается.
+                    if client.peer is None:
+                        raise
+                    self.messages_dropped.inc()
+                    logger.error(f'Некорректное сообщение для {route[0]} от {client.peer} отброшено.')
+                    continue
+                # Сообщение от другого обработчика остаётся кадром с признаком пересылки, служебный ключ
+                # не должен попасть в само сообщение.
+                if client.peer is None:
+                    message = decoded
+            self.messages.append(message)
+
+    # Функция отклоняет сообщение, отправитель которого не совпадает с пользователем подключения (или клиент
+    # ещё не вошёл): сообщение не пересылается, клиенту отправляется ответ с ошибкой.
+    def reject_sender(self, client, sender):
+        self.messages_dropped.inc()
+        logger.warning(f'Клиент {client} отправил сообщение от имени {sender}, сообщение отклонено.')
+        response = RESPONSE_400
+        response[ERROR] = 'Отправитель не совпадает с пользователем подключения.'
+        self.send_to(client, response)
+
+    # Функция проверки, можно ли передать кадр сообщения пользователю destination без разбора: получатель
+    # в режиме с кадрированием с тем же кодеком подключен к этому серверу или к обработчику (узлу), которому кадр
+    # будет передан по каналу связи. Порядок проверок тот же, что и при отправке сообщения в process_message.
+    def forwards_raw(self, destination, codec, forwarded):
+        client = self.registry.find(destination)
+        if client is None:
+            route = self.routes.get(destination)
+            if forwarded or destination in self.detached or route is None:
+                return False
+            client = self.peer_links.get(route[0])
+        return client is not None and client.decoder is not None and client.decoder.codec is codec
+
+    # Функция проверки декодированного сообщения пользователю: сообщение должно быть корректным и совпадать
+    # с заголовком маршрута кадра. Возвращает сообщение.
+    def check_routed(self, message, route):
+        if not is_user_message(message) or message[DESTINATION] != route[0] or message[SENDER] != route[1]:
+            raise IncorrectDataRecivedError
+        return message
+
+    # Функция отправки сообщения клиенту в согласованном с ним режиме. Исходный кадр пересылается без изменений,
+    # если получатель использует тот же кодек, иначе сообщение декодируется и кодируется заново.
+    # Данные ставятся в буфер клиента и отправляются при готовности сокета к записи.
+    def send_to(self, client, message):
+        # Отправитель сообщения пользователю - источник нагрузки на буфер, для ответов - сам клиент.
+        sender = self.registry.find(message[SENDER]) if SENDER in message else client
+        codec = client.decoder.codec if client.decoder else None
+        if RAW_FRAME in message:
+            if codec is message[RAW_CODEC]:
+                self.queue_data(client, message[RAW_FRAME], sender)
+                return
+            message = self.decode_routed(message)
+        self.queue_data(client, encode_message(message, codec), sender)
+
+    # Функция возвращает словарь сообщения, декодируя исходный кадр, если сообщение пересылалось без разбора.
+    def decode_routed(self, message):
+        if RAW_FRAME in message:
+            return message[RAW_CODEC].decode(frame_body(message[RAW_FRAME]))
+        return message
+
+    # Функция начинает доставку сообщений, сохранённых для пользователя, пока он был не в сети. Сообщения
+    # отправляются в порядке поступления по мере освобождения буфера клиента (см. feed_stored). Новые сообщения
+    # пользователю до окончания доставки сохраняются в БД следом за ними.
+    def deliver_stored(self, name, client):
+        self.stored_delivery[name] = []
+        self.feed_stored(name, client)
+
+    # Функция удаляет из БД сохранённые сообщения, уже отправленные клиенту из буфера, и ставит в буфер следующие,
+    # пока он не заполнится до OUTBOUND_HIGH_WATER. Если сообщений больше нет, доставка завершается. Если клиент
+    # отключится раньше, чем буфер будет отправлен, сообщения остаются в БД и доставляются при следующем входе.
+    def feed_stored(self, name, client):
+        delivered = self.stored_delivery[name]
+        if delivered:
+            self.database.delete_stored_messages(name, delivered)
+            logger.info(f'Пользователю {name} доставлено сохранённых сообщений: {len(delivered)}.')
+        batches = self.database.stored_messages(name)
+        batch = next(batches, None)
+        batches.close()
+        if not batch:
+            del self.stored_delivery[name]
+            return
+        codec = client.decoder.codec if client.decoder else None
+        queued = self.stored_delivery[name] = []
+        for message_id, message in batch:
+            if client.outbound is not None and client.outbound.size >= OUTBOUND_HIGH_WATER:
+                break
+            self.queue_data(client, encode_message(message, codec))
+            queued.append(message_id)
+
+    # Функция доставки сообщений, отложенных для сессии пользователя. Пока не доставлены сохранённые в БД
+    # сообщения, отложенные сохраняются следом за ними.
+    def deliver_held(self, client, messages):
+        if client.name in self.stored_delivery \
+                and self.database.store_messages(client.name, [self.decode_routed(message) for message in messages]):
+            return
+        for message in messages:
+            self.send_to(client, message)
+
+    # Функция исключает клиента из списка подключённых, удаляет сопоставленное ему имя и закрывает сокет.
+    # Перед закрытием делается попытка отправить то, что осталось в буфере клиента (например, ответ с ошибкой).
+    # Сессия, которую можно восстановить по токену, сохраняется до истечения RESUME_GRACE_PERIOD. Если пользователь
+    # уже вошёл на другом обработчике (обрыв замечен позже, чем пришло его сообщение о входе), сессия не сохраняется.
+    def remove_client(self, client):
+        if client.peer is not None:
+            self.remove_link(client)
+        if client.resume is not None and not self.routes.get(client.name, (None, False))[1]:
+            client.resume.detached = time.monotonic()
+            self.detached[client.name] = client.resume
+            client.resume = None
+            self.announce(client.name, DETACHED)
+        self.registry.remove(client)
+        if client.name is not None and client.name not in self.detached and self.registry.find(client.name) is None:
+            self.stored_delivery.pop(client.name, None)
+            self.announce(client.name, OFFLINE)
+        self.timers.cancel(client)
+        buffer, client.outbound = client.outbound, None
+        if buffer is not None:
             try:
-                if self.clients:
-                    recv_data_lst, send_data_lst, err_lst = select.select(self.clients, self.clients, [], 0)
+                buffer.flush(client.sock)
             except OSError:
                 pass
+        self.pending.discard(client)
+        self.paused.discard(client)
+        for sender in self.blocked_by.pop(client, ()):
+            self.resume_reading(sender)
+        client.sock.close()
 
-            # принимаем сообщения и если ошибка, исключаем клиента.
-            if recv_data_lst:
-                for client_with_message in recv_data_lst:
-                    try:
-                        self.process_client_message(get_message(client_with_message), client_with_message)
-                    except:
-                        logger.info(f'Клиент {client_with_message.getpeername()} отключился от сервера.')
-                        self.clients.remove(client_with_message)
+    # Функция откладывает сообщения для отключившегося клиента, который ещё может восстановить сессию.
+    # Возвращает False, если такой сессии нет.
+    def hold_messages(self, name, messages):
+        state = self.detached.get(name)
+        if state is None:
+            return False
+        state.held.extend(messages)
+        return True
 
-            # Если есть сообщения, обрабатываем каждое.
-            for message in self.messages:
-                try:
-                    self.process_message(message, send_data_lst)
-                except:
-                    logger.info(f'Связь с клиентом с именем {message[DESTINATION]} была потеряна')
-                    self.clients.remove(self.names[message[DESTINATION]])
-                    del self.names[message[DESTINATION]]
-            self.messages.clear()
+    # Функция завершает сессии, не восстановленные за RESUME_GRACE_PERIOD: отложенные сообщения сохраняются
+    # в БД для доставки при следующем входе, пользователь отмечается вышедшим.
+    def expire_sessions(self):
+        now = time.monotonic()
+        while self.detached:
+            state = next(iter(self.detached.values()))
+            if now - state.detached < RESUME_GRACE_PERIOD:
+                break
+            self.end_session(state.name)
+            self.announce(state.name, OFFLINE)
+            logger.info(f'Истекло время восстановления сессии пользователя {state.name}.')
+            if state.held:
+                self.database.store_messages(state.name, [self.decode_routed(message) for message in state.held])
+            self.database.user_logout(state.name)
+
+    # Функция проверки подключений, таймеры простоя которых сработали. Если от клиента за это время были данные,
+    # таймер переносится, иначе клиенту отправляется ping. Клиент, не ответивший на ping за HEARTBEAT_TIMEOUT,
+    # отключается без возможности восстановить сессию, пользователь отмечается вышедшим. За такт просматриваются
+    # только сработавшие таймеры, а не все подключения. Ping поддерживают только клиенты в режиме с кадрированием
+    # (и каналы связи): клиенты прежних версий на него не отвечают, поэтому их простой не проверяется.
+    def check_heartbeats(self):
+        now = time.monotonic()
+        for client in self.timers.advance(now):
+            # Подключение без приветствия ещё может согласовать кадрирование, вошедший клиент без него - уже нет.
+            if client.decoder is None:
+                if client.name is None:
+                    self.timers.schedule(client, HEARTBEAT_INTERVAL)
+                continue
+            # Любые данные от клиента после ping, в том числе ответ на него, означают, что соединение живо.
+            if client.pinged is not None and client.active > client.pinged:
+                client.pinged = None
+            idle = now - client.active
+            # Чтение от приостановленного клиента остановлено сервером, его простой не проверяем.
+            if client in self.paused:
+                client.pinged = None
+                self.timers.schedule(client, HEARTBEAT_INTERVAL)
+            elif client.pinged is None and idle < HEARTBEAT_INTERVAL:
+                self.timers.schedule(client, HEARTBEAT_INTERVAL - idle)
+            elif client.pinged is None:
+                client.pinged = now
+                self.send_to(client, {ACTION: PING, TIME: time.time()})
+                self.timers.schedule(client, HEARTBEAT_TIMEOUT)
+            else:
+                logger.info(f'Клиент {client} не ответил на ping и будет отключён.')
+                self.sessions_evicted.inc()
+                if client.name is not None:
+                    self.end_session(client.name)
+                    self.database.user_logout(client.name)
+                self.remove_client(client)
+        self.flush_pending()
+
+    # Функция удаляет сессию пользователя, возвращает её состояние или None.
+    def end_session(self, name):
+        self.stored_delivery.pop(name, None)
+        state = self.detached.pop(name, None)
+        client = self.registry.find(name)
+        if client is not None and client.resume is not None:
+            state, client.resume = client.resume, None
+        return state
+
+    # Функция восстановления сессии по токену из сообщения о присутствии. Сокет прежнего подключения, если сервер
+    # ещё не заметил его обрыв, закрывается, клиенту повторно отправляются кадры после полученного им последним
+    # и сообщения, пришедшие, пока он был отключён. Записи в БД не выполняются. Возвращает False, если сессию
+    # восстановить нельзя.
+    def resume_session(self, name, message, client):
+        stale = self.registry.find(name)
+        state = stale.resume if stale is not None else self.detached.get(name)
+        if state is None or message.get(FRAMING) != FRAMING_LENGTH_PREFIX \
+                or not secrets.compare_digest(state.token, str(message[RESUME_TOKEN])):
+            return False
+        last_seq = message.get(LAST_SEQ, 0)
+        chunks = state.replay(last_seq) if isinstance(last_seq, int) else None
+        if chunks is None:
+            return False
+        if (state.log[0][0] if state.log else state.seq + 1) > last_seq + 1:
+            logger.warning(f'Часть кадров сессии пользователя {name} уже не хранится и не будет отправлена повторно.')
+
+        if stale is not None:
+            stale.resume = None
+            logger.info(f'Соединение пользователя {name} заменено новым.')
+            # Доставка сохранённых сообщений продолжается в новом соединении.
+            delivery = self.stored_delivery.pop(name, None)
+            self.remove_client(stale)
+            if delivery is not None:
+                self.stored_delivery[name] = delivery
+        self.detached.pop(name, None)
+        state.detached = None
+        self.bind_client(client, name)
 
-    # Функция адресной отправки сообщения определённому клиенту. Принимает словарь сообщение, список зарегистрированых
-    # пользователей и слушающие сокеты. Ничего не возвращает.
-    def process_message(self, message, listen_socks):
-        if message[DESTINATION] in self.names and self.names[message[DESTINATION]] in listen_socks:
-            send_message(self.names[message[DESTINATION]], message)
+        # Ответ и повторно отправляемые кадры не нумеруются, клиент продолжает счёт с last_seq.
+        client.decoder = FrameDecoder()
+        self.send_to(client, {RESPONSE: 200, FRAMING: FRAMING_LENGTH_PREFIX, CODEC: state.codec.name,
+                              RESUME_TOKEN: state.token})
+        client.decoder.codec = state.codec
+        for data in chunks:
+            self.queue_data(client, data)
+        client.resume = state
+        held, state.held = state.held, []
+        self.deliver_held(client, held)
+        logger.info(f'Восстановлена сессия пользователя {name}, повторно отправлено кадров: {state.seq - last_seq}, '
+                    f'отложенных сообщений: {len(held)}.')
+        return True
+
+    # Функция назначает подключению имя пользователя и сообщает другим обработчикам, что пользователь в сети.
+    def bind_client(self, client, name):
+        self.registry.bind(client, name)
+        self.routes.pop(name, None)
+        self.announce(name, ONLINE)
+
+    # Функция рассылки изменения состояния пользователя этого обработчика: его контактам (вход и выход)
+    # и другим обработчикам.
+    def announce(self, name, status):
+        self.update_presence(name, status)
+        if not self.peer_links:
+            return
+        data = encode_message({ACTION: ROUTE, ACCOUNT_NAME: name, STATUS: status}, CODECS[CODEC_BINARY])
+        for link in self.peer_links.values():
+            self.queue_data(link, data)
+
+    # Функция учёта пользователей в сети. Пользователь, ожидающий восстановления сессии, остаётся в сети, поэтому
+    # обрыв и восстановление соединения контактам не видны. Выход не сообщается, если пользователь уже вошёл
+    # на другом обработчике.
+    def update_presence(self, name, status):
+        if status == ONLINE:
+            try:
+                address = self.registry.find(name).sock.getpeername()[:2]
+            except (AttributeError, OSError):
+                address = (None, None)
+            if name not in self.presence:
+                self.notify_presence(name, ONLINE)
+            self.presence[name] = address + (datetime.datetime.now(),)
+        elif status == OFFLINE and self.presence.pop(name, None) is not None and name not in self.routes:
+            self.notify_presence(name, OFFLINE)
+
+    # Функция ставит изменение состояния пользователя в уведомления подключенных к этому обработчику
+    # пользователей, у которых он в контактах. Уведомления получают только клиенты в режиме с кадрированием.
+    def notify_presence(self, name, status):
+        for watcher in self.database.contact_watchers(name):
+            client = self.registry.find(watcher)
+            if client is None or client.decoder is None:
+                continue
+            updates = self.presence_updates.get(watcher)
+            if updates is None:
+                updates = self.presence_updates[watcher] = dict()
+                if watcher not in self.presence_sent:
+                    self.presence_ready.append(watcher)
+            updates[name] = status
+
+    # Функция отправки накопленных уведомлений о контактах. Все изменения для получателя отправляются одним
+    # сообщением, повторно - не раньше чем через PRESENCE_INTERVAL, так что массовое переподключение
+    # пользователей даёт каждому получателю не больше одного уведомления за интервал.
+    def flush_presence(self):
+        now = time.monotonic()
+        while self.presence_waiting and self.presence_waiting[0][0] <= now:
+            watcher = self.presence_waiting.popleft()[1]
+            del self.presence_sent[watcher]
+            if watcher in self.presence_updates:
+                self.presence_ready.append(watcher)
+        if not self.presence_ready:
+            return
+        ready, self.presence_ready = self.presence_ready, []
+        for watcher in ready:
+            updates = self.presence_updates.pop(watcher, None)
+            client = self.registry.find(watcher)
+            if not updates or client is None:
+                continue
+            self.send_to(client, {ACTION: PRESENCE_UPDATE, TIME: time.time(), CONTACTS: [
+                {ACCOUNT_NAME: name, STATUS: status} for name, status in updates.items()]})
+            self.presence_sent[watcher] = now
+            self.presence_waiting.append((now + PRESENCE_INTERVAL, watcher))
+
+    # Функция проверки, в сети ли пользователь: на этом обработчике или, по таблице маршрутизации, на другом.
+    def is_online(self, name):
+        return name in self.presence or name in self.routes
+
+    # Список пользователей этого обработчика в сети для консоли сервера: (имя, адрес, порт, время входа).
+    def connected_users(self):
+        return sorted((name,) + info for name, info in list(self.presence.items()))
+
+    # Функция передачи сообщения другому обработчику. Возвращает False, если канала связи с ним нет.
+    def send_to_worker(self, worker, message, sender=None):
+        link = self.peer_links.get(worker)
+        if link is None:
+            return False
+        self.queue_data(link, encode_message(message, link.decoder.codec), sender)
+        return True
+
+    # Функция передачи сообщения пользователю, подключенному к другому обработчику. Кадр сообщения передаётся
+    # без перекодирования, если он в кодеке канала связи. Сообщение, уже полученное от другого обработчика,
+    # повторно не пересылается. Возвращает False, если пользователя нет в таблице маршрутизации.
+    def forward_message(self, message):
+        route = self.routes.get(message[DESTINATION])
+        if FORWARDED in message or route is None or route[0] not in self.peer_links:
+            return False
+        link = self.peer_links[route[0]]
+        sender = self.registry.find(message[SENDER])
+        if RAW_FRAME in message and message[RAW_CODEC] is link.decoder.codec:
+            self.queue_data(link, message[RAW_FRAME], sender)
+        else:
+            self.queue_data(link, encode_message(self.decode_routed(message), link.decoder.codec), sender)
+        self.messages_forwarded.inc()
+        return True
+
+    # Функция обработки потери канала связи с другим обработчиком или узлом: его пользователи удаляются из таблицы
+    # маршрутизации, сообщения для них будут сохраняться в БД. Если между узлами два канала (каждый подключился
+    # к другому), потеря старого канала таблицу не затрагивает.
+    def remove_link(self, link):
+        if self.peer_links.get(link.peer) is not link:
+            return
+        # Если по каналу ничего не было получено, соединение не было установлено.
+        if link.active > link.connected:
+            logger.critical(f'Потерян канал связи с {link.peer}.')
+        else:
+            logger.info(f'Нет связи с {link.peer}.')
+        del self.peer_links[link.peer]
+        for name in [name for name, route in self.routes.items() if route[0] == link.peer]:
+            del self.routes[name]
+            if name not in self.presence:
+                self.notify_presence(name, OFFLINE)
+
+    # Обработчик сообщений от других процессов-обработчиков и узлов: изменения таблицы маршрутизации, пакеты
+    # и сообщения групп для пользователей этого обработчика, изменения состава групп (уже записанные в БД).
+    # Обработчику архива другие обработчики передают сообщения для архива и запросы истории и поиска своих
+    # пользователей, ответы он возвращает им.
+    def process_peer_message(self, message, link):
+        action = message.get(ACTION)
+        if action == ROUTE:
+            name, worker, status = message[ACCOUNT_NAME], link.peer, message[STATUS]
+            if status == OFFLINE:
+                if self.routes.get(name, (None,))[0] == worker:
+                    del self.routes[name]
+                    if name not in self.presence:
+                        self.notify_presence(name, OFFLINE)
+                return
+            if name not in self.routes and name not in self.presence:
+                self.notify_presence(name, ONLINE)
+            self.routes[name] = (worker, status == ONLINE)
+            # Пользователь вошёл на другом обработчике, пока его сессия здесь ожидала восстановления: сессия
+            # завершается, отложенные сообщения передаются туда.
+            if status == ONLINE and name in self.detached and self.registry.find(name) is None:
+                state = self.end_session(name)
+                self.announce(name, OFFLINE)
+                for held_message in state.held:
+                    held_message.pop(FORWARDED, None)
+                    self.process_message(held_message)
+                logger.info(f'Сессия пользователя {name} продолжена на {worker}.')
+        elif action == BATCH:
+            self.process_batch(message[MESSAGES], forwarded=True)
+        elif action == ARCHIVE and self.archive is not None:
+            for archived in message[MESSAGES]:
+                self.archive_message(archived)
+        elif action == HISTORY and self.archive is not None:
+            self.send_to(link, dict(self.history_response(message), **{ACTION: REPLY,
+                                                                      ACCOUNT_NAME: message[ACCOUNT_NAME]}))
+        elif action == SEARCH and self.search is not None:
+            self.start_search(link, message[ACCOUNT_NAME], message[QUERY], message[LIMIT], message[OFFSET])
+        elif action == REPLY:
+            client = self.registry.find(message.pop(ACCOUNT_NAME))
+            del message[ACTION]
+            if client is not None:
+                self.send_to(client, message)
+        elif action == GROUP_MESSAGE:
+            members = self.database.group_members(message[GROUP])
+            if members is not None:
+                self.send_to_group(members, message, forwarded=True)
+        elif action == CREATE_GROUP:
+            self.database.create_group(message[GROUP], message[ACCOUNT_NAME], persist=False)
+        elif action == JOIN_GROUP:
+            self.database.join_group(message[GROUP], message[ACCOUNT_NAME], persist=False)
+        elif action == LEAVE_GROUP:
+            self.database.leave_group(message[GROUP], message[ACCOUNT_NAME], persist=False)
+        elif action == ADD_CONTACT:
+            self.database.add_contact(message[ACCOUNT_NAME], message[USER], persist=False)
+        elif action == REMOVE_CONTACT:
+            self.database.remove_contact(message[ACCOUNT_NAME], message[USER], persist=False)
+        elif action == PING:
+            self.send_to(link, {ACTION: PONG, TIME: time.time()})
+        elif action in (PONG, PEER):
+            return
+        else:
+            logger.error(f'Некорректное сообщение от {link.peer}: {message}')
+
+    # Функция адресной отправки сообщения определённому клиенту. Принимает словарь сообщение, ставит его в буфер
+    # получателя. Возвращает False, если сообщение отброшено.
+    def process_message(self, message):
+        client = self.registry.find(message[DESTINATION])
+        # Пока пользователю доставляются сохранённые сообщения, новое сохраняется следом за ними, чтобы не обогнать их.
+        if client is not None and message[DESTINATION] in self.stored_delivery \
+                and self.database.store_message(message[DESTINATION], self.decode_routed(message)):
+            self.messages_stored.inc()
+            logger.info(f'Сообщение для пользователя {message[DESTINATION]} сохранено до доставки сохранённых ранее.')
+        elif client is not None:
+            self.send_to(client, message)
+            self.messages_routed.inc()
             logger.info(f'Отправлено сообщение пользователю {message[DESTINATION]} от пользователя {message[SENDER]}.')
-        elif message[DESTINATION] in self.names and self.names[message[DESTINATION]] not in listen_socks:
-            raise ConnectionError
+        # Если пользователь может восстановить сессию, откладываем сообщение до его подключения. Отложенное
+        # сообщение декодируется сразу, чтобы некорректный кадр не помешал восстановлению сессии.
+        elif message[DESTINATION] in self.detached \
+                and self.hold_messages(message[DESTINATION], [self.decode_routed(message)]):
+            logger.info(f'Сообщение для пользователя {message[DESTINATION]} отложено до восстановления сессии.')
+        # Если пользователь подключен к другому обработчику, передаём сообщение ему.
+        elif self.forward_message(message):
+            logger.info(f'Сообщение для пользователя {message[DESTINATION]} передано на '
+                        f'{self.routes[message[DESTINATION]][0]}.')
+        # Если пользователь известен, но не в сети, сохраняем сообщение до его входа.
+        elif self.database.store_message(message[DESTINATION], self.decode_routed(message)):
+            self.messages_stored.inc()
+            logger.info(f'Пользователь {message[DESTINATION]} не в сети, сообщение от пользователя '
+                        f'{message[SENDER]} сохранено для доставки.')
         else:
+            self.messages_dropped.inc()
             logger.error(
                 f'Пользователь {message[DESTINATION]} не зарегистрирован на сервере, отправка сообщения невозможна.')
+            return False
+        return True
+
+    # Функция рассылки сообщения группы участникам в сети, кроме отправителя. Сообщение кодируется один раз для
+    # каждого используемого получателями кодека, всем получателям ставятся в буфер одни и те же байты.
+    # Обработчикам, к которым подключены другие участники, сообщение передаётся один раз, если оно не пришло
+    # от другого обработчика (forwarded).
+    def send_to_group(self, members, message, forwarded=False):
+        sender = self.registry.find(message[SENDER])
+        encoded = dict()
+        workers = set()
+        count = 0
+        for member in members:
+            client = self.registry.find(member)
+            if client is None:
+                if not forwarded and member in self.routes:
+                    workers.add(self.routes[member][0])
+                continue
+            if client is sender:
+                continue
+            codec = client.decoder.codec if client.decoder else None
+            data = encoded.get(codec)
+            if data is None:
+                data = encoded[codec] = encode_message(message, codec)
+            self.queue_data(client, data, sender)
+            count += 1
+        for worker in workers:
+            self.send_to_worker(worker, message, sender)
+        self.messages_routed.inc(count)
+        logger.info(f'Сообщение группе {message[GROUP]} от пользователя {message[SENDER]} '
+                    f'отправлено участникам в сети: {count}.')
+
+    # Функция обработки пакета сообщений. Пакет принимается, только если все его элементы - корректные сообщения
+    # пользователям (от пользователя sender, если он задан), иначе возвращается False. Сообщения группируются
+    # по получателям: получателю в сети в буфер ставится один блок со всеми его сообщениями, для получателя
+    # не в сети они сохраняются одной транзакцией.
+    # Сообщения для пользователей других обработчиков передаются каждому обработчику одним пакетом, если пакет
+    # не пришёл от другого обработчика (forwarded). Принятые сообщения записываются в архив.
+    def process_batch(self, messages, forwarded=False, sender=None):
+        if not isinstance(messages, list) or not 0 < len(messages) <= MAX_BATCH_SIZE:
+            return False
+        by_destination = dict()
+        for message in messages:
+            if not is_user_message(message) or sender is not None and message[SENDER] != sender:
+                return False
+            by_destination.setdefault(message[DESTINATION], []).append(message)
+
+        remote = dict()
+        for destination, batch in by_destination.items():
+            client = self.registry.find(destination)
+            if client is not None and destination in self.stored_delivery \
+                    and self.database.store_messages(destination, batch):
+                self.messages_stored.inc(len(batch))
+            elif client is not None:
+                sender = self.registry.find(batch[0][SENDER])
+                # Без кадрирования получатель не сможет разделить сообщения, пришедшие одним блоком.
+                if client.decoder is None:
+                    for message in batch:
+                        self.queue_data(client, encode_message(message), sender)
+                else:
+                    codec = client.decoder.codec
+                    self.queue_data(client, b''.join(encode_message(message, codec) for message in batch),
+                                    sender, len(batch))
+                self.messages_routed.inc(len(batch))
+            elif self.hold_messages(destination, batch):
+                pass
+            elif not forwarded and destination in self.routes and self.routes[destination][0] in self.peer_links:
+                remote.setdefault(self.routes[destination][0], []).extend(batch)
+            elif self.database.store_messages(destination, batch):
+                self.messages_stored.inc(len(batch))
+            else:
+                self.messages_dropped.inc(len(batch))
+                logger.error(f'Пользователь {destination} не зарегистрирован на сервере, '
+                             f'отправка {len(batch)} сообщений невозможна.')
+                continue
+            for message in batch:
+                self.archive_message(message, forwarded)
+        for worker, batch in remote.items():
+            self.send_to_worker(worker, {ACTION: BATCH, TIME: time.time(), MESSAGES: batch},
+                                self.registry.find(batch[0][SENDER]))
+            self.messages_forwarded.inc(len(batch))
+        logger.info(f'Обработан пакет из {len(messages)} сообщений для {len(by_destination)} получателей.')
+        return True
 
     # Обработчик сообщений от клиентов, принимает словарь - сообщение от клиента, проверяет корректность, отправляет
     #     словарь-ответ в случае необходимости.
     def process_client_message(self, message, client):
         logger.debug(f'Разбор сообщения от клиента : {message}')
+        if client.peer is not None:
+            self.process_peer_message(message, client)
+            return
+        # Если это приветствие соседнего узла, подключение становится каналом связи с ним. Узлы без общего ключа
+        # (и обработчики в режиме нескольких процессов) подключений узлов не принимают.
+        if ACTION in message and message[ACTION] == PEER and NODE in message and client.name is None \
+                and client.decoder is not None:
+            if self.peer_key is None or self.worker is not None \
+                    or not secrets.compare_digest(str(message.get(PEER_KEY)), self.peer_key):
+                logger.warning(f'Отклонено подключение узла {message[NODE]}.')
+                self.remove_client(client)
+                return
+            self.add_link(client, str(message[NODE]))
+            self.sync_routes(client)
+            logger.info(f'Подключен узел {client.peer}.')
+            return
         # Если это сообщение о присутствии, принимаем и отвечаем
         if ACTION in message and message[ACTION] == PRESENCE and TIME in message and USER in message:
-            # Если такой пользователь ещё не зарегистрирован, регистрируем, иначе отправляем ответ и завершаем соединение.
-            if message[USER][ACCOUNT_NAME] not in self.names.keys():
-                self.names[message[USER][ACCOUNT_NAME]] = client
-                client_ip, client_port = client.getpeername()
+            # Если клиент предъявил действующий токен, восстанавливаем его сессию без входа через БД.
+            if RESUME_TOKEN in message and self.resume_session(message[USER][ACCOUNT_NAME], message, client):
+                return
+            # Если такой пользователь ещё не зарегистрирован (ни на этом, ни на другом обработчике), регистрируем,
+            # иначе отправляем ответ и завершаем соединение.
+            if self.registry.find(message[USER][ACCOUNT_NAME]) is None \
+                    and not self.routes.get(message[USER][ACCOUNT_NAME], (None, False))[1]:
+                # Прежняя сессия пользователя, если она ещё не истекла, заменяется новой.
+                state = self.end_session(message[USER][ACCOUNT_NAME])
+                self.bind_client(client, message[USER][ACCOUNT_NAME])
+                client_ip, client_port = client.sock.getpeername()
                 self.database.user_login(message[USER][ACCOUNT_NAME], client_ip, client_port)
-                send_message(client, RESPONSE_200)
+                # Если клиент предложил режим с префиксом длинны, подтверждаем его. Ответ уже отправляется кадром,
+                # чтобы следующие за ним сообщения не смешались с ответом при чтении.
+                if message.get(FRAMING) == FRAMING_LENGTH_PREFIX:
+                    decoder = client.decoder = FrameDecoder()
+                    response = {RESPONSE: 200, FRAMING: FRAMING_LENGTH_PREFIX}
+                    # Ответ всегда в JSON, на предложенный клиентом кодек переходим после него.
+                    if message.get(CODEC) in CODECS:
+                        response[CODEC] = message[CODEC]
+                    # Клиенту в режиме с кадрированием выдаём токен для восстановления сессии.
+                    response[RESUME_TOKEN] = secrets.token_hex(16)
+                    self.send_to(client, response)
+                    decoder.codec = CODECS[response.get(CODEC, CODEC_JSON)]
+                    client.resume = ResumeState(message[USER][ACCOUNT_NAME], response[RESUME_TOKEN], decoder.codec)
+                else:
+                    self.send_to(client, RESPONSE_200)
+                # Доставляем сообщения, накопленные, пока пользователь был не в сети.
+                self.deliver_stored(message[USER][ACCOUNT_NAME], client)
+                if state is not None and state.held:
+                    self.deliver_held(client, state.held)
             else:
                 response = RESPONSE_400
                 response[ERROR] = 'Имя пользователя уже занято.'
-                send_message(client, response)
-                self.clients.remove(client)
-                client.close()
+                self.send_to(client, response)
+                self.remove_client(client)
+            return
+        # Если это проверка соединения, отвечаем. Ответ клиента на ping сервера уже учтён как данные от клиента.
+        # Клиент в режиме с кадрированием сообщает в них номер последнего полученного кадра.
+        elif ACTION in message and message[ACTION] == PING:
+            if client.resume is not None:
+                client.resume.acknowledge(message.get(LAST_SEQ))
+            self.send_to(client, {ACTION: PONG, TIME: time.time()})
+            return
+        elif ACTION in message and message[ACTION] == PONG:
+            if client.resume is not None:
+                client.resume.acknowledge(message.get(LAST_SEQ))
             return
         # Если это сообщение, то добавляем его в очередь сообщений. Ответ не требуется.
-        elif ACTION in message and message[ACTION] == MESSAGE and DESTINATION in message and TIME in message \
-                and SENDER in message and MESSAGE_TEXT in message:
+        elif is_user_message(message):
+            if message[SENDER] != client.name:
+                self.reject_sender(client, message[SENDER])
+                return
             self.messages.append(message)
             return
+        # Если это пакет сообщений, проверяем его и рассылаем сообщения адресатам. Ответ требуется только при ошибке.
+        elif ACTION in message and message[ACTION] == BATCH and TIME in message and MESSAGES in message:
+            if client.name is None:
+                self.reject_sender(client, None)
+                return
+            if not self.process_batch(message[MESSAGES], sender=client.name):
+                response = RESPONSE_400
+                response[ERROR] = 'Пакет сообщений некорректен.'
+                self.send_to(client, response)
+            return
+        # Если это сообщение группе, рассылаем его участникам. Ответ требуется только при ошибке.
+        elif ACTION in message and message[ACTION] == GROUP_MESSAGE and GROUP in message and TIME in message \
+                and SENDER in message and MESSAGE_TEXT in message:
+            if message[SENDER] != client.name:
+                self.reject_sender(client, message[SENDER])
+                return
+            members = self.database.group_members(message[GROUP])
+            if members is None or message[SENDER] not in members:
+                response = RESPONSE_400
+                response[ERROR] = 'Отправитель не состоит в группе.'
+                self.send_to(client, response)
+                return
+            self.send_to_group(members, message)
+            return
+        # Если это создание группы, вступление в неё или выход, изменяем состав группы и отвечаем
+        elif ACTION in message and message[ACTION] in (CREATE_GROUP, JOIN_GROUP, LEAVE_GROUP) \
+                and GROUP in message and ACCOUNT_NAME in message and client.name == message[ACCOUNT_NAME]:
+            if message[ACTION] == CREATE_GROUP:
+                done = self.database.create_group(message[GROUP], message[ACCOUNT_NAME])
+                error = 'Группа с таким именем уже существует.'
+            elif message[ACTION] == JOIN_GROUP:
+                done = self.database.join_group(message[GROUP], message[ACCOUNT_NAME])
+                error = 'Группа не найдена.'
+            else:
+                done = self.database.leave_group(message[GROUP], message[ACCOUNT_NAME])
+                error = 'Пользователь не состоит в группе.'
+            if done:
+                self.send_to(client, RESPONSE_200)
+                # Другие обработчики обновляют свой кэш состава групп.
+                for worker in self.peer_links:
+                    self.send_to_worker(worker, message)
+            else:
+                response = RESPONSE_400
+                response[ERROR] = error
+                self.send_to(client, response)
+            return
+        # Если это запрос списка контактов, отвечаем контактами с их состоянием. Список может быть больше
+        # MAX_PACKAGE_LENGTH, поэтому выдаётся только в режиме с кадрированием.
+        elif ACTION in message and message[ACTION] == GET_CONTACTS and ACCOUNT_NAME in message \
+                and client.name == message[ACCOUNT_NAME]:
+            if client.decoder is None:
+                response = RESPONSE_400
+                response[ERROR] = 'Список контактов доступен только в режиме с кадрированием.'
+                self.send_to(client, response)
+                return
+            self.send_to(client, {RESPONSE: 202, CONTACTS: [
+                {ACCOUNT_NAME: name, STATUS: ONLINE if self.is_online(name) else OFFLINE}
+                for name in sorted(self.database.get_contacts(client.name))]})
+            return
+        # Если это добавление или удаление контакта, изменяем список контактов и отвечаем
+        elif ACTION in message and message[ACTION] in (ADD_CONTACT, REMOVE_CONTACT) and ACCOUNT_NAME in message \
+                and USER in message and client.name == message[ACCOUNT_NAME]:
+            if message[ACTION] == ADD_CONTACT:
+                done = self.database.add_contact(message[ACCOUNT_NAME], str(message[USER]))
+                error = 'Пользователь не найден.'
+            else:
+                done = self.database.remove_contact(message[ACCOUNT_NAME], str(message[USER]))
+                error = 'Пользователя нет в контактах.'
+            if done:
+                self.send_to(client, RESPONSE_200)
+                # Другие обработчики обновляют свой кэш контактов.
+                for worker in self.peer_links:
+                    self.send_to_worker(worker, {ACTION: message[ACTION], TIME: message.get(TIME, time.time()),
+                                                 ACCOUNT_NAME: message[ACCOUNT_NAME], USER: str(message[USER])})
+            else:
+                response = RESPONSE_400
+                response[ERROR] = error
+                self.send_to(client, response)
+            return
+        # Если это запрос истории переписки, отвечаем последними сообщениями с собеседником из архива. Ответ может
+        # быть больше MAX_PACKAGE_LENGTH, поэтому история выдаётся только в режиме с кадрированием. Если архив ведёт
+        # другой обработчик, запрос передаётся ему, ответ придёт от него.
+        elif ACTION in message and message[ACTION] == HISTORY and ACCOUNT_NAME in message and USER in message \
+                and COUNT in message and client.name == message[ACCOUNT_NAME]:
+            if self.archive is None and self.archive_worker is None or client.decoder is None \
+                    or not isinstance(message[COUNT], int) \
+                    or not isinstance(message.get(BEFORE), (int, float, type(None))) \
+                    or self.archive is None and not self.send_to_worker(self.archive_worker, message):
+                response = RESPONSE_400
+                response[ERROR] = 'История переписки недоступна.'
+                self.send_to(client, response)
+                return
+            if self.archive is not None:
+                self.send_to(client, self.history_response(message))
+            return
+        # Если это поисковый запрос, ищем в потоке поиска и отвечаем найденными сообщениями переписки пользователя,
+        # от новых к старым. Если архив ведёт другой обработчик, запрос передаётся ему.
+        elif ACTION in message and message[ACTION] == SEARCH and ACCOUNT_NAME in message and QUERY in message \
+                and client.name == message[ACCOUNT_NAME]:
+            limit = message.get(LIMIT, SEARCH_MAX_RESULTS)
+            offset = message.get(OFFSET, 0)
+            if self.search is None and self.archive_worker is None or client.decoder is None \
+                    or not isinstance(limit, int) or not isinstance(offset, int):
+                response = RESPONSE_400
+                response[ERROR] = 'Поиск недоступен.'
+                self.send_to(client, response)
+                return
+            limit, offset = max(0, min(limit, SEARCH_MAX_RESULTS)), max(0, offset)
+            if self.search is not None:
+                self.start_search(client, client.name, message[QUERY], limit, offset)
+            elif not self.send_to_worker(self.archive_worker, {ACTION: SEARCH, TIME: time.time(),
+                                                               ACCOUNT_NAME: client.name, QUERY: message[QUERY],
+                                                               LIMIT: limit, OFFSET: offset}):
+                response = RESPONSE_400
+                response[ERROR] = 'Поиск недоступен.'
+                self.send_to(client, response)
+            return
         # Если клиент выходит
-        elif ACTION in message and message[ACTION] == EXIT and ACCOUNT_NAME in message:
+        elif ACTION in message and message[ACTION] == EXIT and ACCOUNT_NAME in message \
+                and client.name == message[ACCOUNT_NAME]:
+            self.end_session(message[ACCOUNT_NAME])
             self.database.user_logout(message[ACCOUNT_NAME])
-            self.clients.remove(self.names[message[ACCOUNT_NAME]])
-            self.names[message[ACCOUNT_NAME]].close()
-            del self.names[message[ACCOUNT_NAME]]
+            self.remove_client(self.registry.find(message[ACCOUNT_NAME]) or client)
             return
         # Иначе отдаём Bad request
         else:
             response = RESPONSE_400
             response[ERROR] = 'Запрос некорректен.'
-            send_message(client, response)
+            self.send_to(client, response)
+            return
+
+
+# Сервер на основе asyncio. Подключения принимаются и сообщения читаются по готовности сокетов, без таймаута на
+# accept и без опроса всех клиентов через select. Правила обработки сообщений те же, что и у основного сервера.
+class AsyncServer(Server):
+    def __init__(self, listen_address, listen_port, database, worker=None, links=None, peers=None, peer_key=None,
+                 control=None, archive=None, search=None, archive_worker=None):
+        # Задачи чтения сообщений для каждого подключённого клиента и задача основного цикла.
+        self.readers = dict()
+        self.main_task = None
+
+        # Клиенты, ожидающие готовности сокета к записи, и события возобновления чтения приостановленных клиентов.
+        self.writers = set()
+        self.resume_events = dict()
+
+        super().__init__(listen_address, listen_port, database, worker, links, peers, peer_key, control, archive,
+                         search, archive_worker)
+
+    engine = 'asyncio сервер'
+
+    # Цикл событий asyncio работает только с неблокирующими сокетами.
+    def init_listener(self):
+        self.sock.setblocking(False)
+
+    # Готовность сокетов отслеживает цикл событий asyncio, селектор реестру не нужен.
+    def create_selector(self):
+        return None
+
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        except asyncio.CancelledError:
+            pass
+
+    # Ответы на поисковые запросы отправляются в цикле событий, поток поиска ставит их отправку в цикл.
+    # Если цикл уже завершён, сервер останавливается и ответы не нужны.
+    def wake_loop(self):
+        try:
+            self.loop.call_soon_threadsafe(self.deliver_search_results)
+        except RuntimeError:
+            pass
+
+    def deliver_search_results(self):
+        super().deliver_search_results()
+        self.flush_pending()
+
+    # Задача основного цикла отменяется из обработчика сигнала через цикл событий.
+    def shutdown(self):
+        super().shutdown()
+        if self.main_task is not None:
+            self.loop.call_soon_threadsafe(self.main_task.cancel)
+
+    # Основной цикл: ждём подключения и для каждого клиента запускаем отдельную задачу чтения.
+    async def serve(self):
+        self.init_socket()
+        self.init_control()
+        self.loop = loop = asyncio.get_running_loop()
+        self.main_task = asyncio.current_task()
+        if not self.running:
             return
+        self.init_links()
+        # Подключения, полученные от прежнего процесса сервера.
+        for client in list(self.registry):
+            if client not in self.readers:
+                self.readers[client] = loop.create_task(self.serve_client(client))
+        self.route_messages()
+        self.flush_pending()
+        self.ticker = loop.create_task(self.tick())
+        if self.control is not None:
+            self.controller = loop.create_task(self.serve_control())
+        while True:
+            sock, client_address = await loop.sock_accept(self.sock)
+            logger.info(f'Установлено соедение с ПК {client_address}')
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            client = self.registry.add(sock)
+            self.timers.schedule(client, HEARTBEAT_INTERVAL)
+            self.connections_total.inc()
+            self.readers[client] = loop.create_task(self.serve_client(client))
+
+    # Задача приёма запросов нового процесса сервера на управляющем сокете.
+    async def serve_control(self):
+        while True:
+            conn, _ = await self.loop.sock_accept(self.control)
+            self.handoff(conn)
+
+    # Периодические проверки, которые основной сервер выполняет в каждой итерации цикла.
+    async def tick(self):
+        while True:
+            await asyncio.sleep(SERVER_TICK)
+            self.expire_sessions()
+            self.check_heartbeats()
+            self.connect_peers()
+            self.flush_archive()
+            self.flush_presence()
+            self.flush_pending()
+
+    # Задача чтения сообщений одного клиента, завершается при отключении клиента.
+    async def serve_client(self, client):
+        loop = asyncio.get_running_loop()
+        while client in self.registry:
+            # Если чтение приостановлено, ждём освобождения буфера получателя.
+            if client in self.resume_events:
+                await self.resume_events[client].wait()
+                continue
+            try:
+                data = await loop.sock_recv(client.sock, READ_BUFFER_SIZE)
+                started = time.perf_counter()
+                self.process_client_data(data, client)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.info(f'Клиент {client} отключился от сервера.')
+                self.remove_client(client)
+                # Другие обработчики должны узнать об отключении сразу, а не на следующем такте.
+                self.flush_pending()
+                break
+            self.route_messages()
+            self.flush_presence()
+            self.flush_pending()
+            self.loop_time.observe(time.perf_counter() - started)
+
+    # Для канала связи, установленного этим сервером, запускается задача чтения. Принятые подключения, ставшие
+    # каналами связи, уже читаются своей задачей.
+    def add_link(self, link, peer):
+        super().add_link(link, peer)
+        if link not in self.readers:
+            self.readers[link] = self.loop.create_task(self.serve_client(link))
+
+    # Если буфер не удалось отправить целиком, дописываем его, когда сокет станет готов к записи.
+    def flush_client(self, client):
+        done = super().flush_client(client)
+        if not done and client not in self.writers:
+            self.loop.add_writer(client, self.flush_client, client)
+            self.writers.add(client)
+        elif done and client in self.writers:
+            self.loop.remove_writer(client)
+            self.writers.discard(client)
+        return done
+
+    def pause_reading(self, client):
+        super().pause_reading(client)
+        if client not in self.resume_events:
+            self.resume_events[client] = asyncio.Event()
+
+    def resume_reading(self, client):
+        super().resume_reading(client)
+        event = self.resume_events.pop(client, None)
+        if event is not None:
+            event.set()
+
+    def remove_client(self, client):
+        reader = self.readers.pop(client, None)
+        if reader is not None and reader is not asyncio.current_task():
+            reader.cancel()
+        if client in self.writers:
+            self.loop.remove_writer(client)
+            self.writers.discard(client)
+        super().remove_client(client)
+        self.resume_reading(client)
 
 
 def print_help():
@@ -167,21 +1706,172 @@ def print_help():
     print('users - список известных пользователей')
     print('connected - список подключенных пользователей')
     print('loghist - история входов пользователя')
+    print('stats - метрики сервера')
     print('exit - завершение работы сервера.')
     print('help - вывод справки по поддерживаемым командам')
 
 
+# Запрос даты у администратора. Пустой ввод - без ограничения.
+def input_date(prompt):
+    while True:
+        text = input(prompt)
+        if not text:
+            return None
+        try:
+            return datetime.datetime.fromisoformat(text)
+        except ValueError:
+            print('Некорректная дата, используйте формат ГГГГ-ММ-ДД или ГГГГ-ММ-ДД ЧЧ:ММ.')
+
+
+# Каналы связи между процессами-обработчиками: пара сокетов Unix для каждой пары обработчиков. Возвращает для
+# каждого обработчика словарь сокетов по номерам остальных.
+def create_worker_links(count):
+    links = [dict() for _ in range(count)]
+    for first in range(count):
+        for second in range(first + 1, count):
+            links[first][second], links[second][first] = socket.socketpair()
+    return links
+
+
+# Процесс-обработчик: свой сервер на общем порту, своё подключение к БД и свои метрики на порту metrics_port + номер.
+# Архив сообщений в archive_dir и индекс поиска по нему ведёт один обработчик ARCHIVE_WORKER, чтобы история
+# и поиск не зависели от того, к какому обработчику подключился клиент.
+def run_worker(worker, links, listen_address, listen_port, engine, metrics_port, db_url, archive_dir):
+    database = create_storage(db_url, shared=True)
+    archive = MessageArchive(archive_dir) if archive_dir and worker == ARCHIVE_WORKER else None
+    search = SearchIndex(archive) if archive is not None else None
+    archive_worker = ARCHIVE_WORKER if archive_dir and worker != ARCHIVE_WORKER else None
+    server_class = AsyncServer if engine == 'asyncio' else Server
+    server = server_class(listen_address, listen_port, database, worker, links, archive=archive, search=search,
+                          archive_worker=archive_worker)
+    # По сигналу завершения цикл сервера останавливается, после этого в БД записываются события, ещё не записанные
+    # потоком записи. Исключение из обработчика сигнала могло бы прервать поток посреди записи в журнал или БД.
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.shutdown())
+    if metrics_port:
+        start_metrics_server(metrics_port + worker)
+    try:
+        server.run()
+    finally:
+        database.close()
+        if archive is not None:
+            search.close()
+            archive.close()
+
+
+# Запуск процессов-обработчиков. Процессы запускаются методом spawn: в них заново настраивается логирование
+# и отображения БД, сокеты каналов связи передаются при запуске.
+def start_workers(count, listen_address, listen_port, engine, metrics_port, db_url=SERVER_DB, archive_dir=ARCHIVE_DIR):
+    context = multiprocessing.get_context('spawn')
+    links = create_worker_links(count)
+    workers = []
+    for worker in range(count):
+        process = context.Process(target=run_worker, daemon=True, args=(
+            worker, links[worker], listen_address, listen_port, engine, metrics_port, db_url, archive_dir))
+        process.start()
+        workers.append(process)
+    # В основном процессе сокеты каналов не нужны.
+    for worker_links in links:
+        for sock in worker_links.values():
+            sock.close()
+    return workers
+
+
+# Чтение из сокета ровно size байт.
+def recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('соединение закрыто')
+        data += chunk
+    return bytes(data)
+
+
+# Запрос подключений у работающего процесса сервера через управляющий сокет path. Возвращает управляющее
+# соединение, снимок состояния, слушающий сокет и сокеты клиентов или None, если работающего сервера нет.
+def request_handoff(path):
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+    except OSError:
+        conn.close()
+        return None
+    conn.settimeout(HANDOFF_TIMEOUT)
+    size = struct.unpack('!I', recv_exactly(conn, 4))[0]
+    snapshot = pickle.loads(recv_exactly(conn, size))
+    fds = []
+    while len(fds) < len(snapshot['sessions']) + 1:
+        data, received, flags, address = socket.recv_fds(conn, 1, HANDOFF_FDS_PER_MESSAGE)
+        if not data:
+            raise ConnectionError('соединение закрыто')
+        fds.extend(received)
+    socks = [socket.socket(fileno=fd) for fd in fds]
+    return conn, snapshot, socks[0], socks[1:]
+
+
 def main():
     # Загрузка параметров командной строки, если нет параметров, то задаём значения по умоланию.
-    listen_address, listen_port = arg_parser()
+    listen_address, listen_port, engine, metrics_port, workers, peers, peer_key, control, archive_dir, reload = \
+        arg_parser()
+    if workers > 1 and peers:
+        print('Подключение к соседним узлам поддерживается только в режиме одного процесса, список узлов не используется.')
 
-    # Инициализация БД
-    database = ServerStorage()
+    # По запросу перезапуска принимаем у сервера, работающего на том же порту, слушающий сокет и подключения
+    # клиентов. Передача подключений поддерживается только в режиме одного процесса.
+    handoff = None
+    if reload:
+        if workers > 1 or not control:
+            print('Перезапуск поддерживается только в режиме одного процесса с управляющим сокетом.')
+            sys.exit(1)
+        try:
+            handoff = request_handoff(control)
+        except (OSError, pickle.UnpicklingError) as error:
+            print(f'Не удалось получить подключения у работающего сервера: {error}')
+            sys.exit(1)
+        if handoff is None:
+            print('Работающий сервер не найден, сервер запускается заново.')
 
-    # Создание экземпляра класса - сервера и его запуск:
-    server = Server(listen_address, listen_port, database)
-    server.daemon = True
-    server.start()
+    # Инициализация БД. В режиме нескольких процессов БД общая для всех обработчиков, а основной процесс
+    # только обслуживает консоль. Пользователи онлайн, полученные от прежнего процесса, остаются в БД.
+    database = create_storage(shared=workers > 1)
+    if handoff is None:
+        database.reset_active_users()
+    archive = search = None
+    if workers > 1:
+        processes = start_workers(workers, listen_address, listen_port, engine, metrics_port,
+                                  archive_dir=archive_dir)
+        print(f'Запущено процессов-обработчиков: {workers}.')
+    else:
+        processes = []
+        # Архив и индекс поиска открываются после того, как прежний процесс записал их на диск.
+        if archive_dir:
+            archive = MessageArchive(archive_dir)
+            search = SearchIndex(archive)
+        # Создание экземпляра класса - сервера и его запуск:
+        if engine == 'asyncio':
+            server = AsyncServer(listen_address, listen_port, database, peers=peers, peer_key=peer_key,
+                                 control=control, archive=archive, search=search)
+        else:
+            server = Server(listen_address, listen_port, database, peers=peers, peer_key=peer_key, control=control,
+                            archive=archive, search=search)
+        if handoff is not None:
+            conn, snapshot, listen_sock, client_socks = handoff
+            server.restore(snapshot, listen_sock, client_socks)
+            conn.sendall(b'K')
+            # Прежний процесс закрывает управляющее соединение при завершении, после этого освобождаются
+            # управляющий сокет и порт метрик.
+            try:
+                conn.recv(1)
+            except OSError:
+                pass
+            conn.close()
+            print(f'Получено подключений от работающего сервера: {len(client_socks)}.')
+        server.daemon = True
+        server.start()
+
+        # Выдача метрик по HTTP на локальном адресе
+        if metrics_port:
+            start_metrics_server(metrics_port)
 
     # Печатаем справку:
     print_help()
@@ -197,16 +1887,54 @@ def main():
             for user in sorted(database.users_list()):
                 print(f'Пользователь {user[0]}, последний вход: {user[1]}')
         elif command == 'connected':
-            for user in sorted(database.active_users_list()):
+            # Пользователи в сети берутся из памяти сервера; обработчики работают в своих процессах, поэтому
+            # в режиме нескольких процессов - из БД.
+            users = database.active_users_list() if processes else server.connected_users()
+            for user in sorted(users):
                 print(f'Пользователь {user[0]}, подключен: {user[1]}:{user[2]}, время установки соединения: {user[3]}')
+        elif command == 'stats':
+            # Метрики собирает каждый обработчик в своём процессе.
+            if processes:
+                if metrics_port:
+                    print(f'Метрики обработчиков: http://127.0.0.1:<порт>/metrics, '
+                          f'порты {metrics_port}-{metrics_port + workers - 1}.')
+                continue
+            # Скорости счётчиков считаются с предыдущего вызова команды.
+            for line in METRICS.summary():
+                print(line)
         elif command == 'loghist':
             name = input('Введите имя пользователя для просмотра истории. '
                          'Для вывода всей истории, просто нажмите Enter: ')
-            for user in sorted(database.login_history(name)):
-                print(f'Пользователь: {user[0]} время входа: {user[1]}. Вход с: {user[2]}:{user[3]}')
+            date_from = input_date('Начало периода (ГГГГ-ММ-ДД [ЧЧ:ММ]), Enter - без ограничения: ')
+            date_to = input_date('Конец периода (ГГГГ-ММ-ДД [ЧЧ:ММ]), Enter - без ограничения: ')
+            # Выводим историю по страницам по мере чтения из БД. Страница читается из одного снимка БД, снимок
+            # завершается до ожидания ввода: открытая транзакция чтения не дала бы перенести журнал WAL в БД.
+            # Следующая страница выбирается по ключу (время и номер входа), поэтому входы, записанные во время
+            # просмотра, не сдвигают страницы.
+            pages = database.login_history_pages(name, date_from, date_to)
+            while True:
+                with database.snapshot():
+                    page = next(pages, None)
+                if page is None:
+                    break
+                for user in page:
+                    print(f'Пользователь: {user[0]} время входа: {user[1]}. Вход с: {user[2]}:{user[3]}')
+                if len(page) == HISTORY_PAGE_SIZE and \
+                        input('Enter - следующая страница, q - прервать вывод: ') == 'q':
+                    break
         else:
             print('Команда не распознана.')
 
+    # Останавливаем обработчики и записываем в БД события, ещё не записанные потоком записи.
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join()
+    database.close()
+    if archive is not None:
+        search.close()
+        archive.close()
+
 
 if __name__ == '__main__':
     main()
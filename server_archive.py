@@ -0,0 +1,259 @@
+import bisect
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from common.variables import *
+from common.codec import CODECS, DECODE_ERRORS, JSON_CODEC
+from common.utils import frame_body
+
+
+# Архив сообщений пользователям. Сообщения дописываются в сегменты журнала (файлы <номер>.log размером до
+# segment_size байт) в том виде, в каком пришли: кадр из режима с кадрированием - без перекодирования. Индекс
+# переписок (пара собеседников -> время и позиция каждого сообщения) хранится в памяти, а на диск дописывается
+# в файлы <номер>.idx не чаще раза в ARCHIVE_FLUSH_INTERVAL. При открытии архива индекс загружается из этих
+# файлов, записи журнала, не попавшие в индекс, дочитываются из самого журнала. Сообщения читаются через mmap.
+class MessageArchive:
+    # Заголовок записи журнала: длинна сообщения, время архивации, номер кодека, длинны имён отправителя
+    # и получателя. За заголовком следуют имена и само сообщение.
+    record_header = struct.Struct('!IdBHH')
+    # Запись файла индекса: смещение и полная длинна записи журнала, время архивации, длинны имён отправителя
+    # и получателя, за ней - имена.
+    index_entry = struct.Struct('!IIdHH')
+    # Кодеки сообщений по номерам
+    codecs = (CODEC_JSON, CODEC_BINARY)
+
+    def __init__(self, directory=ARCHIVE_DIR, segment_size=ARCHIVE_SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        os.makedirs(directory, exist_ok=True)
+        # Индекс переписок: (имя, имя) по порядку -> (массив времён, массив позиций). Позиция сообщения - номер
+        # сегмента, сдвинутый на 32 бита, плюс смещение записи в сегменте.
+        self.conversations = dict()
+        # Записи индекса текущего сегмента, ещё не записанные на диск
+        self.pending = []
+        # Отображения сегментов в память, последние использованные - в конце
+        self.maps = OrderedDict()
+        # Запись ведёт поток сервера, сброс на диск при завершении может выполняться из другого потока.
+        self.lock = threading.Lock()
+
+        segments = sorted(int(name[:-4]) for name in os.listdir(directory)
+                          if name.endswith('.log') and name[:-4].isdigit())
+        for segment in segments:
+            self.load_segment(segment, segment == segments[-1])
+        self.segment = segments[-1] if segments else 0
+        self.file = open(self.segment_path(self.segment, 'log'), 'ab')
+        self.index_file = open(self.segment_path(self.segment, 'idx'), 'ab')
+        self.size = self.file.tell()
+        self.flushed = time.monotonic()
+
+    def segment_path(self, segment, extension):
+        return os.path.join(self.directory, f'{segment:08d}.{extension}')
+
+    # Загрузка индекса сегмента: сначала из файла индекса, затем из записей журнала после последней
+    # проиндексированной, они же дописываются в файл индекса. Незаконченная запись в конце последнего сегмента
+    # (обрыв при записи) отбрасывается.
+    def load_segment(self, segment, last):
+        end = 0
+        index_path = self.segment_path(segment, 'idx')
+        if os.path.exists(index_path):
+            with open(index_path, 'rb') as file:
+                data = file.read()
+            offset = 0
+            while offset + self.index_entry.size <= len(data):
+                position, length, stamp, sender_length, destination_length = self.index_entry.unpack_from(data, offset)
+                names = offset + self.index_entry.size
+                entry_end = names + sender_length + destination_length
+                if entry_end > len(data):
+                    break
+                self.add(data[names:names + sender_length].decode(ENCODING),
+                         data[names + sender_length:entry_end].decode(ENCODING), stamp, segment, position)
+                end = position + length
+                offset = entry_end
+            if offset != len(data):
+                os.truncate(index_path, offset)
+
+        log_path = self.segment_path(segment, 'log')
+        with open(log_path, 'rb') as file:
+            file.seek(end)
+            data = file.read()
+        offset = 0
+        entries = []
+        while offset + self.record_header.size <= len(data):
+            length, stamp, codec, sender_length, destination_length = self.record_header.unpack_from(data, offset)
+            names = offset + self.record_header.size
+            record_end = names + sender_length + destination_length + length
+            if record_end > len(data):
+                break
+            sender_name = data[names:names + sender_length]
+            destination_name = data[names + sender_length:names + sender_length + destination_length]
+            self.add(sender_name.decode(ENCODING), destination_name.decode(ENCODING), stamp, segment, end + offset)
+            entries.append(self.pack_entry(end + offset, record_end - offset, stamp, sender_name, destination_name))
+            offset = record_end
+        if entries:
+            with open(index_path, 'ab') as file:
+                file.write(b''.join(entries))
+        if last and offset != len(data):
+            os.truncate(log_path, end + offset)
+
+    # Запись файла индекса, имена передаются в байтах.
+    def pack_entry(self, offset, length, stamp, sender_name, destination_name):
+        return self.index_entry.pack(offset, length, stamp, len(sender_name), len(destination_name)) \
+            + sender_name + destination_name
+
+    # Добавление сообщения в индекс переписок в памяти.
+    def add(self, sender, destination, stamp, segment, offset):
+        key = (sender, destination) if sender <= destination else (destination, sender)
+        entry = self.conversations.get(key)
+        if entry is None:
+            entry = self.conversations[key] = (array('d'), array('Q'))
+        entry[0].append(stamp)
+        entry[1].append(segment << 32 | offset)
+
+    # Запись сообщения в архив. Сообщение, пришедшее кадром, сохраняется без декодирования. Возвращает позицию
+    # сообщения в архиве.
+    def append(self, message):
+        if RAW_FRAME in message:
+            body = frame_body(message[RAW_FRAME])
+            codec = self.codecs.index(message[RAW_CODEC].name)
+        else:
+            body = JSON_CODEC.encode(message)
+            codec = 0
+        sender = str(message[SENDER])
+        destination = str(message[DESTINATION])
+        sender_name = sender.encode(ENCODING)
+        destination_name = destination.encode(ENCODING)
+        stamp = time.time()
+        with self.lock:
+            length = self.record_header.size + len(sender_name) + len(destination_name) + len(body)
+            if self.size and self.size + length > self.segment_size:
+                self.rotate()
+            offset = self.size
+            self.file.write(self.record_header.pack(len(body), stamp, codec, len(sender_name), len(destination_name))
+                            + sender_name + destination_name)
+            self.file.write(body)
+            self.size += length
+            self.add(sender, destination, stamp, self.segment, offset)
+            self.pending.append(self.pack_entry(offset, length, stamp, sender_name, destination_name))
+        return self.segment << 32 | offset
+
+    # Переход к следующему сегменту, когда текущий заполнен.
+    def rotate(self):
+        self.write_index()
+        self.file.close()
+        self.index_file.close()
+        self.segment += 1
+        self.file = open(self.segment_path(self.segment, 'log'), 'ab')
+        self.index_file = open(self.segment_path(self.segment, 'idx'), 'ab')
+        self.size = 0
+
+    # Запись на диск журнала и накопленных записей индекса (без fsync).
+    def write_index(self):
+        self.file.flush()
+        if self.pending:
+            self.index_file.write(b''.join(self.pending))
+            self.index_file.flush()
+            self.pending.clear()
+        self.flushed = time.monotonic()
+
+    def flush(self):
+        with self.lock:
+            self.write_index()
+
+    # Сброс на диск, если с предыдущего прошло ARCHIVE_FLUSH_INTERVAL секунд. Вызывается из цикла сервера.
+    def flush_if_due(self):
+        if time.monotonic() - self.flushed >= ARCHIVE_FLUSH_INTERVAL:
+            self.flush()
+
+    # Последние count сообщений переписки пользователей first и second, заархивированных раньше момента before
+    # (если задан), в порядке архивации. Время сообщения заменяется временем архивации, по нему можно запросить
+    # предыдущие сообщения.
+    def history(self, first, second, count, before=None):
+        key = (first, second) if first <= second else (second, first)
+        with self.lock:
+            entry = self.conversations.get(key)
+            if entry is None:
+                return []
+            times, positions = entry
+            end = len(times) if before is None else bisect.bisect_left(times, before)
+            selected = positions[max(0, end - count):end]
+        return self.messages(selected)
+
+    # Сообщения по их позициям в архиве. Сообщения, которые не удаётся декодировать, пропускаются.
+    def messages(self, positions):
+        with self.lock:
+            # Читаемые записи текущего сегмента могут быть ещё в буфере файла.
+            self.file.flush()
+            messages = [self.read(position >> 32, position & 0xFFFFFFFF) for position in positions]
+        return [message for message in messages if message is not None]
+
+    # Перебор сообщений архива с позицией больше after (всех, если after не задан) в порядке архивации: пары
+    # (позиция, сообщение). Чтение начинается с записи after, а не с начала сегмента, поэтому архив можно
+    # дочитывать по мере роста. Используется для построения производных индексов.
+    def records(self, after=None):
+        self.flush()
+        first = 0 if after is None else after >> 32
+        for segment in range(first, self.segment + 1):
+            path = self.segment_path(segment, 'log')
+            if not os.path.exists(path):
+                continue
+            base = after & 0xFFFFFFFF if segment == first and after is not None else 0
+            with open(path, 'rb') as file:
+                file.seek(base)
+                data = file.read()
+            offset = 0
+            while offset + self.record_header.size <= len(data):
+                length, stamp, codec, sender_length, destination_length = self.record_header.unpack_from(data, offset)
+                start = offset + self.record_header.size + sender_length + destination_length
+                if start + length > len(data):
+                    break
+                position = segment << 32 | base + offset
+                if after is None or position > after:
+                    message = self.decode(codec, data[start:start + length], stamp)
+                    if message is not None:
+                        yield position, message
+                offset = start + length
+
+    def read(self, segment, offset):
+        mapping = self.map_segment(segment, offset + self.record_header.size)
+        length, stamp, codec, sender_length, destination_length = self.record_header.unpack_from(mapping, offset)
+        start = offset + self.record_header.size + sender_length + destination_length
+        mapping = self.map_segment(segment, start + length)
+        return self.decode(codec, mapping[start:start + length], stamp)
+
+    # Декодирование сообщения записи журнала, время сообщения заменяется временем архивации. Кадры пересылаются
+    # и архивируются без разбора, поэтому в журнале может оказаться некорректное сообщение - вместо него
+    # возвращается None.
+    def decode(self, codec, data, stamp):
+        try:
+            message = CODECS[self.codecs[codec]].decode(data)
+        except DECODE_ERRORS:
+            return None
+        message[TIME] = stamp
+        return message
+
+    # Отображение сегмента в память. Текущий сегмент растёт, поэтому его отображение пересоздаётся, если нужная
+    # запись в него не попадает. Открытыми остаются не более ARCHIVE_MAPPED_SEGMENTS отображений.
+    def map_segment(self, segment, size):
+        mapping = self.maps.pop(segment, None)
+        if mapping is None or len(mapping) < size:
+            if mapping is not None:
+                mapping.close()
+            with open(self.segment_path(segment, 'log'), 'rb') as file:
+                mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.maps[segment] = mapping
+        while len(self.maps) > ARCHIVE_MAPPED_SEGMENTS:
+            self.maps.popitem(last=False)[1].close()
+        return mapping
+
+    def close(self):
+        with self.lock:
+            self.write_index()
+            self.file.close()
+            self.index_file.close()
+            for mapping in self.maps.values():
+                mapping.close()
+            self.maps.clear()
@@ -1,11 +1,422 @@
 import datetime
-from sqlalchemy import create_engine, Column, ForeignKey, MetaData, Table, Integer, String, DateTime
-from sqlalchemy.orm import mapper, sessionmaker
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from sqlalchemy import create_engine, event, Column, ForeignKey, MetaData, Table, Index, Integer, String, DateTime, \
+    Text, and_, or_, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import aliased, mapper, scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
 
-from common.variables import SERVER_DB
+from common.variables import SERVER_DB, STORED_BATCH_SIZE, WRITE_BATCH_SIZE, WRITE_BATCH_INTERVAL, USER_CACHE_SIZE, \
+    HISTORY_PAGE_SIZE, LISTING_CACHE_TTL, STORAGE_BACKEND, STORAGE_SQLALCHEMY, STORAGE_SQLITE
+from server_metrics import METRICS
 
+logger = logging.getLogger('server')
 
-class ServerStorage:
+
+# Кэш справочника пользователей: имя -> (id, время последнего входа). При превышении размера вытесняются давно
+# не использованные записи. Используется из нескольких потоков, поэтому доступ защищён блокировкой.
+class UserCache:
+    def __init__(self, max_size=USER_CACHE_SIZE):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        # Истина, пока в кэше есть все пользователи БД (ни одна запись не вытеснена)
+        self.complete = True
+
+    def get(self, name):
+        with self.lock:
+            item = self.items.get(name)
+            if item is not None:
+                self.items.move_to_end(name)
+            return item
+
+    def put(self, name, user_id, last_login):
+        with self.lock:
+            self.items[name] = (user_id, last_login)
+            self.items.move_to_end(name)
+            if len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+                self.complete = False
+
+    def discard(self, name):
+        with self.lock:
+            self.items.pop(name, None)
+            self.complete = False
+
+    # список (имя, время последнего входа) всех пользователей или None, если часть записей вытеснена
+    def users(self):
+        with self.lock:
+            if not self.complete:
+                return None
+            return [(name, last_login) for name, (user_id, last_login) in self.items.items()]
+
+
+# Общая часть хранилищ данных сервера, не зависящая от способа доступа к БД: кэш пользователей, состав групп,
+# очередь событий на запись и поток, записывающий их пачками. Реализации (ServerStorage на SQLAlchemy ORM
+# и SqliteStorage на модуле sqlite3) подключаются к БД и вызывают этот конструктор, а также реализуют запросы
+# и применение событий. Сессия - объект с методами commit, rollback и close; у каждого потока (сервера, записи,
+# консоли) своя сессия со своим соединением из thread_session, так что запросы консоли не мешают потоку сервера.
+class Storage:
+    # shared - БД используется одновременно несколькими процессами сервера: кэш пользователей не считается полным
+    # (пользователя мог добавить другой процесс). Таблица пользователей онлайн при подключении не очищается:
+    # сервер делает это вызовом reset_active_users, если запускается заново, а не принимает подключения
+    # у прежнего процесса.
+    def __init__(self, shared=False):
+        # состояние потока: snapshot - истина внутри блока snapshot
+        self.local = threading.local()
+        # кэш частых списков: название -> (момент устаревания, результат)
+        self.listings = dict()
+
+        # заполнение кэша пользователей из БД
+        self.users_cache = UserCache()
+        with self.reading() as session:
+            for name, user_id, last_login in self.load_users(session, self.users_cache.max_size + 1):
+                self.users_cache.put(name, user_id, last_login)
+            # состав групп: имя группы -> множество имён участников. Группы читаются из кэша при каждом сообщении,
+            # изменения записываются в БД потоком записи.
+            self.groups = self.load_groups(session)
+            # списки контактов: имя -> множество имён контактов, и обратный индекс: имя -> множество пользователей,
+            # у которых он в контактах (им сервер сообщает о его входе и выходе). Изменения, как и у групп,
+            # записываются потоком записи.
+            self.contacts = dict()
+            self.watchers = dict()
+            for username, contact in self.load_contacts(session):
+                self.contacts.setdefault(username, set()).add(contact)
+                self.watchers.setdefault(contact, set()).add(username)
+        if shared:
+            self.users_cache.complete = False
+
+        # Сообщения для пользователей не в сети тоже сохраняются и удаляются потоком записи. Пока удаление
+        # не выполнено, удаляемые сообщения (их id в deleting) не выдаются при чтении, а чтение сообщений
+        # пользователя дожидается записи сохраняемых для него (storing: имя -> количество событий в очереди).
+        self.stored_lock = threading.Lock()
+        self.deleting = set()
+        self.storing = dict()
+
+        # очередь событий на запись и поток, применяющий их к БД пачками в одной транзакции
+        self.write_queue = queue.Queue()
+        METRICS.gauge('db_write_queue', 'Событий в очереди на запись в БД').function = self.write_queue.qsize
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    # замер времени обращения к БД, результат попадает в гистограмму с меткой операции
+    @staticmethod
+    def timed(operation):
+        return METRICS.histogram('db_call_seconds', 'Время обращений к БД, секунд', op=operation).time()
+
+    # запись входа пользователя в БД. Событие ставится в очередь и будет записано потоком записи.
+    def user_login(self, username, ip_address, port):
+        self.write_queue.put((self.apply_login, (username, ip_address, port, datetime.datetime.now())))
+
+    # запись выхода пользователя в БД, так же через очередь потока записи
+    def user_logout(self, username):
+        self.write_queue.put((self.apply_logout, (username,)))
+
+    # ожидание записи всех событий, поставленных в очередь до вызова
+    def flush(self):
+        done = threading.Event()
+        self.write_queue.put((None, done))
+        done.wait()
+
+    # завершение работы с БД: записать все события, остановить поток записи и закрыть соединения потоков
+    def close(self):
+        if self.writer.is_alive():
+            self.write_queue.put((None, None))
+            self.writer.join()
+        self.close_sessions()
+
+    # основной цикл потока записи. События собираются в пачку, пока не наберётся WRITE_BATCH_SIZE событий или не
+    # пройдёт WRITE_BATCH_INTERVAL секунд с первого события пачки, затем пачка записывается одной транзакцией.
+    def write_loop(self):
+        session = self.thread_session()
+        while True:
+            batch = [self.write_queue.get()]
+            deadline = time.monotonic() + WRITE_BATCH_INTERVAL
+            while batch[-1][0] is not None and len(batch) < WRITE_BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.write_queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            events = [write_event for write_event in batch if write_event[0] is not None]
+            if events:
+                with self.timed('write_batch'):
+                    self.apply_events(session, events)
+                self.written(events)
+            # служебное событие: None - завершение потока, иначе отметка для flush
+            if batch[-1][0] is None:
+                if batch[-1][1] is None:
+                    session.close()
+                    return
+                batch[-1][1].set()
+
+    # запись пачки событий одной транзакцией. Если транзакция не удалась, события записываются по одному, чтобы
+    # одно ошибочное событие не привело к потере остальных.
+    def apply_events(self, session, events):
+        try:
+            for apply, args in events:
+                apply(session, *args)
+            session.commit()
+            return
+        except Exception:
+            session.rollback()
+            self.forget_users(events)
+        for apply, args in events:
+            try:
+                apply(session, *args)
+                session.commit()
+            except Exception as error:
+                session.rollback()
+                self.forget_users([(apply, args)])
+                logger.error(f'Не удалось записать событие {apply.__name__}{args} в БД: {error}')
+
+    # события пачки обработаны (записаны или отброшены из-за ошибки): сохранённые сообщения можно читать,
+    # не дожидаясь записи, а удалённые больше не нужно скрывать
+    def written(self, events):
+        with self.stored_lock:
+            for apply, args in events:
+                if apply == self.apply_store_messages:
+                    count = self.storing.pop(args[0]) - 1
+                    if count:
+                        self.storing[args[0]] = count
+                elif apply == self.apply_delete_messages:
+                    self.deleting.difference_update(args[1])
+
+    # после отката транзакции записи кэша по пользователям событий могут не соответствовать БД, их нужно удалить.
+    # События входа и выхода первым аргументом принимают имя пользователя.
+    def forget_users(self, events):
+        for apply, args in events:
+            self.users_cache.discard(args[0])
+
+    # id пользователя по имени: из кэша, а при промахе - из БД с занесением в кэш. None, если пользователь неизвестен.
+    def user_id(self, session, username):
+        cached = self.users_cache.get(username)
+        if cached is not None:
+            return cached[0]
+        # в полном кэше есть все пользователи, обращаться к БД не нужно
+        if self.users_cache.complete:
+            return None
+        user = self.find_user(session, username)
+        if user is None:
+            return None
+        self.users_cache.put(username, *user)
+        return user[0]
+
+    # участники группы или None, если такой группы нет
+    def group_members(self, group):
+        return self.groups.get(group)
+
+    # создание группы, создатель становится её участником. Возвращает False, если группа уже существует.
+    # persist=False - изменение, уже записанное в БД другим процессом сервера, применяется только к кэшу.
+    def create_group(self, group, username, persist=True):
+        if group in self.groups:
+            return False
+        self.groups[group] = {username}
+        if persist:
+            self.write_queue.put((self.apply_create_group, (username, group)))
+        return True
+
+    # вступление в группу. Возвращает False, если группы нет.
+    def join_group(self, group, username, persist=True):
+        members = self.groups.get(group)
+        if members is None:
+            return False
+        if username not in members:
+            members.add(username)
+            if persist:
+                self.write_queue.put((self.apply_join_group, (username, group)))
+        return True
+
+    # выход из группы. Возвращает False, если пользователь в ней не состоит.
+    def leave_group(self, group, username, persist=True):
+        members = self.groups.get(group)
+        if members is None or username not in members:
+            return False
+        members.discard(username)
+        if persist:
+            self.write_queue.put((self.apply_leave_group, (username, group)))
+        return True
+
+    # Сессия текущего потока для чтения. Вне блока snapshot транзакция чтения завершается сразу после запроса,
+    # чтобы сессия не удерживала соединение и старый снимок БД.
+    @contextmanager
+    def reading(self):
+        session = self.thread_session()
+        try:
+            yield session
+        finally:
+            if not getattr(self.local, 'snapshot', False):
+                session.rollback()
+
+    # Чтения текущего потока внутри блока выполняются в одной транзакции и видят один снимок БД. В режиме WAL
+    # такая транзакция не блокирует запись и не блокируется ей, но пока она открыта, журнал WAL не переносится в БД,
+    # поэтому блок не должен ждать ввода пользователя. Используется консолью сервера для чтения страницы истории.
+    @contextmanager
+    def snapshot(self):
+        session = self.thread_session()
+        session.rollback()
+        self.begin_snapshot(session)
+        self.local.snapshot = True
+        try:
+            yield
+        finally:
+            self.local.snapshot = False
+            session.rollback()
+
+    # Результат частого запроса списка: повторные запросы в течение LISTING_CACHE_TTL секунд получают его из кэша,
+    # не обращаясь к БД.
+    def listing(self, name, query):
+        cached = self.listings.get(name)
+        if cached is not None and time.monotonic() < cached[0]:
+            return cached[1]
+        with self.reading() as session:
+            result = query(session)
+        self.listings[name] = (time.monotonic() + LISTING_CACHE_TTL, result)
+        return result
+
+    # контакты пользователя
+    def get_contacts(self, username):
+        return self.contacts.get(username, set())
+
+    # пользователи, у которых username в контактах
+    def contact_watchers(self, username):
+        return self.watchers.get(username, set())
+
+    # добавление контакта. Возвращает False, если такой пользователь неизвестен или это сам пользователь.
+    # persist=False - изменение, уже записанное в БД другим процессом сервера, применяется только к кэшу.
+    def add_contact(self, username, contact, persist=True):
+        if contact == username:
+            return False
+        if persist:
+            with self.reading() as session:
+                if self.user_id(session, contact) is None:
+                    return False
+        contacts = self.contacts.setdefault(username, set())
+        if contact not in contacts:
+            contacts.add(contact)
+            self.watchers.setdefault(contact, set()).add(username)
+            if persist:
+                self.write_queue.put((self.apply_add_contact, (username, contact)))
+        return True
+
+    # удаление контакта. Возвращает False, если его нет в контактах пользователя.
+    def remove_contact(self, username, contact, persist=True):
+        contacts = self.contacts.get(username)
+        if contacts is None or contact not in contacts:
+            return False
+        contacts.discard(contact)
+        watchers = self.watchers[contact]
+        watchers.discard(username)
+        if not watchers:
+            del self.watchers[contact]
+        if persist:
+            self.write_queue.put((self.apply_remove_contact, (username, contact)))
+        return True
+
+    # список всех пользователей со временем последнего входа, из кэша, если в нём есть все пользователи
+    def users_list(self):
+        users = self.users_cache.users()
+        if users is not None:
+            return users
+        return self.listing('users', self.query_users)
+
+    # список активных пользователей: (имя, адрес, порт, время входа)
+    def active_users_list(self):
+        return self.listing('active_users', self.query_active_users)
+
+    # список истории входов в порядке времени входа: (имя, время входа, адрес, порт, id). Можно ограничить период
+    # [date_from, date_to) и количество записей limit. after - ключ (время входа, id) последней записи предыдущей
+    # страницы, выдаются записи после неё.
+    def login_history(self, username=None, date_from=None, date_to=None, limit=None, after=None):
+        with self.reading() as session:
+            user_id = None
+            # фильтрация, если задано имя
+            if username:
+                user_id = self.user_id(session, username)
+                if user_id is None:
+                    return []
+            return self.query_history(session, user_id, date_from, date_to, limit, after)
+
+    # история входов по страницам: генератор выдаёт списки записей, каждая страница читается отдельным запросом
+    # по ключу (время входа, id) последней записи предыдущей страницы
+    def login_history_pages(self, username=None, date_from=None, date_to=None, page_size=HISTORY_PAGE_SIZE):
+        after = None
+        while True:
+            page = self.login_history(username, date_from, date_to, page_size, after)
+            if page:
+                yield page
+            if len(page) < page_size:
+                return
+            after = (page[-1][1], page[-1][4])
+
+    # сохранение сообщения для пользователя не в сети, возвращает False, если такой пользователь неизвестен
+    def store_message(self, username, message):
+        return self.store_messages(username, [message])
+
+    # сохранение нескольких сообщений для пользователя не в сети. Сообщения записываются потоком записи
+    # в одной транзакции с другими событиями.
+    def store_messages(self, username, messages):
+        with self.reading() as session:
+            user_id = self.user_id(session, username)
+        if user_id is None:
+            return False
+        with self.stored_lock:
+            self.storing[username] = self.storing.get(username, 0) + 1
+        self.write_queue.put((self.apply_store_messages, (username, user_id, datetime.datetime.now(),
+                                                          [json.dumps(message) for message in messages])))
+        return True
+
+    # сообщения, ожидающие доставки пользователю, в порядке поступления. Генератор выдаёт пачки списков
+    # (id, сообщение), каждая следующая пачка читается отдельным запросом после id последнего сообщения предыдущей.
+    # Если сообщения для пользователя ещё в очереди на запись, сначала дожидается их записи.
+    def stored_messages(self, username, batch_size=STORED_BATCH_SIZE):
+        with self.stored_lock:
+            storing = username in self.storing
+        if storing:
+            self.flush()
+        with self.reading() as session:
+            user_id = self.user_id(session, username)
+        if user_id is None:
+            return
+        last_id = 0
+        while True:
+            with self.timed('stored_messages'), self.reading() as session:
+                batch = self.select_messages(session, user_id, last_id, batch_size)
+            if not batch:
+                return
+            last_id = batch[-1][0]
+            with self.stored_lock:
+                batch = [(message_id, message) for message_id, message in batch if message_id not in self.deleting]
+            if batch:
+                yield [(message_id, json.loads(message)) for message_id, message in batch]
+
+    # удаление доставленных сообщений пользователя. Удаление выполняет поток записи, до этого сообщения
+    # не выдаются при чтении.
+    def delete_stored_messages(self, username, message_ids):
+        with self.stored_lock:
+            self.deleting.update(message_ids)
+        self.write_queue.put((self.apply_delete_messages, (username, list(message_ids))))
+
+    # применение событий сохранения и удаления сообщений, одинаковое для обоих хранилищ
+    def apply_store_messages(self, session, username, user_id, date_time, messages):
+        self.insert_messages(session, user_id, date_time, messages)
+
+    def apply_delete_messages(self, session, username, message_ids):
+        self.delete_messages(session, message_ids)
+
+
+# Хранилище на SQLAlchemy ORM: таблицы отображаются на вложенные классы, подходит для любой БД,
+# которую поддерживает SQLAlchemy.
+class ServerStorage(Storage):
     # класс для таблицы всех пользователей
     class AllUsers:
         def __init__(self, username):
@@ -30,19 +441,71 @@ class ServerStorage:
 
     # класс для таблицы истории входов пользователей
     class LoginHistory:
-        def __init__(self, name, date_time, ip_address, port):
+        def __init__(self, user_id, date_time, ip_address, port):
             self.id = None
-            self.name = name
+            self.user = user_id
             self.date_time = date_time
             self.ip_address = ip_address
             self.port = port
 
         def __repr__(self):
-            return f"<f'User {self.name} {self.date_time} {self.ip_address} {self.port}'>"
+            return f"<f'User {self.user} {self.date_time} {self.ip_address} {self.port}'>"
+
+    # класс для таблицы сообщений, ожидающих доставки пользователям не в сети
+    class StoredMessage:
+        def __init__(self, user_id, date_time, message):
+            self.id = None
+            self.user = user_id
+            self.date_time = date_time
+            self.message = message
+
+        def __repr__(self):
+            return f"<f'Message for {self.user} {self.date_time}'>"
+
+    # класс для таблицы групп
+    class Group:
+        def __init__(self, name):
+            self.id = None
+            self.name = name
+
+        def __repr__(self):
+            return f"<f'Group {self.name}'>"
+
+    # класс для таблицы участников групп
+    class GroupMember:
+        def __init__(self, group_id, user_id):
+            self.id = None
+            self.group = group_id
+            self.user = user_id
+
+        def __repr__(self):
+            return f"<f'Member {self.user} of {self.group}'>"
+
+    # класс для таблицы контактов пользователей
+    class Contact:
+        def __init__(self, user_id, contact_id):
+            self.id = None
+            self.user = user_id
+            self.contact = contact_id
+
+        def __repr__(self):
+            return f"<f'Contact {self.contact} of {self.user}'>"
+
+    # Истина, если классы таблиц уже отображены
+    mapped = False
 
-    def __init__(self):
-        # Подключение к БД
-        self.engine = create_engine(SERVER_DB, echo=False, pool_recycle=7200)
+    def __init__(self, db_url=SERVER_DB, shared=False):
+        # Подключение к БД. Соединения с файлом SQLite по умолчанию не переиспользуются (каждая транзакция открывает
+        # новое), поэтому для него включаем пул; соединение пула в каждый момент использует только один поток.
+        url = make_url(db_url)
+        if url.get_backend_name() == 'sqlite' and url.database not in (None, '', ':memory:'):
+            self.engine = create_engine(db_url, echo=False, pool_recycle=7200, poolclass=QueuePool,
+                                        connect_args={'check_same_thread': False})
+        else:
+            self.engine = create_engine(db_url, echo=False, pool_recycle=7200)
+        # для SQLite включаем журнал WAL: запись не блокирует чтение, а фиксация транзакции дешевле
+        if self.engine.dialect.name == 'sqlite':
+            event.listen(self.engine, 'connect', self.set_sqlite_pragmas)
 
         self.metadata = MetaData()
 
@@ -62,70 +525,187 @@ class ServerStorage:
                                    Column('login_time', DateTime)
                                    )
 
-        # таблица истории входов пользователей
+        # таблица истории входов пользователей, индексирована по пользователю и времени входа
         user_login_history = Table('Login_history', self.metadata,
                                    Column('id', Integer, primary_key=True),
                                    Column('user', ForeignKey('Users.id')),
                                    Column('date_time', DateTime),
                                    Column('ip_address', String(50), nullable=False),
-                                   Column('port', Integer, nullable=False)
+                                   Column('port', Integer, nullable=False),
+                                   Index('ix_login_history_user_date_time', 'user', 'date_time', 'id'),
+                                   Index('ix_login_history_date_time', 'date_time', 'id')
                                    )
 
+        # таблица сообщений, ожидающих доставки, индексирована по получателю
+        stored_messages_table = Table('Stored_messages', self.metadata,
+                                      Column('id', Integer, primary_key=True),
+                                      Column('user', ForeignKey('Users.id'), index=True),
+                                      Column('date_time', DateTime),
+                                      Column('message', Text, nullable=False)
+                                      )
+
+        # таблица групп
+        groups_table = Table('Groups', self.metadata,
+                             Column('id', Integer, primary_key=True),
+                             Column('name', String(50), unique=True, nullable=False)
+                             )
+
+        # таблица участников групп, пользователь входит в группу не более одного раза
+        group_members_table = Table('Group_members', self.metadata,
+                                    Column('id', Integer, primary_key=True),
+                                    Column('group', ForeignKey('Groups.id'), nullable=False),
+                                    Column('user', ForeignKey('Users.id'), nullable=False),
+                                    Index('ix_group_members_group_user', 'group', 'user', unique=True)
+                                    )
+
+        # таблица контактов, контакт входит в список пользователя не более одного раза
+        contacts_table = Table('Contacts', self.metadata,
+                               Column('id', Integer, primary_key=True),
+                               Column('user', ForeignKey('Users.id'), nullable=False),
+                               Column('contact', ForeignKey('Users.id'), nullable=False),
+                               Index('ix_contacts_user_contact', 'user', 'contact', unique=True)
+                               )
+
         # внесение изменений в БД
         self.metadata.create_all(self.engine)
+        # индексы таблиц, созданных до их появления, create_all не добавляет
+        for index in user_login_history.indexes:
+            index.create(self.engine, checkfirst=True)
 
-        # настройка отображений
-        mapper(self.AllUsers, users_table)
-        mapper(self.ActiveUsers, active_users_table)
-        mapper(self.LoginHistory, user_login_history)
+        # настройка отображений. Класс отображается на таблицу один раз за процесс, таблицы следующих экземпляров
+        # хранилища (например, с другой БД) совпадают с ними.
+        if not ServerStorage.mapped:
+            mapper(self.AllUsers, users_table)
+            mapper(self.ActiveUsers, active_users_table)
+            mapper(self.LoginHistory, user_login_history)
+            mapper(self.StoredMessage, stored_messages_table)
+            mapper(self.Group, groups_table)
+            mapper(self.GroupMember, group_members_table)
+            mapper(self.Contact, contacts_table)
+            ServerStorage.mapped = True
 
-        # создание сессии
+        # создание сессий: sess_obj выдаёт каждому потоку его собственную сессию
         self.session = sessionmaker(bind=self.engine)
-        self.sess_obj = self.session()
+        self.sess_obj = scoped_session(self.session)
+
+        super().__init__(shared)
+
+    @staticmethod
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.close()
+
+    # первые limit пользователей для заполнения кэша: (имя, id, время последнего входа)
+    def load_users(self, session, limit):
+        return session.query(self.AllUsers.name, self.AllUsers.id, self.AllUsers.last_login).limit(limit).all()
+
+    # состав групп из БД
+    def load_groups(self, session):
+        groups = {group.name: set() for group in session.query(self.Group.name)}
+        for group, user in session.query(self.Group.name, self.AllUsers.name).select_from(
+                self.GroupMember).join(self.Group).join(self.AllUsers):
+            groups[group].add(user)
+        return groups
+
+    # пары (пользователь, контакт) из БД
+    def load_contacts(self, session):
+        contact_user = aliased(self.AllUsers)
+        return session.query(self.AllUsers.name, contact_user.name).select_from(self.Contact).join(
+            self.AllUsers, self.Contact.user == self.AllUsers.id).join(
+            contact_user, self.Contact.contact == contact_user.id).all()
+
+    # сессия текущего потока
+    def thread_session(self):
+        return self.sess_obj()
+
+    # Начало транзакции снимка. Драйвер sqlite3 сам открывает транзакцию только перед изменением данных, поэтому для
+    # SQLite она начинается явно; в других БД снимок даёт транзакция сессии на уровне изоляции БД.
+    def begin_snapshot(self, session):
+        if self.engine.dialect.name == 'sqlite':
+            session.execute(text('BEGIN'))
+
+    def close_sessions(self):
+        self.sess_obj.remove()
+        self.engine.dispose()
+
+    # очистка таблицы пользователей онлайн при запуске сервера
+    def reset_active_users(self):
         self.sess_obj.query(self.ActiveUsers).delete()
         self.sess_obj.commit()
 
-    # запись входа пользователя в БД
-    def user_login(self, username, ip_address, port):
-        print(username, ip_address, port)
-        # проверка на существование пользователя
-        rez = self.sess_obj.query(self.AllUsers).filter_by(name=username)
+    # (id, время последнего входа) пользователя из БД или None
+    def find_user(self, session, username):
+        user = session.query(self.AllUsers.id, self.AllUsers.last_login).filter_by(name=username).first()
+        return None if user is None else (user.id, user.last_login)
+
+    # применение события входа пользователя
+    def apply_login(self, session, username, ip_address, port, login_time):
+        user_id = self.user_id(session, username)
         # пользователь существует - обновить время последнего входа
-        if rez.count():
-            user = rez.first()
-            user.last_login = datetime.datetime.now()
+        if user_id is not None:
+            session.query(self.AllUsers).filter_by(id=user_id).update(
+                {self.AllUsers.last_login: login_time}, synchronize_session=False)
         # пользователя не существует - создать нового пользователя
         else:
             user = self.AllUsers(username)
-            self.sess_obj.add(user)
-            self.sess_obj.commit()
+            user.last_login = login_time
+            session.add(user)
+            session.flush()
+            user_id = user.id
+        self.users_cache.put(username, user_id, login_time)
 
-        # создать запись в таблицу активных пользователей
-        new_active_user = self.ActiveUsers(user.id, ip_address, port, datetime.datetime.now())
-        self.sess_obj.add(new_active_user)
+        # создать запись в таблицу активных пользователей, заменив оставшуюся от прежнего подключения
+        session.query(self.ActiveUsers).filter_by(user=user_id).delete(synchronize_session=False)
+        new_active_user = self.ActiveUsers(user_id, ip_address, port, login_time)
+        session.add(new_active_user)
 
         # сохранить время входа в историю
-        new_login = self.LoginHistory(user.id, datetime.datetime.now(), ip_address, port)
-        self.sess_obj.add(new_login)
+        new_login = self.LoginHistory(user_id, login_time, ip_address, port)
+        session.add(new_login)
 
-        self.sess_obj.commit()
+    # применение события выхода пользователя
+    def apply_logout(self, session, username):
+        # находим нужного пользователя и удаляем его из таблицы пользователей онлайн
+        user_id = self.user_id(session, username)
+        session.query(self.ActiveUsers).filter_by(user=user_id).delete(synchronize_session=False)
 
-    # запись выхода пользователя в БД
-    def user_logout(self, username):
-        # находим нужного пользователя
-        user = self.sess_obj.query(self.AllUsers).filter_by(name=username).first()
-        # удаляем его из таблицы пользователей онлайн
-        self.sess_obj.query(self.ActiveUsers).filter_by(user=user.id).delete()
-        self.sess_obj.commit()
+    # применение события создания группы
+    def apply_create_group(self, session, username, group):
+        new_group = self.Group(group)
+        session.add(new_group)
+        session.flush()
+        session.add(self.GroupMember(new_group.id, self.user_id(session, username)))
 
-    # список всех пользователей со временем последнего входа
-    def users_list(self):
-        query = self.sess_obj.query(self.AllUsers.name, self.AllUsers.last_login)
+    # применение события вступления в группу
+    def apply_join_group(self, session, username, group):
+        group_id = session.query(self.Group.id).filter_by(name=group).scalar()
+        session.add(self.GroupMember(group_id, self.user_id(session, username)))
+
+    # применение события выхода из группы
+    def apply_leave_group(self, session, username, group):
+        group_id = session.query(self.Group.id).filter_by(name=group).scalar()
+        session.query(self.GroupMember).filter_by(group=group_id, user=self.user_id(session, username)).delete(
+            synchronize_session=False)
+
+    # применение события добавления контакта
+    def apply_add_contact(self, session, username, contact):
+        session.add(self.Contact(self.user_id(session, username), self.user_id(session, contact)))
+
+    # применение события удаления контакта
+    def apply_remove_contact(self, session, username, contact):
+        session.query(self.Contact).filter_by(user=self.user_id(session, username),
+                                              contact=self.user_id(session, contact)).delete(synchronize_session=False)
+
+    # список всех пользователей со временем последнего входа из БД
+    def query_users(self, session):
+        query = session.query(self.AllUsers.name, self.AllUsers.last_login)
         return query.all()
 
-    # список активных пользователей
-    def active_users_list(self):
-        query = self.sess_obj.query(
+    # список активных пользователей из БД
+    def query_active_users(self, session):
+        query = session.query(
             self.AllUsers.name,
             self.ActiveUsers.ip_address,
             self.ActiveUsers.port,
@@ -133,32 +713,346 @@ class ServerStorage:
         ).join(self.AllUsers)
         return query.all()
 
-    # список истории входов
-    def login_history(self, username=None):
-        query = self.sess_obj.query(
+    # история входов из БД, параметры - как у login_history, вместо имени - id пользователя
+    def query_history(self, session, user_id, date_from, date_to, limit, after):
+        query = session.query(
             self.AllUsers.name,
             self.LoginHistory.date_time,
             self.LoginHistory.ip_address,
-            self.LoginHistory.port
+            self.LoginHistory.port,
+            self.LoginHistory.id
         ).join(self.AllUsers)
-        # фильтрация, ксли задано имя
-        if username:
-            query = query.filter(self.AllUsers.name == username)
+        if user_id is not None:
+            query = query.filter(self.LoginHistory.user == user_id)
+        if date_from:
+            query = query.filter(self.LoginHistory.date_time >= date_from)
+        if date_to:
+            query = query.filter(self.LoginHistory.date_time < date_to)
+        if after:
+            query = query.filter(or_(
+                self.LoginHistory.date_time > after[0],
+                and_(self.LoginHistory.date_time == after[0], self.LoginHistory.id > after[1])
+            ))
+        query = query.order_by(self.LoginHistory.date_time, self.LoginHistory.id)
+        if limit:
+            query = query.limit(limit)
         return query.all()
 
+    # запись сообщений, ожидающих доставки; транзакцию фиксирует поток записи
+    def insert_messages(self, session, user_id, date_time, messages):
+        session.add_all([self.StoredMessage(user_id, date_time, message) for message in messages])
+
+    # пачка (id, сообщение) после last_id
+    def select_messages(self, session, user_id, last_id, batch_size):
+        return session.query(self.StoredMessage.id, self.StoredMessage.message).filter(
+            self.StoredMessage.user == user_id,
+            self.StoredMessage.id > last_id
+        ).order_by(self.StoredMessage.id).limit(batch_size).all()
+
+    def delete_messages(self, session, message_ids):
+        session.query(self.StoredMessage).filter(
+            self.StoredMessage.id.in_(message_ids)).delete(synchronize_session=False)
+
+
+# Время в формате, в котором его хранит SQLAlchemy: файлы БД обоих хранилищ взаимозаменяемы, а строки времени
+# сравниваются в запросах как строки.
+def format_time(value):
+    return None if value is None else value.strftime('%Y-%m-%d %H:%M:%S.%f')
+
+
+def parse_time(value):
+    return None if value is None else datetime.datetime.fromisoformat(value)
+
+
+# Путь к файлу БД из адреса SQLAlchemy вида sqlite:///путь
+def sqlite_path(db_url):
+    prefix = 'sqlite:///'
+    if not db_url.startswith(prefix) or len(db_url) == len(prefix):
+        raise ValueError(f'Хранилище {STORAGE_SQLITE} работает только с файлом БД SQLite, адрес: {db_url}')
+    return db_url[len(prefix):].split('?')[0]
+
+
+# Сессия хранилища на sqlite3: соединение и строки, накопленные событиями пачки. Строки входов и выходов
+# записываются при фиксации через executemany - по одному выполнению подготовленного запроса на таблицу.
+class SqliteSession:
+    def __init__(self, connection):
+        self.connection = connection
+        # id пользователя -> время последнего входа
+        self.last_logins = dict()
+        # id пользователя -> (адрес, порт, время входа) или None после выхода; в таблицу пользователей онлайн
+        # попадает последнее событие пачки
+        self.active = dict()
+        # строки истории входов
+        self.history = []
+
+    def execute(self, sql, parameters=()):
+        return self.connection.execute(sql, parameters)
+
+    def commit(self):
+        if self.last_logins:
+            self.connection.executemany(SqliteStorage.UPDATE_LAST_LOGIN, [
+                (login_time, user_id) for user_id, login_time in self.last_logins.items()])
+        if self.active:
+            self.connection.executemany(SqliteStorage.DELETE_ACTIVE, [(user_id,) for user_id in self.active])
+            self.connection.executemany(SqliteStorage.INSERT_ACTIVE, [
+                (user_id,) + row for user_id, row in self.active.items() if row is not None])
+        if self.history:
+            self.connection.executemany(SqliteStorage.INSERT_HISTORY, self.history)
+        self.connection.commit()
+        self.clear()
+
+    def rollback(self):
+        self.clear()
+        self.connection.rollback()
+
+    def clear(self):
+        self.last_logins.clear()
+        self.active.clear()
+        self.history.clear()
+
+    def close(self):
+        self.connection.close()
+
+
+# Хранилище на модуле sqlite3 без ORM: запросы - постоянные строки, их подготовленные выражения берутся из кэша
+# соединения, строки результатов - кортежи. Схема совпадает со схемой ServerStorage. У каждого потока своё
+# соединение.
+class SqliteStorage(Storage):
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS "Users" (
+            id INTEGER NOT NULL, name VARCHAR(50) NOT NULL, last_login DATETIME,
+            PRIMARY KEY (id), UNIQUE (name));
+        CREATE TABLE IF NOT EXISTS "Active_users" (
+            id INTEGER NOT NULL, user INTEGER, ip_address VARCHAR(50) NOT NULL, port INTEGER NOT NULL,
+            login_time DATETIME,
+            PRIMARY KEY (id), UNIQUE (user), FOREIGN KEY(user) REFERENCES "Users" (id));
+        CREATE TABLE IF NOT EXISTS "Login_history" (
+            id INTEGER NOT NULL, user INTEGER, date_time DATETIME, ip_address VARCHAR(50) NOT NULL,
+            port INTEGER NOT NULL,
+            PRIMARY KEY (id), FOREIGN KEY(user) REFERENCES "Users" (id));
+        CREATE INDEX IF NOT EXISTS ix_login_history_user_date_time ON "Login_history" (user, date_time, id);
+        CREATE INDEX IF NOT EXISTS ix_login_history_date_time ON "Login_history" (date_time, id);
+        CREATE TABLE IF NOT EXISTS "Stored_messages" (
+            id INTEGER NOT NULL, user INTEGER, date_time DATETIME, message TEXT NOT NULL,
+            PRIMARY KEY (id), FOREIGN KEY(user) REFERENCES "Users" (id));
+        CREATE INDEX IF NOT EXISTS "ix_Stored_messages_user" ON "Stored_messages" (user);
+        CREATE TABLE IF NOT EXISTS "Groups" (
+            id INTEGER NOT NULL, name VARCHAR(50) NOT NULL,
+            PRIMARY KEY (id), UNIQUE (name));
+        CREATE TABLE IF NOT EXISTS "Group_members" (
+            id INTEGER NOT NULL, "group" INTEGER NOT NULL, user INTEGER NOT NULL,
+            PRIMARY KEY (id), FOREIGN KEY("group") REFERENCES "Groups" (id), FOREIGN KEY(user) REFERENCES "Users" (id));
+        CREATE UNIQUE INDEX IF NOT EXISTS ix_group_members_group_user ON "Group_members" ("group", user);
+        CREATE TABLE IF NOT EXISTS "Contacts" (
+            id INTEGER NOT NULL, user INTEGER NOT NULL, contact INTEGER NOT NULL,
+            PRIMARY KEY (id), FOREIGN KEY(user) REFERENCES "Users" (id), FOREIGN KEY(contact) REFERENCES "Users" (id));
+        CREATE UNIQUE INDEX IF NOT EXISTS ix_contacts_user_contact ON "Contacts" (user, contact);
+    '''
+    SELECT_USERS = 'SELECT name, id, last_login FROM "Users" LIMIT ?'
+    SELECT_USER = 'SELECT id, last_login FROM "Users" WHERE name = ?'
+    SELECT_USER_NAMES = 'SELECT name, last_login FROM "Users"'
+    INSERT_USER = 'INSERT INTO "Users" (name, last_login) VALUES (?, ?)'
+    UPDATE_LAST_LOGIN = 'UPDATE "Users" SET last_login = ? WHERE id = ?'
+    DELETE_ACTIVE = 'DELETE FROM "Active_users" WHERE user = ?'
+    DELETE_ALL_ACTIVE = 'DELETE FROM "Active_users"'
+    INSERT_ACTIVE = 'INSERT INTO "Active_users" (user, ip_address, port, login_time) VALUES (?, ?, ?, ?)'
+    SELECT_ACTIVE = 'SELECT u.name, a.ip_address, a.port, a.login_time FROM "Active_users" a ' \
+                    'JOIN "Users" u ON u.id = a.user'
+    INSERT_HISTORY = 'INSERT INTO "Login_history" (user, date_time, ip_address, port) VALUES (?, ?, ?, ?)'
+    SELECT_GROUPS = 'SELECT name FROM "Groups"'
+    SELECT_GROUP_MEMBERS = 'SELECT g.name, u.name FROM "Group_members" m ' \
+                           'JOIN "Groups" g ON g.id = m."group" JOIN "Users" u ON u.id = m.user'
+    SELECT_CONTACTS = 'SELECT u.name, c.name FROM "Contacts" k ' \
+                      'JOIN "Users" u ON u.id = k.user JOIN "Users" c ON c.id = k.contact'
+    INSERT_CONTACT = 'INSERT INTO "Contacts" (user, contact) VALUES (?, ?)'
+    DELETE_CONTACT = 'DELETE FROM "Contacts" WHERE user = ? AND contact = ?'
+    SELECT_GROUP = 'SELECT id FROM "Groups" WHERE name = ?'
+    INSERT_GROUP = 'INSERT INTO "Groups" (name) VALUES (?)'
+    INSERT_MEMBER = 'INSERT INTO "Group_members" ("group", user) VALUES (?, ?)'
+    DELETE_MEMBER = 'DELETE FROM "Group_members" WHERE "group" = ? AND user = ?'
+    INSERT_MESSAGE = 'INSERT INTO "Stored_messages" (user, date_time, message) VALUES (?, ?, ?)'
+    SELECT_MESSAGES = 'SELECT id, message FROM "Stored_messages" WHERE user = ? AND id > ? ORDER BY id LIMIT ?'
+    DELETE_MESSAGE = 'DELETE FROM "Stored_messages" WHERE id = ?'
+    # Количество подготовленных выражений в кэше соединения: все постоянные запросы и варианты запроса истории
+    CACHED_STATEMENTS = 64
+
+    def __init__(self, db_url=SERVER_DB, shared=False):
+        self.path = sqlite_path(db_url)
+        # сессия каждого потока и список всех сессий для закрытия
+        self.thread_sessions = threading.local()
+        self.sessions = []
+        self.sessions_lock = threading.Lock()
+        self.thread_session().connection.executescript(self.SCHEMA)
+        super().__init__(shared)
+
+    # Сессия текущего потока, при первом обращении потока открывается его соединение. Соединение используется
+    # только своим потоком, но закрывается при закрытии хранилища из другого.
+    def thread_session(self):
+        session = getattr(self.thread_sessions, 'session', None)
+        if session is None:
+            connection = sqlite3.connect(self.path, check_same_thread=False,
+                                         cached_statements=self.CACHED_STATEMENTS)
+            # журнал WAL: запись не блокирует чтение, а фиксация транзакции дешевле
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            session = self.thread_sessions.session = SqliteSession(connection)
+            with self.sessions_lock:
+                self.sessions.append(session)
+        return session
+
+    # модуль sqlite3 сам открывает транзакцию только перед изменением данных, транзакция снимка начинается явно
+    def begin_snapshot(self, session):
+        session.execute('BEGIN')
+
+    def close_sessions(self):
+        with self.sessions_lock:
+            for session in self.sessions:
+                session.close()
+            self.sessions.clear()
+        self.thread_sessions = threading.local()
+
+    # первые limit пользователей для заполнения кэша: (имя, id, время последнего входа)
+    def load_users(self, session, limit):
+        return [(name, user_id, parse_time(last_login))
+                for name, user_id, last_login in session.execute(self.SELECT_USERS, (limit,))]
+
+    # состав групп из БД
+    def load_groups(self, session):
+        groups = {name: set() for name, in session.execute(self.SELECT_GROUPS)}
+        for group, user in session.execute(self.SELECT_GROUP_MEMBERS):
+            groups[group].add(user)
+        return groups
+
+    # пары (пользователь, контакт) из БД
+    def load_contacts(self, session):
+        return session.execute(self.SELECT_CONTACTS).fetchall()
+
+    # очистка таблицы пользователей онлайн при запуске сервера
+    def reset_active_users(self):
+        session = self.thread_session()
+        session.execute(self.DELETE_ALL_ACTIVE)
+        session.commit()
+
+    # (id, время последнего входа) пользователя из БД или None
+    def find_user(self, session, username):
+        row = session.execute(self.SELECT_USER, (username,)).fetchone()
+        return None if row is None else (row[0], parse_time(row[1]))
+
+    # применение события входа пользователя: новый пользователь создаётся сразу (нужен его id), остальные строки
+    # накапливаются в сессии до фиксации пачки
+    def apply_login(self, session, username, ip_address, port, login_time):
+        user_id = self.user_id(session, username)
+        stamp = format_time(login_time)
+        if user_id is not None:
+            session.last_logins[user_id] = stamp
+        else:
+            user_id = session.execute(self.INSERT_USER, (username, stamp)).lastrowid
+        self.users_cache.put(username, user_id, login_time)
+        session.active[user_id] = (ip_address, port, stamp)
+        session.history.append((user_id, stamp, ip_address, port))
+
+    # применение события выхода пользователя
+    def apply_logout(self, session, username):
+        user_id = self.user_id(session, username)
+        if user_id is not None:
+            session.active[user_id] = None
+
+    # применение события создания группы
+    def apply_create_group(self, session, username, group):
+        group_id = session.execute(self.INSERT_GROUP, (group,)).lastrowid
+        session.execute(self.INSERT_MEMBER, (group_id, self.user_id(session, username)))
+
+    # применение события вступления в группу
+    def apply_join_group(self, session, username, group):
+        group_id = session.execute(self.SELECT_GROUP, (group,)).fetchone()
+        session.execute(self.INSERT_MEMBER, (group_id and group_id[0], self.user_id(session, username)))
+
+    # применение события выхода из группы
+    def apply_leave_group(self, session, username, group):
+        group_id = session.execute(self.SELECT_GROUP, (group,)).fetchone()
+        session.execute(self.DELETE_MEMBER, (group_id and group_id[0], self.user_id(session, username)))
+
+    # применение события добавления контакта
+    def apply_add_contact(self, session, username, contact):
+        session.execute(self.INSERT_CONTACT, (self.user_id(session, username), self.user_id(session, contact)))
+
+    # применение события удаления контакта
+    def apply_remove_contact(self, session, username, contact):
+        session.execute(self.DELETE_CONTACT, (self.user_id(session, username), self.user_id(session, contact)))
+
+    # список всех пользователей со временем последнего входа из БД
+    def query_users(self, session):
+        return [(name, parse_time(last_login)) for name, last_login in session.execute(self.SELECT_USER_NAMES)]
+
+    # список активных пользователей из БД
+    def query_active_users(self, session):
+        return [(name, ip_address, port, parse_time(login_time))
+                for name, ip_address, port, login_time in session.execute(self.SELECT_ACTIVE)]
+
+    # история входов из БД, параметры - как у login_history, вместо имени - id пользователя. Текст запроса зависит
+    # только от набора заданных условий, поэтому вариантов немного и все они остаются в кэше подготовленных выражений.
+    def query_history(self, session, user_id, date_from, date_to, limit, after):
+        conditions = []
+        parameters = []
+        if user_id is not None:
+            conditions.append('h.user = ?')
+            parameters.append(user_id)
+        if date_from:
+            conditions.append('h.date_time >= ?')
+            parameters.append(format_time(date_from))
+        if date_to:
+            conditions.append('h.date_time < ?')
+            parameters.append(format_time(date_to))
+        if after:
+            conditions.append('(h.date_time, h.id) > (?, ?)')
+            parameters.extend((format_time(after[0]), after[1]))
+        sql = 'SELECT u.name, h.date_time, h.ip_address, h.port, h.id FROM "Login_history" h ' \
+              'JOIN "Users" u ON u.id = h.user'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY h.date_time, h.id LIMIT ?'
+        parameters.append(limit or -1)
+        return [(name, parse_time(date_time), ip_address, port, login_id)
+                for name, date_time, ip_address, port, login_id in session.execute(sql, parameters)]
+
+    # запись сообщений, ожидающих доставки; транзакцию фиксирует поток записи
+    def insert_messages(self, session, user_id, date_time, messages):
+        stamp = format_time(date_time)
+        session.connection.executemany(self.INSERT_MESSAGE, [(user_id, stamp, message) for message in messages])
+
+    # пачка (id, сообщение) после last_id
+    def select_messages(self, session, user_id, last_id, batch_size):
+        return session.execute(self.SELECT_MESSAGES, (user_id, last_id, batch_size)).fetchall()
+
+    def delete_messages(self, session, message_ids):
+        session.connection.executemany(self.DELETE_MESSAGE, [(message_id,) for message_id in message_ids])
+
+
+# Хранилища по названиям, выбор - STORAGE_BACKEND в common/variables.py
+STORAGES = {STORAGE_SQLALCHEMY: ServerStorage, STORAGE_SQLITE: SqliteStorage}
+
+
+# создание хранилища выбранного типа
+def create_storage(db_url=SERVER_DB, shared=False, backend=STORAGE_BACKEND):
+    return STORAGES[backend](db_url, shared)
+
 
 if __name__ == '__main__':
-    db = ServerStorage()
+    db = create_storage()
     # подключаем пользователей
     db.user_login('user1', '192.168.0.1', 4321)
     db.user_login('user2', '192.168.0.2', 4322)
+    # дожидаемся записи событий
+    db.flush()
     # выводим список активных пользователей
     print(db.active_users_list())
     # отключаем одного пользователя
     db.user_logout('user1')
+    db.flush()
     # выводим список активных пользователей
     print(db.active_users_list())
     # смотрим историю входов пользователя
     db.login_history('user1')
     # выводим список всех пользователей
     print(db.users_list())
+    db.close()
@@ -0,0 +1,206 @@
+import time
+import logging
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger('server')
+
+# Границы корзин гистограмм времени, в секундах
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+# Префикс имён метрик в текстовом формате Prometheus
+PREFIX = 'server_'
+
+
+# Формирование строки меток в формате Prometheus
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+# Счётчик - только возрастает.
+class Counter:
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+# Текущее значение. Может задаваться явно или вычисляться функцией при чтении.
+class Gauge:
+    kind = 'gauge'
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        return self.function() if self.function else self.value
+
+
+# Гистограмма: количество наблюдений по корзинам, их число и сумма.
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    # Замер времени выполнения блока with
+    def time(self):
+        return HistogramTimer(self)
+
+    # Оценка квантиля по корзинам: верхняя граница корзины, в которую попадает квантиль
+    def quantile(self, fraction):
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return float('inf')
+
+
+class HistogramTimer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+# Реестр метрик сервера. Метрика определяется именем и набором меток, при первом обращении создаётся.
+# Каждую метрику изменяет один поток, читать можно из любого.
+class Metrics:
+    def __init__(self):
+        self.metrics = dict()
+        self.help = dict()
+        self.lock = threading.Lock()
+        # Значения счётчиков и время при предыдущем расчёте скоростей
+        self.last_values = dict()
+        self.last_time = time.monotonic()
+
+    def get(self, metric_class, name, help_text, labels):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.setdefault(key, metric_class())
+                self.help.setdefault(name, help_text)
+        return metric
+
+    def counter(self, name, help_text='', **labels):
+        return self.get(Counter, name, help_text, labels)
+
+    def gauge(self, name, help_text='', **labels):
+        return self.get(Gauge, name, help_text, labels)
+
+    def histogram(self, name, help_text='', **labels):
+        return self.get(Histogram, name, help_text, labels)
+
+    # Скорости счётчиков в секунду с предыдущего вызова
+    def rates(self):
+        now = time.monotonic()
+        elapsed = max(now - self.last_time, 1e-9)
+        rates = dict()
+        for key, metric in list(self.metrics.items()):
+            if metric.kind == 'counter':
+                rates[key] = (metric.value - self.last_values.get(key, 0)) / elapsed
+                self.last_values[key] = metric.value
+        self.last_time = now
+        return rates
+
+    # Сводка для консоли администратора
+    def summary(self):
+        rates = self.rates()
+        lines = []
+        for (name, labels), metric in sorted(self.metrics.items()):
+            title = name + format_labels(labels)
+            if metric.kind == 'counter':
+                lines.append(f'{title}: {metric.value} ({rates[(name, labels)]:.1f}/с)')
+            elif metric.kind == 'gauge':
+                lines.append(f'{title}: {metric.get()}')
+            elif metric.count:
+                lines.append(f'{title}: {metric.count} замеров, среднее {metric.sum / metric.count * 1000:.3f} мс, '
+                             f'p50 <= {metric.quantile(0.5) * 1000:g} мс, p99 <= {metric.quantile(0.99) * 1000:g} мс')
+        return lines
+
+    # Все метрики в текстовом формате Prometheus
+    def render(self):
+        lines = []
+        described = set()
+        for (name, labels), metric in sorted(self.metrics.items()):
+            full_name = PREFIX + name
+            if name not in described:
+                described.add(name)
+                if self.help.get(name):
+                    lines.append(f'# HELP {full_name} {self.help[name]}')
+                lines.append(f'# TYPE {full_name} {metric.kind}')
+            if metric.kind == 'counter':
+                lines.append(f'{full_name}{format_labels(labels)} {metric.value}')
+            elif metric.kind == 'gauge':
+                lines.append(f'{full_name}{format_labels(labels)} {metric.get()}')
+            else:
+                total = 0
+                for bound, count in zip(metric.buckets + ('+Inf',), metric.counts):
+                    total += count
+                    lines.append(f'{full_name}_bucket{format_labels(labels + (("le", bound),))} {total}')
+                lines.append(f'{full_name}_sum{format_labels(labels)} {metric.sum}')
+                lines.append(f'{full_name}_count{format_labels(labels)} {metric.count}')
+        return '\n'.join(lines) + '\n'
+
+
+# Общий реестр метрик процесса сервера
+METRICS = Metrics()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = METRICS.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # запросы к метрикам не пишем в лог
+    def log_message(self, format, *args):
+        pass
+
+
+# Запуск HTTP сервера метрик (GET /metrics) в отдельном потоке на локальном адресе. Если порт занят (например,
+# другим сервером на этом же компьютере), метрики не выдаются, а сервер продолжает работу: возвращается None.
+def start_metrics_server(port, address='127.0.0.1'):
+    try:
+        http_server = ThreadingHTTPServer((address, port), MetricsHandler)
+    except OSError as error:
+        logger.error(f'Не удалось запустить выдачу метрик на порту {port}: {error}')
+        return None
+    thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+    thread.start()
+    logger.info(f'Метрики сервера доступны по адресу http://{address}:{port}/metrics')
+    return http_server
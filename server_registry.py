@@ -0,0 +1,99 @@
+import selectors
+import time
+
+
+# Состояние одного подключения к серверу. Атрибуты объявлены в __slots__, чтобы простаивающее подключение
+# занимало как можно меньше памяти: буфер исходящих данных и декодер кадров создаются только при необходимости.
+class Session:
+    __slots__ = ('sock', 'fd', 'name', 'decoder', 'outbound', 'resume', 'connected', 'active', 'pinged', 'peer')
+
+    def __init__(self, sock):
+        self.sock = sock
+        # Номер дескриптора запоминается при подключении: у закрытого сокета fileno() возвращает -1
+        self.fd = sock.fileno()
+        # Имя пользователя, назначается после приветствия
+        self.name = None
+        # Декодер кадров, если клиент согласовал режим с префиксом длинны
+        self.decoder = None
+        # Буфер исходящих данных
+        self.outbound = None
+        # Состояние сессии для восстановления по токену
+        self.resume = None
+        # Время подключения и последнего получения данных от клиента
+        self.connected = self.active = time.monotonic()
+        # Время отправки клиенту ping, ответ на который ещё не получен, или None
+        self.pinged = None
+        # Номер процесса-обработчика сервера, если это канал связи с ним, а не подключение клиента
+        self.peer = None
+
+    # селекторы и цикл событий asyncio принимают объекты с методом fileno, поэтому сессию можно передавать им напрямую
+    def fileno(self):
+        return self.fd
+
+    def __repr__(self):
+        return f'<Session fd={self.fd} name={self.name}>'
+
+
+# Реестр подключений сервера: сессии по номеру дескриптора и по имени пользователя. Добавление, удаление
+# и поиск выполняются за O(1), имя и подключение хранятся в одном объекте и не могут рассогласоваться.
+# Если задан selector (selectors.BaseSelector), новые подключения регистрируются в нём на чтение, удалённые -
+# снимаются с регистрации, так что цикл сервера не собирает список сокетов на каждой итерации.
+class SessionRegistry:
+    def __init__(self, selector=None):
+        self.by_fd = dict()
+        self.by_name = dict()
+        self.selector = selector
+
+    # Регистрация нового подключения, возвращает его сессию.
+    def add(self, sock):
+        session = Session(sock)
+        self.by_fd[session.fd] = session
+        if self.selector is not None:
+            self.selector.register(session, selectors.EVENT_READ, session)
+        return session
+
+    # Удаление сессии из реестра, повторное удаление ничего не делает.
+    def remove(self, session):
+        if self.by_fd.get(session.fd) is session:
+            del self.by_fd[session.fd]
+            self.watch(session, 0)
+        if session.name is not None and self.by_name.get(session.name) is session:
+            del self.by_name[session.name]
+
+    # Изменение событий (selectors.EVENT_READ, EVENT_WRITE), которых селектор ждёт от сессии. Без событий сессия
+    # снимается с регистрации в селекторе, но остаётся в реестре.
+    def watch(self, session, events):
+        if self.selector is None:
+            return
+        registered = session in self.selector.get_map()
+        if not events:
+            if registered:
+                self.selector.unregister(session)
+        elif registered:
+            self.selector.modify(session, events, session)
+        else:
+            self.selector.register(session, events, session)
+
+    # Назначение сессии имени пользователя
+    def bind(self, session, name):
+        if session.name is not None and self.by_name.get(session.name) is session:
+            del self.by_name[session.name]
+        session.name = name
+        self.by_name[name] = session
+
+    # Сессия по номеру дескриптора или None
+    def get(self, fd):
+        return self.by_fd.get(fd)
+
+    # Сессия пользователя по имени или None
+    def find(self, name):
+        return self.by_name.get(name)
+
+    def __contains__(self, session):
+        return self.by_fd.get(session.fd) is session
+
+    def __iter__(self):
+        return iter(self.by_fd.values())
+
+    def __len__(self):
+        return len(self.by_fd)
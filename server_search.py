@@ -0,0 +1,377 @@
+import bisect
+import logging
+import math
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from array import array
+from common.variables import *
+
+logger = logging.getLogger('server')
+
+# Слова текста сообщения: последовательности букв и цифр
+WORD = re.compile(r'\w+')
+# Префикс служебных термов участников переписки. Слова текста его не содержат, поэтому участник не совпадёт
+# со словом сообщения.
+PARTICIPANT = '\x00'
+
+
+# Разбиение текста на термы индекса: слова в нижнем регистре без повторов.
+def tokenize(text):
+    return {word for word in WORD.findall(str(text).lower()) if len(word) <= SEARCH_MAX_TERM_LENGTH}
+
+
+# Неизменяемый сегмент инвертированного индекса на диске. Файл: заголовок, словарь термов (длинна терма,
+# количество документов, смещение списка документов) и списки документов - позиций сообщений в архиве по
+# возрастанию (массивы 8-байтовых чисел в порядке байт платформы). Словарь загружается в память, списки
+# документов читаются через mmap.
+class SearchSegment:
+    magic = b'JIMS'
+    # Заголовок: метка формата, количество термов, количество документов, первый и последний документ
+    header = struct.Struct('!4sIIQQ')
+    entry = struct.Struct('!HIQ')
+    # Размер номера документа в списках
+    item_size = array('Q').itemsize
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            self.mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, self.docs, self.first, self.last = self.header.unpack_from(self.mapping, 0)
+        if magic != self.magic:
+            self.mapping.close()
+            raise ValueError(f'{path} не является сегментом индекса')
+        self.terms = dict()
+        offset = self.header.size
+        for _ in range(count):
+            length, postings, position = self.entry.unpack_from(self.mapping, offset)
+            offset += self.entry.size
+            self.terms[self.mapping[offset:offset + length].decode(ENCODING)] = (position, postings)
+            offset += length
+        # Количество запросов, читающих сегмент, и признак того, что сегмент заменён объединённым: такой сегмент
+        # закрывается и удаляется, когда его дочитает последний запрос.
+        self.readers = 0
+        self.retired = False
+
+    # Количество документов терма в сегменте.
+    def count(self, term):
+        entry = self.terms.get(term)
+        return 0 if entry is None else entry[1]
+
+    # Список документов терма без копирования: представление mmap, по которому можно искать двоичным поиском,
+    # или None, если терма в сегменте нет. Представление нужно освободить (release) до закрытия сегмента.
+    def view(self, term):
+        entry = self.terms.get(term)
+        if entry is None:
+            return None
+        position, count = entry
+        return memoryview(self.mapping)[position:position + count * self.item_size].cast('Q')
+
+    # Копия списка документов терма или None, если терма в сегменте нет.
+    def postings(self, term):
+        entry = self.terms.get(term)
+        if entry is None:
+            return None
+        position, count = entry
+        result = array('Q')
+        result.frombytes(self.mapping[position:position + count * result.itemsize])
+        return result
+
+    # Запись сегмента из словаря терм -> массив документов. Файл пишется под временным именем и переименовывается,
+    # поэтому сегмент на диске всегда целый.
+    @classmethod
+    def write(cls, path, postings, docs, first, last):
+        terms = sorted(postings)
+        names = [term.encode(ENCODING) for term in terms]
+        offset = cls.header.size + sum(cls.entry.size + len(name) for name in names)
+        parts = [cls.header.pack(cls.magic, len(terms), docs, first, last)]
+        for term, name in zip(terms, names):
+            parts.append(cls.entry.pack(len(name), len(postings[term]), offset) + name)
+            offset += len(postings[term]) * postings[term].itemsize
+        with open(path + '.tmp', 'wb') as file:
+            file.write(b''.join(parts))
+            for term in terms:
+                file.write(postings[term].tobytes())
+        os.replace(path + '.tmp', path)
+        return cls(path)
+
+    def close(self):
+        self.mapping.close()
+
+
+# Инвертированный индекс архива сообщений для полнотекстового поиска. Документ - позиция сообщения в архиве,
+# термы - слова текста и участники переписки (по ним поиск ограничивается перепиской пользователя). Новые
+# сообщения архива раз в interval секунд дочитывает фоновый поток: декодирование и разбиение на слова не
+# задерживают поток сервера, который только пишет сообщения в архив. Они добавляются в сегмент в памяти, он
+# записывается на диск, когда наберёт segment_docs сообщений, и раз в SEARCH_FLUSH_INTERVAL. Когда накапливается
+# merge_factor сегментов одного уровня (уровень - логарифм количества документов по основанию merge_factor),
+# они объединяются в фоновом потоке, так что количество сегментов растёт логарифмически. При открытии индекс
+# дочитывает сообщения архива после последнего записанного на диск.
+class SearchIndex:
+    def __init__(self, archive, directory=None, segment_docs=SEARCH_SEGMENT_DOCS, merge_factor=SEARCH_MERGE_FACTOR,
+                 interval=SEARCH_INDEX_INTERVAL):
+        self.archive = archive
+        self.directory = directory or os.path.join(archive.directory, 'search')
+        self.segment_docs = segment_docs
+        self.merge_factor = merge_factor
+        self.interval = interval
+        os.makedirs(self.directory, exist_ok=True)
+        # Сегмент в памяти: терм -> массив документов, количество документов, первый и последний документ
+        self.memory = dict()
+        self.memory_docs = 0
+        self.memory_first = self.memory_last = None
+        # Сегменты на диске по возрастанию документов
+        self.segments = []
+        # Поток объединения сегментов, если он работает
+        self.compactor = None
+        # Сегменты меняет поток объединения, поэтому запросы и замена сегментов выполняются под блокировкой.
+        self.lock = threading.Lock()
+        self.flushed = time.monotonic()
+        # Поток, дочитывающий архив, и событие его остановки. Дочитывание выполняется одним потоком за раз.
+        self.indexer = None
+        self.stopped = threading.Event()
+        self.updating = threading.Lock()
+
+        numbers = [0]
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.tmp'):
+                os.remove(path)
+            elif name.endswith('.seg') and name[:-4].isdigit():
+                numbers.append(int(name[:-4]))
+                try:
+                    self.segments.append(SearchSegment(path))
+                except (ValueError, OSError, struct.error):
+                    os.remove(path)
+        self.sequence = max(numbers)
+        # Если процесс завершился между записью объединённого сегмента и удалением исходных, исходные покрыты
+        # объединённым и удаляются.
+        self.segments.sort(key=lambda segment: (segment.first, -segment.last))
+        for segment in list(self.segments):
+            covered = [other for other in self.segments if other.docs > segment.docs
+                       and other.first <= segment.first and segment.last <= other.last]
+            if covered:
+                self.segments.remove(segment)
+                segment.close()
+                os.remove(segment.path)
+
+        # Позиция в архиве последнего проиндексированного сообщения
+        self.position = self.segments[-1].last if self.segments else None
+        self.start()
+
+    # Запуск и остановка потока, дочитывающего архив. Перед передачей архива новому процессу сервера поток
+    # останавливается, чтобы индекс на диске не менялся.
+    def start(self):
+        if self.indexer is None:
+            self.stopped.clear()
+            self.indexer = threading.Thread(target=self.tail, daemon=True)
+            self.indexer.start()
+
+    def stop(self):
+        if self.indexer is not None:
+            self.stopped.set()
+            self.indexer.join()
+            self.indexer = None
+
+    def tail(self):
+        while True:
+            try:
+                self.update()
+            except OSError as error:
+                logger.error(f'Не удалось дочитать архив для индекса поиска: {error}')
+            if self.stopped.wait(self.interval):
+                return
+
+    # Добавление в индекс сообщений архива после последнего проиндексированного. Возвращает их количество.
+    def update(self):
+        count = 0
+        with self.updating:
+            for position, message in self.archive.records(self.position):
+                self.add(position, message)
+                self.position = position
+                count += 1
+        return count
+
+    # Добавление сообщения с позицией position в архиве.
+    def add(self, position, message):
+        terms = tokenize(message.get(MESSAGE_TEXT, ''))
+        terms.add(PARTICIPANT + str(message.get(SENDER)))
+        terms.add(PARTICIPANT + str(message.get(DESTINATION)))
+        with self.lock:
+            memory = self.memory
+            for term in terms:
+                postings = memory.get(term)
+                if postings is None:
+                    postings = memory[term] = array('Q')
+                postings.append(position)
+            if self.memory_first is None:
+                self.memory_first = position
+            self.memory_last = position
+            self.memory_docs += 1
+            if self.memory_docs >= self.segment_docs:
+                self.write_memory()
+
+    # Запись сегмента в памяти на диск, выполняется под блокировкой.
+    def write_memory(self):
+        self.flushed = time.monotonic()
+        if not self.memory_docs:
+            return
+        self.sequence += 1
+        self.segments.append(SearchSegment.write(os.path.join(self.directory, f'{self.sequence:08d}.seg'),
+                                                 self.memory, self.memory_docs, self.memory_first, self.memory_last))
+        self.memory = dict()
+        self.memory_docs = 0
+        self.memory_first = self.memory_last = None
+        self.start_compaction()
+
+    def level(self, segment):
+        return int(math.log(max(segment.docs, 1), self.merge_factor))
+
+    # Запуск объединения merge_factor идущих подряд сегментов одного уровня (самых новых из таких), если
+    # объединение ещё не идёт. Выполняется под блокировкой.
+    def start_compaction(self):
+        if self.compactor is not None:
+            return
+        for start in range(len(self.segments) - self.merge_factor, -1, -1):
+            merged = self.segments[start:start + self.merge_factor]
+            if len({self.level(segment) for segment in merged}) == 1:
+                break
+        else:
+            return
+        self.sequence += 1
+        path = os.path.join(self.directory, f'{self.sequence:08d}.seg')
+        self.compactor = threading.Thread(target=self.compact, args=(merged, path), daemon=True)
+        self.compactor.start()
+
+    # Объединение сегментов в фоновом потоке. Документы сегментов не пересекаются и идут по возрастанию, поэтому
+    # списки документов терма просто соединяются.
+    def compact(self, merged, path):
+        postings = dict()
+        for segment in merged:
+            for term in segment.terms:
+                part = postings.get(term)
+                if part is None:
+                    part = postings[term] = array('Q')
+                part.extend(segment.postings(term))
+        try:
+            result = SearchSegment.write(path, postings, sum(segment.docs for segment in merged),
+                                         merged[0].first, merged[-1].last)
+        except OSError as error:
+            logger.error(f'Не удалось объединить сегменты индекса поиска: {error}')
+            with self.lock:
+                self.compactor = None
+            return
+        with self.lock:
+            start = self.segments.index(merged[0])
+            self.segments[start:start + len(merged)] = [result]
+            for segment in merged:
+                segment.retired = True
+                if not segment.readers:
+                    self.remove_segment(segment)
+            self.compactor = None
+            self.start_compaction()
+
+    # Закрытие и удаление сегмента, заменённого объединённым. Выполняется под блокировкой.
+    @staticmethod
+    def remove_segment(segment):
+        segment.close()
+        os.remove(segment.path)
+
+    # Запись сегмента в памяти на диск. wait - дождаться окончания объединения сегментов (перед передачей
+    # индекса другому процессу и при закрытии).
+    def flush(self, wait=False):
+        with self.lock:
+            self.write_memory()
+        while wait:
+            with self.lock:
+                compactor = self.compactor
+            if compactor is None:
+                break
+            compactor.join()
+
+    # Запись на диск, если с предыдущей прошло SEARCH_FLUSH_INTERVAL секунд. Вызывается из цикла сервера.
+    def flush_if_due(self):
+        if self.memory_docs and time.monotonic() - self.flushed >= SEARCH_FLUSH_INTERVAL:
+            self.flush()
+
+    # Поиск сообщений переписки пользователя user, содержащих все слова запроса. Возвращает сообщения от новых
+    # к старым, пропустив offset первых и не больше limit. Под блокировкой только копируются списки сегмента
+    # в памяти и отмечается чтение сегментов на диске, сам поиск идёт без блокировки: сегменты перебираются
+    # от новых к старым, в каждом документы самого редкого терма (от новых к старым) ищутся в списках остальных
+    # термов двоичным поиском прямо в mmap. Документы сегментов не пересекаются, поэтому поиск заканчивается,
+    # как только найдено offset + limit документов.
+    def search(self, user, text, limit, offset=0):
+        terms = tokenize(text)
+        if not terms or limit <= 0:
+            return []
+        terms.add(PARTICIPANT + user)
+        with self.lock:
+            memory = {term: array('Q', self.memory.get(term, ())) for term in terms}
+            segments = self.acquire_segments()
+        try:
+            counts = {term: len(memory[term]) + sum(segment.count(term) for segment in segments) for term in terms}
+            if not all(counts.values()):
+                return []
+            rarest = min(terms, key=counts.get)
+            others = [term for term in terms if term != rarest]
+            found = []
+            wanted = offset + limit
+            # Сегмент в памяти - самый новый.
+            collect(found, wanted, memory[rarest], [memory[term] for term in others])
+            for segment in reversed(segments):
+                if len(found) >= wanted:
+                    break
+                if not segment.count(rarest) or not all(segment.count(term) for term in others):
+                    continue
+                views = [segment.view(term) for term in [rarest] + others]
+                try:
+                    collect(found, wanted, views[0], views[1:])
+                finally:
+                    for view in views:
+                        view.release()
+        finally:
+            self.release_segments(segments)
+        return self.archive.messages(found[offset:wanted])
+
+    # Сегменты на диске для чтения без блокировки: пока они не освобождены, объединение их не закрывает.
+    # Выполняется под блокировкой.
+    def acquire_segments(self):
+        segments = list(self.segments)
+        for segment in segments:
+            segment.readers += 1
+        return segments
+
+    def release_segments(self, segments):
+        with self.lock:
+            for segment in segments:
+                segment.readers -= 1
+                if segment.retired and not segment.readers:
+                    self.remove_segment(segment)
+
+    def close(self):
+        self.stop()
+        self.flush(wait=True)
+        with self.lock:
+            for segment in self.segments:
+                segment.close()
+            self.segments.clear()
+
+
+# Добавление в found документов списка candidates (от последнего к первому), которые есть во всех списках others,
+# пока в found меньше wanted документов.
+def collect(found, wanted, candidates, others):
+    for index in range(len(candidates) - 1, -1, -1):
+        if len(found) >= wanted:
+            return
+        doc = candidates[index]
+        if all(contains(postings, doc) for postings in others):
+            found.append(doc)
+
+
+# Проверка наличия документа в упорядоченном списке документов.
+def contains(postings, doc):
+    index = bisect.bisect_left(postings, doc)
+    return index < len(postings) and postings[index] == doc
@@ -0,0 +1,51 @@
+import math
+import time
+
+
+# Хэшированное колесо таймеров. Время делится на такты длительностью tick, таймеры раскладываются по slots ячейкам
+# по номеру такта срабатывания, для таймеров дальше одного оборота колеса хранится число оставшихся оборотов.
+# Установка и отмена таймера выполняются за O(1), на каждом такте просматривается только одна ячейка.
+class TimerWheel:
+    def __init__(self, tick, slots, now=None):
+        self.tick = tick
+        self.slots = [dict() for _ in range(slots)]
+        # Ячейка каждого установленного таймера, для отмены
+        self.positions = dict()
+        self.current = 0
+        self.time = time.monotonic() if now is None else now
+
+    # Установка таймера для item через delay секунд (с точностью до такта). Прежний таймер item отменяется.
+    def schedule(self, item, delay):
+        self.cancel(item)
+        ticks = max(1, math.ceil(delay / self.tick))
+        slot = (self.current + ticks) % len(self.slots)
+        self.slots[slot][item] = (ticks - 1) // len(self.slots)
+        self.positions[item] = slot
+
+    def cancel(self, item):
+        slot = self.positions.pop(item, None)
+        if slot is not None:
+            del self.slots[slot][item]
+
+    # Продвижение колеса до момента now, возвращает список элементов, таймеры которых сработали.
+    def advance(self, now=None):
+        now = time.monotonic() if now is None else now
+        expired = []
+        while now - self.time >= self.tick:
+            self.time += self.tick
+            self.current = (self.current + 1) % len(self.slots)
+            bucket = self.slots[self.current]
+            for item, rounds in list(bucket.items()):
+                if rounds:
+                    bucket[item] = rounds - 1
+                else:
+                    del bucket[item]
+                    del self.positions[item]
+                    expired.append(item)
+        return expired
+
+    def __contains__(self, item):
+        return item in self.positions
+
+    def __len__(self):
+        return len(self.positions)
@@ -0,0 +1,75 @@
+import sys
+sys.path.append('../')
+import os
+import tempfile
+import unittest
+from common.variables import *
+from common.codec import BINARY_CODEC
+from common.utils import encode_message
+from server_archive import MessageArchive
+
+
+def create_message(sender, destination, text):
+    return {ACTION: MESSAGE, SENDER: sender, DESTINATION: destination, TIME: 1.0, MESSAGE_TEXT: text}
+
+
+# Тесты архива сообщений
+class TestMessageArchive(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.archive = MessageArchive(self.directory, segment_size=1024)
+
+    def tearDown(self):
+        self.archive.close()
+
+    def texts(self, messages):
+        return [message[MESSAGE_TEXT] for message in messages]
+
+    # история переписки общая для обоих собеседников, выдаются последние сообщения в порядке архивации
+    def test_history(self):
+        for index in range(5):
+            self.archive.append(create_message('user1', 'user2', f'{index}'))
+            self.archive.append(create_message('user2', 'user1', f'ответ {index}'))
+            self.archive.append(create_message('user1', 'user3', f'другому {index}'))
+        self.assertEqual(self.texts(self.archive.history('user2', 'user1', 3)), ['ответ 3', '4', 'ответ 4'])
+        self.assertEqual(len(self.archive.history('user1', 'user3', 100)), 5)
+        self.assertEqual(self.archive.history('user2', 'user3', 10), [])
+
+    # сообщения раньше заданного момента - по времени архивации, выданному в предыдущем ответе
+    def test_before(self):
+        for index in range(5):
+            self.archive.append(create_message('user1', 'user2', f'{index}'))
+        last = self.archive.history('user1', 'user2', 2)
+        self.assertEqual(self.texts(self.archive.history('user1', 'user2', 2, last[0][TIME])), ['1', '2'])
+
+    # кадр сообщения хранится без перекодирования и читается кодеком, которым был закодирован
+    def test_raw_frame(self):
+        self.archive.append({ACTION: MESSAGE, DESTINATION: 'user2', SENDER: 'user1', RAW_CODEC: BINARY_CODEC,
+                             RAW_FRAME: encode_message(create_message('user1', 'user2', 'кадр'), BINARY_CODEC)})
+        self.assertEqual(self.texts(self.archive.history('user1', 'user2', 1)), ['кадр'])
+
+    # после переоткрытия архив читается из нескольких сегментов, включая записи, не попавшие в файл индекса,
+    # а незаконченная запись в конце журнала отбрасывается
+    def test_reopen(self):
+        for index in range(50):
+            self.archive.append(create_message('user1', 'user2', f'{index}'))
+        self.archive.flush()
+        self.archive.append(create_message('user1', 'user2', 'без индекса'))
+        self.archive.file.flush()
+        self.archive.file.write(b'\x00\x00')
+        self.archive.file.flush()
+        segments = [name for name in os.listdir(self.directory) if name.endswith('.log')]
+        self.assertGreater(len(segments), 1)
+
+        archive = MessageArchive(self.directory, segment_size=1024)
+        try:
+            history = self.texts(archive.history('user1', 'user2', 100))
+            self.assertEqual(history, [f'{index}' for index in range(50)] + ['без индекса'])
+            archive.append(create_message('user1', 'user2', 'после'))
+            self.assertEqual(self.texts(archive.history('user1', 'user2', 2)), ['без индекса', 'после'])
+        finally:
+            archive.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
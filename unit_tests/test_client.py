@@ -1,6 +1,6 @@
 import sys
 sys.path.append('../')
-from client import create_presence, process_response_ans
+from client import create_presence, create_batch, process_response_ans
 from common.variables import *
 import unittest
 from errors import ReqFieldMissingError, ServerError
@@ -14,6 +14,21 @@ class TestClass(unittest.TestCase):
         test[TIME] = 1.1  # время необходимо приравнять принудительно иначе тест никогда не будет пройден
         self.assertEqual(test, {ACTION: PRESENCE, TIME: 1.1, USER: {ACCOUNT_NAME: 'Guest'}})
 
+    # тест запроса с токеном восстановления сессии
+    def test_resume_presence(self):
+        test = create_presence('Guest', FRAMING_LENGTH_PREFIX, resume_token='abc', last_seq=5)
+        test[TIME] = 1.1
+        self.assertEqual(test, {ACTION: PRESENCE, TIME: 1.1, USER: {ACCOUNT_NAME: 'Guest'},
+                                FRAMING: FRAMING_LENGTH_PREFIX, RESUME_TOKEN: 'abc', LAST_SEQ: 5})
+
+    # тест пакета сообщений
+    def test_batch(self):
+        test = create_batch('Guest', [('user1', 'один'), ('user2', 'два')])
+        self.assertEqual(test[ACTION], BATCH)
+        self.assertEqual([(message[DESTINATION], message[MESSAGE_TEXT]) for message in test[MESSAGES]],
+                         [('user1', 'один'), ('user2', 'два')])
+        self.assertTrue(all(message[ACTION] == MESSAGE and message[SENDER] == 'Guest' for message in test[MESSAGES]))
+
     # тест корректтного разбора ответа 200
     def test_200_ans(self):
         self.assertEqual(process_response_ans({RESPONSE: 200}), '200 : OK')
@@ -0,0 +1,58 @@
+import sys
+sys.path.append('../')
+from common.codec import JSON_CODEC, BINARY_CODEC, CODECS
+from common.variables import *
+import unittest
+from errors import IncorrectDataRecivedError
+
+
+# Тесты кодеков сообщений
+class TestCodec(unittest.TestCase):
+    test_message = {
+        ACTION: MESSAGE,
+        SENDER: 'user1',
+        DESTINATION: 'пользователь2',
+        TIME: 1573760672.167031,
+        MESSAGE_TEXT: 'Привет!'
+    }
+    # словарь с ключами и значениями, для которых у двоичного кодека нет меток
+    test_other = {
+        'list': [1, -2, 3.5, None, True, False, 'text', {'nested': []}],
+        RESPONSE: 400,
+        ERROR: None,
+        'long': 'x' * 70000
+    }
+
+    # двоичный кодек должен декодировать ровно то, что закодировал
+    def test_binary_roundtrip(self):
+        for message in (self.test_message, self.test_other):
+            self.assertEqual(BINARY_CODEC.decode(BINARY_CODEC.encode(message)), message)
+
+    # двоичный кодек компактнее JSON на сообщениях протокола
+    def test_binary_smaller(self):
+        self.assertLess(len(BINARY_CODEC.encode(self.test_message)), len(JSON_CODEC.encode(self.test_message)))
+
+    # повреждённые данные и не словари приводят к ошибке данных
+    def test_binary_errors(self):
+        encoded = BINARY_CODEC.encode(self.test_message)
+        self.assertRaises(IncorrectDataRecivedError, BINARY_CODEC.decode, encoded[:-1])
+        self.assertRaises(IncorrectDataRecivedError, BINARY_CODEC.decode, encoded + b'\x00')
+        self.assertRaises(IncorrectDataRecivedError, BINARY_CODEC.decode, b'\x63')
+        self.assertRaises(IncorrectDataRecivedError, BINARY_CODEC.encode, [])
+        self.assertRaises(IncorrectDataRecivedError, JSON_CODEC.decode, b'[1, 2]')
+
+    # действия с группами передаются однобайтовыми константами
+    def test_binary_group_message(self):
+        message = {ACTION: GROUP_MESSAGE, SENDER: 'user1', GROUP: 'группа', TIME: 1.5, MESSAGE_TEXT: 'Привет!'}
+        encoded = BINARY_CODEC.encode(message)
+        self.assertEqual(BINARY_CODEC.decode(encoded), message)
+        self.assertIn(bytes((BINARY_CODEC.CONST, BINARY_CODEC.constant_tags[GROUP_MESSAGE])), encoded)
+
+    # кодеки доступны по именам, используемым при согласовании
+    def test_codec_names(self):
+        self.assertIs(CODECS[CODEC_JSON], JSON_CODEC)
+        self.assertIs(CODECS[CODEC_BINARY], BINARY_CODEC)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import sys
+sys.path.append('../')
+import logging
+import unittest
+import decos
+from decos import log
+
+
+# Аргумент, считающий, сколько раз его пытались представить строкой
+class CountingArg:
+    def __init__(self):
+        self.count = 0
+
+    def __repr__(self):
+        self.count += 1
+        return 'CountingArg'
+
+
+# Тесты декоратора логирования вызовов
+class TestLog(unittest.TestCase):
+    def setUp(self):
+        self.level = decos.logger.level
+
+    def tearDown(self):
+        decos.logger.setLevel(self.level)
+
+    # декорированная функция возвращает результат исходной
+    def test_result(self):
+        self.assertEqual(log(lambda a, b=1: a + b)(1, b=2), 3)
+        self.assertEqual(log(sample_rate=0.5)(lambda a: a * 2)(4), 8)
+
+    # при выключенном уровне DEBUG параметры вызова не форматируются
+    def test_disabled_level(self):
+        decos.logger.setLevel(logging.INFO)
+        arg = CountingArg()
+        log(lambda a: a)(arg)
+        self.assertEqual(arg.count, 0)
+
+    # при нулевой доле вызовов запись не формируется даже на уровне DEBUG
+    def test_sampling(self):
+        decos.logger.setLevel(logging.DEBUG)
+        arg = CountingArg()
+        with self.assertNoLogs(decos.logger, logging.DEBUG):
+            log(sample_rate=0)(lambda a: a)(arg)
+        self.assertEqual(arg.count, 0)
+        with self.assertLogs(decos.logger, logging.DEBUG):
+            log(lambda a: a)(arg)
+
+
+if __name__ == '__main__':
+    unittest.main()
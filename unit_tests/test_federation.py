@@ -0,0 +1,101 @@
+import sys
+sys.path.append('../')
+import time
+import socket
+import logging
+import tempfile
+import unittest
+import multiprocessing
+from common.variables import *
+from common.utils import get_message, send_message
+from client import connect_server
+
+
+# Процесс узла сервера: временная БД, общий ключ узлов и список соседей.
+def run_node(port, peers, db_url):
+    import server
+    from server_database import create_storage
+    logging.getLogger('server').setLevel(logging.WARNING)
+    server.Server('127.0.0.1', port, create_storage(db_url), peers=peers, peer_key='test').run()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port):
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError
+
+
+# Тесты объединения узлов сервера: три узла на loopback, каждый следующий подключается к предыдущим
+class TestFederation(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        context = multiprocessing.get_context('spawn')
+        db_dir = tempfile.mkdtemp()
+        cls.ports = []
+        cls.nodes = []
+        for index in range(3):
+            port = free_port()
+            peers = [f'127.0.0.1:{peer}' for peer in cls.ports]
+            node = context.Process(target=run_node, daemon=True,
+                                   args=(port, peers, f'sqlite:///{db_dir}/node{index}.db3'))
+            node.start()
+            cls.nodes.append(node)
+            cls.ports.append(port)
+            wait_for_port(port)
+        time.sleep(0.5)
+
+    @classmethod
+    def tearDownClass(cls):
+        for node in cls.nodes:
+            node.terminate()
+            node.join()
+
+    def setUp(self):
+        self.connections = []
+
+    def tearDown(self):
+        for transport, decoder in self.connections:
+            transport.close()
+
+    def login(self, node, name):
+        transport, response, decoder = connect_server('127.0.0.1', self.ports[node], name)
+        transport.settimeout(5)
+        self.connections.append((transport, decoder))
+        return transport, response, decoder
+
+    # сообщение доставляется пользователю, подключенному к другому узлу
+    def test_cross_node_message(self):
+        users = [self.login(node, f'user{node}') for node in range(3)]
+        time.sleep(0.3)
+        for sender in range(3):
+            for destination in range(3):
+                if sender != destination:
+                    send_message(users[sender][0], {
+                        ACTION: MESSAGE, SENDER: f'user{sender}', DESTINATION: f'user{destination}',
+                        TIME: time.time(), MESSAGE_TEXT: f'{sender}->{destination}'}, users[sender][2].codec)
+        for destination in range(3):
+            received = sorted(get_message(users[destination][0], users[destination][2])[MESSAGE_TEXT]
+                              for _ in range(2))
+            self.assertEqual(received, sorted(f'{sender}->{destination}' for sender in range(3)
+                                              if sender != destination))
+
+    # имя пользователя, подключенного к одному узлу, занято и на остальных
+    def test_name_taken_on_other_node(self):
+        self.login(0, 'taken')
+        time.sleep(0.3)
+        transport, response, decoder = self.login(2, 'taken')
+        self.assertEqual(response[RESPONSE], 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
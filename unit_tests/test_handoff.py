@@ -0,0 +1,220 @@
+import sys
+sys.path.append('../')
+import os
+import time
+import socket
+import sqlite3
+import tempfile
+import subprocess
+import unittest
+import urllib.request
+from common.variables import *
+from common.utils import get_message, send_message
+from client import connect_server
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server.py')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+# Два свободных соседних порта: процессы-обработчики выдают метрики на портах metrics_port + номер обработчика.
+def free_port_pair():
+    while True:
+        port = free_port()
+        try:
+            with socket.socket() as sock:
+                sock.bind(('127.0.0.1', port + 1))
+        except OSError:
+            continue
+        return port
+
+
+def users_online(port):
+    with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics', timeout=5) as response:
+        for line in response.read().decode('utf-8').splitlines():
+            if line.startswith('server_users_online '):
+                return int(float(line.split()[1]))
+
+
+def wait_for_port(port):
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError
+
+
+# Тест перезапуска сервера без разрыва соединений: новый процесс (движок asyncio) получает слушающий сокет
+# и подключения клиентов у работающего (движок select) через управляющий сокет.
+class TestHandoff(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.port = free_port()
+        self.processes = []
+        self.connections = []
+
+    def tearDown(self):
+        for transport, decoder in self.connections:
+            transport.close()
+        for process in self.processes:
+            process.kill()
+            process.wait()
+            process.stdin.close()
+
+    # Сервер запускается в отдельном процессе, консоль ждёт ввода из открытого канала.
+    def start_server(self, engine, *args):
+        process = subprocess.Popen(
+            [sys.executable, SERVER_SCRIPT, '-p', str(self.port), '-a', '127.0.0.1', '-m', '0', '-e', engine, *args],
+            cwd=self.directory, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+        self.processes.append(process)
+        return process
+
+    def login(self, name):
+        transport, response, decoder = connect_server('127.0.0.1', self.port, name)
+        transport.settimeout(5)
+        self.connections.append((transport, decoder))
+        return transport, decoder
+
+    def exchange(self, sender, destination, text):
+        send_message(sender[0], {ACTION: MESSAGE, SENDER: 'first', DESTINATION: 'second', TIME: time.time(),
+                                 MESSAGE_TEXT: text}, sender[1].codec)
+        self.assertEqual(get_message(destination[0], destination[1])[MESSAGE_TEXT], text)
+
+    # клиенты остаются подключены и обмениваются сообщениями через новый процесс
+    def test_clients_survive_restart(self):
+        old = self.start_server('select')
+        wait_for_port(self.port)
+        first = self.login('first')
+        second = self.login('second')
+        self.exchange(first, second, 'до перезапуска')
+
+        self.start_server('asyncio', '--reload')
+        self.assertEqual(old.wait(timeout=20), 0)
+        self.exchange(first, second, 'после перезапуска')
+
+        # пользователи онлайн остались в БД
+        with sqlite3.connect(os.path.join(self.directory, 'server_db.db3')) as connection:
+            count = connection.execute('SELECT COUNT(*) FROM Active_users').fetchone()[0]
+        self.assertEqual(count, 2)
+
+
+    # без --reload второй сервер на том же порту не забирает подключения работающего, управляющий сокет доступен
+    # только владельцу
+    def test_no_takeover_without_reload(self):
+        old = self.start_server('select')
+        wait_for_port(self.port)
+        first = self.login('first')
+        second = self.login('second')
+        control = os.path.join(self.directory, CONTROL_SOCKET.format(port=self.port))
+        self.assertEqual(os.stat(control).st_mode & 0o777, 0o600)
+
+        new = self.start_server('select')
+        with self.assertRaises(subprocess.TimeoutExpired):
+            new.wait(timeout=2)
+        self.assertIsNone(old.poll())
+        self.exchange(first, second, 'после запуска второго сервера')
+
+    # Подключение пользователя к другому обработчику, чем тот, на котором уже работает first (same - к тому же).
+    # Обработчик определяется по числу пользователей в сети в его метриках, ядро распределяет новые подключения
+    # по хешу адресов.
+    def login_elsewhere(self, name, metrics_port, same=False):
+        for _ in range(50):
+            first_worker = [users_online(metrics_port + worker) for worker in range(2)].index(1)
+            connection = self.login(name)
+            for _ in range(50):
+                online = [users_online(metrics_port + worker) for worker in range(2)]
+                if sum(online) == 2:
+                    break
+                time.sleep(0.05)
+            if sum(online) == 2 and (online[first_worker] == 2) == same:
+                return connection
+            self.connections.remove(connection)
+            connection[0].close()
+            while sum(users_online(metrics_port + worker) for worker in range(2)) != 1:
+                time.sleep(0.05)
+        self.fail('Не удалось подключиться к нужному обработчику')
+
+    # сообщения между пользователями разных обработчиков доходят все и по порядку, по команде exit
+    # процессы-обработчики, занятые обменом сообщениями, завершаются, и сервер выходит
+    def test_workers_exit(self):
+        for engine in ('select', 'asyncio'):
+            with self.subTest(engine=engine):
+                metrics_port = free_port_pair()
+                process = self.start_server(engine, '-w', '2', '-m', str(metrics_port))
+                wait_for_port(self.port)
+                wait_for_port(metrics_port)
+                wait_for_port(metrics_port + 1)
+                first = self.login('first')
+                second = self.login_elsewhere('second', metrics_port)
+                for index in range(20):
+                    send_message(first[0], {ACTION: MESSAGE, SENDER: 'first', DESTINATION: 'second',
+                                            TIME: time.time(), MESSAGE_TEXT: str(index)}, first[1].codec)
+                received = [get_message(second[0], second[1])[MESSAGE_TEXT] for _ in range(20)]
+                self.assertEqual(received, [str(index) for index in range(20)])
+                process.stdin.write(b'exit\n')
+                process.stdin.flush()
+                self.assertEqual(process.wait(timeout=20), 0)
+                self.port = free_port()
+
+    # Запрос к архиву от пользователя connection, ответ - тексты сообщений.
+    def archive_request(self, connection, request):
+        send_message(connection[0], dict(request, **{TIME: time.time()}), connection[1].codec)
+        response = get_message(connection[0], connection[1])
+        self.assertEqual(response[RESPONSE], 202)
+        return [message[MESSAGE_TEXT] for message in response[MESSAGES]]
+
+    # архив один на все обработчики: переписка на одном обработчике видна в истории и поиске после переподключения
+    # к другому, каждое сообщение в архиве один раз
+    def test_workers_archive(self):
+        for engine in ('select', 'asyncio'):
+            with self.subTest(engine=engine):
+                self.directory = tempfile.mkdtemp()
+                metrics_port = free_port_pair()
+                process = self.start_server(engine, '-w', '2', '-m', str(metrics_port))
+                wait_for_port(self.port)
+                wait_for_port(metrics_port)
+                wait_for_port(metrics_port + 1)
+                first = self.login('first')
+                second = self.login_elsewhere('second', metrics_port, same=True)
+                texts = ['первое слово', 'второе слово', 'третье слово', 'четвёртое слово']
+                for index, text in enumerate(texts):
+                    # вторая половина переписки - после переподключения second к другому обработчику
+                    if index == 2:
+                        self.connections.remove(second)
+                        second[0].close()
+                        while sum(users_online(metrics_port + worker) for worker in range(2)) != 1:
+                            time.sleep(0.05)
+                        second = self.login_elsewhere('second', metrics_port)
+                    sender, destination = (first, second) if index % 2 == 0 else (second, first)
+                    names = ('first', 'second') if index % 2 == 0 else ('second', 'first')
+                    send_message(sender[0], {ACTION: MESSAGE, SENDER: names[0], DESTINATION: names[1],
+                                             TIME: time.time(), MESSAGE_TEXT: text}, sender[1].codec)
+                    self.assertEqual(get_message(destination[0], destination[1])[MESSAGE_TEXT], text)
+
+                for connection, name, user in ((first, 'first', 'second'), (second, 'second', 'first')):
+                    self.assertEqual(self.archive_request(connection, {ACTION: HISTORY, ACCOUNT_NAME: name,
+                                                                       USER: user, COUNT: 10}), texts)
+                # новые сообщения индекс поиска дочитывает раз в SEARCH_INDEX_INTERVAL секунд
+                for connection, name in ((first, 'first'), (second, 'second')):
+                    for _ in range(50):
+                        found = self.archive_request(connection, {ACTION: SEARCH, ACCOUNT_NAME: name, QUERY: 'слово'})
+                        if found:
+                            break
+                        time.sleep(0.1)
+                    self.assertEqual(found, texts[::-1])
+                self.assertNotIn('1', os.listdir(os.path.join(self.directory, ARCHIVE_DIR)))
+
+                process.stdin.write(b'exit\n')
+                process.stdin.flush()
+                self.assertEqual(process.wait(timeout=20), 0)
+                self.port = free_port()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import sys
+sys.path.append('../')
+import socket
+import unittest
+from server_metrics import Metrics, start_metrics_server
+
+
+# Тесты реестра метрик сервера
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+
+    # метрика с тем же именем и метками - тот же объект
+    def test_same_metric(self):
+        counter = self.metrics.counter('sent_total', op='a')
+        self.assertIs(self.metrics.counter('sent_total', op='a'), counter)
+        self.assertIsNot(self.metrics.counter('sent_total', op='b'), counter)
+
+    # гистограмма относит замеры к корзинам и оценивает квантили по их границам
+    def test_histogram(self):
+        histogram = self.metrics.histogram('latency_seconds')
+        for value in (0.0001, 0.0003, 0.002, 10):
+            histogram.observe(value)
+        self.assertEqual(histogram.count, 4)
+        self.assertAlmostEqual(histogram.sum, 10.0024)
+        self.assertEqual(histogram.quantile(0.5), 0.0005)
+        self.assertEqual(histogram.quantile(1), float('inf'))
+
+    # текстовый формат: тип, значения с метками, накопительные корзины, сумма и количество
+    def test_render(self):
+        self.metrics.counter('sent_total', 'Отправлено').inc(3)
+        self.metrics.gauge('online').function = lambda: 7
+        self.metrics.histogram('latency_seconds', op='store').observe(0.002)
+        text = self.metrics.render()
+        self.assertIn('# HELP server_sent_total Отправлено\n# TYPE server_sent_total counter\nserver_sent_total 3\n', text)
+        self.assertIn('server_online 7\n', text)
+        self.assertIn('server_latency_seconds_bucket{op="store",le="0.001"} 0\n', text)
+        self.assertIn('server_latency_seconds_bucket{op="store",le="0.0025"} 1\n', text)
+        self.assertIn('server_latency_seconds_bucket{op="store",le="+Inf"} 1\n', text)
+        self.assertIn('server_latency_seconds_count{op="store"} 1\n', text)
+
+    # скорости считаются с предыдущего расчёта
+    def test_rates(self):
+        counter = self.metrics.counter('sent_total')
+        self.metrics.rates()
+        counter.inc(10)
+        rates = self.metrics.rates()
+        self.assertGreater(rates[('sent_total', ())], 0)
+        self.assertEqual(self.metrics.rates()[('sent_total', ())], 0)
+
+
+    # занятый порт не мешает запуску сервера: выдача метрик просто не запускается
+    def test_port_in_use(self):
+        with socket.create_server(('127.0.0.1', 0)) as sock:
+            with self.assertLogs('server', 'ERROR'):
+                self.assertIsNone(start_metrics_server(sock.getsockname()[1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import sys
+sys.path.append('../')
+import socket
+import selectors
+import unittest
+from server_registry import SessionRegistry
+
+
+# Тесты реестра подключений сервера
+class TestSessionRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = SessionRegistry()
+        self.sockets = socket.socketpair()
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+
+    # сессия доступна по дескриптору сокета и после назначения имени - по имени
+    def test_add_and_find(self):
+        session = self.registry.add(self.sockets[0])
+        self.assertIs(self.registry.get(self.sockets[0].fileno()), session)
+        self.assertEqual(session.fileno(), self.sockets[0].fileno())
+        self.assertIsNone(self.registry.find('user1'))
+        self.registry.bind(session, 'user1')
+        self.assertIs(self.registry.find('user1'), session)
+        self.assertIn(session, self.registry)
+        self.assertEqual(len(self.registry), 1)
+
+    # удаление убирает сессию из обоих индексов, повторное удаление не приводит к ошибке
+    def test_remove(self):
+        session = self.registry.add(self.sockets[0])
+        self.registry.bind(session, 'user1')
+        self.registry.remove(session)
+        self.registry.remove(session)
+        self.assertNotIn(session, self.registry)
+        self.assertIsNone(self.registry.find('user1'))
+        self.assertEqual(len(self.registry), 0)
+
+    # удаление старой сессии не затрагивает новую сессию с тем же именем
+    def test_rebind(self):
+        old = self.registry.add(self.sockets[0])
+        new = self.registry.add(self.sockets[1])
+        self.registry.bind(old, 'user1')
+        self.registry.bind(new, 'user1')
+        self.registry.remove(old)
+        self.assertIs(self.registry.find('user1'), new)
+        self.assertEqual(list(self.registry), [new])
+
+    # у сессии нет словаря атрибутов
+    def test_slots(self):
+        session = self.registry.add(self.sockets[0])
+        self.assertFalse(hasattr(session, '__dict__'))
+
+
+    # в реестре с селектором сессия регистрируется на чтение при добавлении и снимается при удалении, события
+    # сессии можно изменить
+    def test_selector(self):
+        selector = selectors.DefaultSelector()
+        self.addCleanup(selector.close)
+        registry = SessionRegistry(selector)
+        session = registry.add(self.sockets[0])
+        self.assertEqual(selector.get_key(session).events, selectors.EVENT_READ)
+        self.assertIs(selector.get_key(session).data, session)
+        registry.watch(session, selectors.EVENT_READ | selectors.EVENT_WRITE)
+        self.assertEqual(selector.select(0), [(selector.get_key(session), selectors.EVENT_WRITE)])
+        registry.watch(session, 0)
+        self.assertNotIn(session, selector.get_map())
+        self.assertIn(session, registry)
+        registry.watch(session, selectors.EVENT_WRITE)
+        registry.remove(session)
+        registry.remove(session)
+        self.assertNotIn(session, selector.get_map())
+
+
+if __name__ == '__main__':
+    unittest.main()
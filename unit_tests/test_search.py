@@ -0,0 +1,129 @@
+import sys
+sys.path.append('../')
+import os
+import tempfile
+import unittest
+from unittest import mock
+from common.variables import *
+from common.codec import BINARY_CODEC
+from common.utils import encode_frame
+from server_archive import MessageArchive
+from server_search import SearchIndex, SearchSegment
+
+
+def create_message(sender, destination, text):
+    return {ACTION: MESSAGE, SENDER: sender, DESTINATION: destination, TIME: 1.0, MESSAGE_TEXT: text}
+
+
+# Тесты индекса полнотекстового поиска
+class TestSearchIndex(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.archive = MessageArchive(self.directory)
+        self.index = SearchIndex(self.archive, segment_docs=4, merge_factor=2)
+
+    def tearDown(self):
+        self.index.close()
+        self.archive.close()
+
+    # Сообщение пишется в архив, индекс дочитывает его сразу, не дожидаясь своего потока.
+    def add(self, sender, destination, text):
+        self.archive.append(create_message(sender, destination, text))
+        self.index.update()
+
+    def texts(self, messages):
+        return [message[MESSAGE_TEXT] for message in messages]
+
+    # находятся сообщения со всеми словами запроса без учёта регистра, от новых к старым
+    def test_and_query(self):
+        self.add('user1', 'user2', 'Встреча завтра в офисе')
+        self.add('user2', 'user1', 'Встреча отменена')
+        self.add('user1', 'user2', 'завтра в офисе никого')
+        self.assertEqual(self.texts(self.index.search('user1', 'встреча', 10)),
+                         ['Встреча отменена', 'Встреча завтра в офисе'])
+        self.assertEqual(self.texts(self.index.search('user2', 'ОФИСЕ завтра', 10)),
+                         ['завтра в офисе никого', 'Встреча завтра в офисе'])
+        self.assertEqual(self.index.search('user1', 'встреча никого', 10), [])
+        self.assertEqual(self.index.search('user1', '', 10), [])
+
+    # пользователь находит только сообщения своей переписки
+    def test_own_conversations(self):
+        self.add('user1', 'user2', 'секрет')
+        self.add('user3', 'user4', 'секрет')
+        self.assertEqual(len(self.index.search('user2', 'секрет', 10)), 1)
+        self.assertEqual(len(self.index.search('user3', 'секрет', 10)), 1)
+        self.assertEqual(self.index.search('user5', 'секрет', 10), [])
+
+    # результаты выдаются страницами; сегменты, записанные на диск и объединённые, ищутся вместе с сегментом
+    # в памяти, после переоткрытия индекс дочитывает сообщения, не записанные в сегменты
+    def test_segments_and_reopen(self):
+        for index in range(30):
+            self.add('user1', 'user2', f'сообщение {index}')
+        self.index.flush(wait=True)
+        self.add('user1', 'user2', 'сообщение последнее')
+        self.assertLess(len(self.index.segments), 30 // 4)
+        found = self.texts(self.index.search('user1', 'сообщение', 5, 1))
+        self.assertEqual(found, ['сообщение 29', 'сообщение 28', 'сообщение 27', 'сообщение 26', 'сообщение 25'])
+
+        self.index.close()
+        self.archive.flush()
+        self.index = SearchIndex(self.archive, segment_docs=4, merge_factor=2)
+        self.index.update()
+        self.assertEqual(len(self.index.search('user2', 'сообщение', 100)), 31)
+        self.assertEqual(self.texts(self.index.search('user2', 'последнее', 10)), ['сообщение последнее'])
+        self.assertFalse([name for name in os.listdir(self.index.directory) if name.endswith('.tmp')])
+
+    # поиск идёт от новых сегментов к старым, начиная с самого редкого терма, и заканчивается, когда найдено
+    # offset + limit сообщений: более старые сегменты не читаются
+    def test_newest_first(self):
+        for index in range(12):
+            self.add('user1', 'user2', f'сообщение {index}' + (' редкое' if index % 4 == 1 else ''))
+        self.index.flush(wait=True)
+        self.assertEqual([segment.docs for segment in self.index.segments], [8, 4])
+        read = []
+        view = SearchSegment.view
+
+        def record(segment, term):
+            read.append((segment.docs, term))
+            return view(segment, term)
+        with mock.patch.object(SearchSegment, 'view', autospec=True, side_effect=record):
+            self.assertEqual(self.texts(self.index.search('user1', 'сообщение', 2)), ['сообщение 11', 'сообщение 10'])
+            self.assertEqual({docs for docs, term in read}, {4})
+            read.clear()
+            self.assertEqual(self.texts(self.index.search('user1', 'сообщение редкое', 2, 1)),
+                             ['сообщение 5 редкое', 'сообщение 1 редкое'])
+            self.assertEqual([term for docs, term in read if docs == 8][0], 'редкое')
+
+    # сегмент, заменённый объединённым, пока его читает запрос, закрывается и удаляется после окончания запроса
+    def test_retired_segment(self):
+        for index in range(4):
+            self.add('user1', 'user2', f'сообщение {index}')
+        self.index.flush(wait=True)
+        with self.index.lock:
+            segments = self.index.acquire_segments()
+        for index in range(4, 8):
+            self.add('user1', 'user2', f'сообщение {index}')
+        self.index.flush(wait=True)
+        self.assertEqual([segment.docs for segment in self.index.segments], [8])
+        self.assertTrue(segments[0].retired)
+        self.assertTrue(os.path.exists(segments[0].path))
+        self.assertEqual(len(segments[0].view('сообщение')), 4)
+        self.index.release_segments(segments)
+        self.assertFalse(os.path.exists(segments[0].path))
+        self.assertEqual(len(self.index.search('user1', 'сообщение', 10)), 8)
+
+    # некорректное сообщение, записанное в архив кадром без разбора, пропускается индексом и историей
+    def test_garbage_record(self):
+        self.add('user1', 'user2', 'до')
+        route = b'user2' + ROUTE_SEPARATOR + b'user1'
+        self.archive.append({ACTION: MESSAGE, DESTINATION: 'user2', SENDER: 'user1',
+                             RAW_FRAME: encode_frame(b'\xff\xfe', route), RAW_CODEC: BINARY_CODEC})
+        self.add('user1', 'user2', 'после')
+        self.assertEqual(self.texts(self.archive.history('user1', 'user2', 10)), ['до', 'после'])
+        self.assertEqual(self.texts(self.index.search('user1', 'до после', 10)), [])
+        self.assertEqual(len(self.index.search('user2', 'после', 10)), 1)
+        self.assertEqual(self.index.update(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
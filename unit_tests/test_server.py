@@ -0,0 +1,792 @@
+import sys
+sys.path.append('../')
+import os
+import time
+import selectors
+import resource
+import socket
+import logging
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from common.variables import *
+from common.utils import *
+from common.codec import CODECS
+from client import create_presence, connect_server
+import server
+from server_archive import MessageArchive
+from server_database import create_storage
+from server_search import SearchIndex
+
+logging.getLogger('server').setLevel(logging.WARNING)
+
+
+# Тесты обработки данных сервером без запуска сетевого цикла: клиенты подключаются через сокет на loopback,
+# сервер читает и обрабатывает данные от них так же, как в цикле, по вызову pump.
+class ServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.database = create_storage('sqlite:///' + os.path.join(tempfile.mkdtemp(), 'server.db3'))
+        self.server = server.Server('127.0.0.1', DEFAULT_PORT, self.database)
+        self.listener = socket.create_server(('127.0.0.1', 0))
+        self.transports = []
+
+    def tearDown(self):
+        for client in list(self.server.registry):
+            self.server.remove_client(client)
+        for transport in self.transports:
+            transport.close()
+        self.listener.close()
+        self.database.close()
+
+    # Подключение клиента, возвращает клиентский сокет и сессию подключения на сервере. У медленного (slow)
+    # клиента буферы ядра маленькие, поэтому данные для него быстро скапливаются в буфере на сервере.
+    def connect(self, slow=False):
+        transport = socket.socket()
+        if slow:
+            transport.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        transport.connect(self.listener.getsockname())
+        transport.settimeout(2)
+        self.transports.append(transport)
+        sock, address = self.listener.accept()
+        if slow:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        sock.setblocking(False)
+        return transport, self.server.registry.add(sock)
+
+    # Вход пользователя, возвращает клиентский сокет, декодер кадров (None без кадрирования), ответ сервера
+    # и сессию на сервере.
+    def login(self, name, codec=CODEC_JSON, framed=True, slow=False, **presence):
+        transport, session = self.connect(slow)
+        send_message(transport, create_presence(name, FRAMING_LENGTH_PREFIX if framed else None,
+                                                codec if framed else None, **presence))
+        self.pump()
+        if not framed:
+            return transport, None, get_message(transport), session
+        decoder = FrameDecoder()
+        response = get_handshake_response(transport, decoder)
+        decoder.codec = CODECS[response.get(CODEC, CODEC_JSON)]
+        return transport, decoder, response, session
+
+    # Одна итерация цикла сервера: чтение готовых подключений (кроме приостановленных), маршрутизация и отправка
+    # из буферов.
+    def pump(self, timeout=0.2):
+        for key, events in self.server.registry.selector.select(timeout):
+            client = key.data
+            if not events & selectors.EVENT_READ or client not in self.server.registry or client in self.server.paused:
+                continue
+            try:
+                self.server.process_client_data(client.sock.recv(READ_BUFFER_SIZE), client)
+            except Exception:
+                self.server.remove_client(client)
+        self.server.route_messages()
+        self.server.deliver_search_results()
+        self.server.flush_pending()
+
+    def assertNothingReceived(self, transport, decoder):
+        transport.settimeout(0.2)
+        with self.assertRaises(socket.timeout):
+            get_message(transport, decoder)
+
+
+# Маршрутизация кадров сообщений пользователям
+class TestRouting(ServerTestCase):
+    def garbage(self, destination, sender):
+        return encode_frame(b'\xff\xfe', destination.encode(ENCODING) + ROUTE_SEPARATOR + sender.encode(ENCODING))
+
+    def chat(self, sender, destination, text):
+        return {ACTION: MESSAGE, SENDER: sender, DESTINATION: destination, TIME: time.time(), MESSAGE_TEXT: text}
+
+    # кадр с корректным заголовком маршрута и некорректным сообщением для получателя с другим кодеком проверяется
+    # при приёме: отключается отправитель, получатель остаётся подключён
+    def test_garbage_frame_disconnects_sender(self):
+        victim = self.login('victim', CODEC_BINARY)
+        attacker = self.login('attacker')
+        attacker[0].sendall(self.garbage('victim', 'attacker'))
+        self.pump()
+        self.assertIs(self.server.registry.find('victim'), victim[3])
+        self.assertIsNone(self.server.registry.find('attacker'))
+        self.assertNothingReceived(victim[0], victim[1])
+
+        friend = self.login('friend')
+        send_message(friend[0], self.chat('friend', 'victim', 'привет'), friend[1].codec)
+        self.pump()
+        self.assertEqual(get_message(victim[0], victim[1])[MESSAGE_TEXT], 'привет')
+
+    # получателю без кадрирования сообщение перекодируется в JSON, некорректный кадр для него отключает отправителя
+    def test_legacy_recipient(self):
+        legacy = self.login('legacy', framed=False)
+        sender = self.login('sender', CODEC_BINARY)
+        send_message(sender[0], self.chat('sender', 'legacy', 'привет'), sender[1].codec)
+        self.pump()
+        self.assertEqual(get_message(legacy[0])[MESSAGE_TEXT], 'привет')
+        sender[0].sendall(self.garbage('legacy', 'sender'))
+        self.pump()
+        self.assertIs(self.server.registry.find('legacy'), legacy[3])
+        self.assertIsNone(self.server.registry.find('sender'))
+
+    # получателю с тем же кодеком кадр передаётся без разбора
+    def test_same_codec_frame_not_decoded(self):
+        recipient = self.login('recipient')
+        sender = self.login('sender')
+        sender[0].sendall(self.garbage('recipient', 'sender'))
+        self.pump()
+        self.assertIs(self.server.registry.find('sender'), sender[3])
+        recipient[0].settimeout(2)
+        self.assertEqual(recipient[0].recv(READ_BUFFER_SIZE), self.garbage('recipient', 'sender'))
+
+    # сообщение, в котором имя отправителя или получателя не строка, отклоняется при приёме, пакет с таким
+    # сообщением - тоже; цикл сервера продолжает работу
+    def test_invalid_names(self):
+        recipient = self.login('recipient')
+        legacy = self.login('legacy', framed=False)
+        framed = self.login('framed')
+        bad = [self.chat('legacy', ['recipient'], 'x'), self.chat({'name': 'legacy'}, 'recipient', 'x'),
+               {ACTION: BATCH, TIME: time.time(), MESSAGES: [self.chat('legacy', 'recipient', 'x'),
+                                                            self.chat('legacy', ['recipient'], 'x')]}]
+        for message in bad:
+            send_message(legacy[0], message)
+            self.pump()
+            self.assertEqual(get_message(legacy[0])[RESPONSE], 400)
+            # кадр без заголовка маршрута разбирается целиком
+            framed[0].sendall(encode_frame(framed[1].codec.encode(message)))
+            self.pump()
+            self.assertEqual(get_message(framed[0], framed[1])[RESPONSE], 400)
+            self.assertEqual(self.server.messages, [])
+        self.assertNothingReceived(recipient[0], recipient[1])
+
+    # сообщение от чужого имени отклоняется во всех режимах: кадром с заголовком маршрута, кадром без него,
+    # без кадрирования, в пакете и группе; подключение без входа не может отправлять сообщения
+    def test_forged_sender(self):
+        recipient = self.login('recipient')
+        framed = self.login('framed', CODEC_BINARY)
+        legacy = self.login('legacy', framed=False)
+        forged = self.chat('recipient', 'framed', 'подделка')
+        for message in (self.chat('victim', 'recipient', 'x'),
+                        {ACTION: BATCH, TIME: time.time(), MESSAGES: [self.chat('framed', 'recipient', 'x'),
+                                                                     self.chat('victim', 'recipient', 'x')]},
+                        {ACTION: GROUP_MESSAGE, TIME: time.time(), GROUP: 'group', SENDER: 'victim',
+                         MESSAGE_TEXT: 'x'},
+                        {ACTION: EXIT, TIME: time.time(), ACCOUNT_NAME: 'recipient'}):
+            with self.subTest(action=message[ACTION]):
+                send_message(framed[0], message, framed[1].codec)
+                self.pump()
+                self.assertEqual(get_message(framed[0], framed[1])[RESPONSE], 400)
+                send_message(legacy[0], message)
+                self.pump()
+                self.assertEqual(get_message(legacy[0])[RESPONSE], 400)
+        # кадр без заголовка маршрута
+        framed[0].sendall(encode_frame(framed[1].codec.encode(forged)))
+        self.pump()
+        self.assertEqual(get_message(framed[0], framed[1])[RESPONSE], 400)
+
+        # подключение без приветствия сразу передаёт кадры, как соседний узел
+        transport, session = self.connect()
+        transport.sendall(encode_message(self.chat('victim', 'recipient', 'x'), CODECS[CODEC_BINARY]))
+        self.pump()
+        self.assertEqual(self.server.messages, [])
+        self.assertIs(self.server.registry.find('recipient'), recipient[3])
+        self.assertNothingReceived(recipient[0], recipient[1])
+
+        send_message(framed[0], self.chat('framed', 'recipient', 'привет'), framed[1].codec)
+        self.pump()
+        self.assertEqual(get_message(recipient[0], recipient[1])[MESSAGE_TEXT], 'привет')
+
+    # ошибка при обработке одного сообщения из очереди не прерывает маршрутизацию остальных, очередь очищается
+    def test_route_error(self):
+        recipient = self.login('recipient')
+        self.server.messages.append(self.chat('sender', ['recipient'], 'x'))
+        self.server.messages.append(self.chat('sender', 'recipient', 'привет'))
+        self.server.route_messages()
+        self.assertEqual(self.server.messages, [])
+        self.server.flush_pending()
+        self.assertEqual(get_message(recipient[0], recipient[1])[MESSAGE_TEXT], 'привет')
+
+
+# Пакеты сообщений (BATCH)
+class TestBatch(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.sender = self.login('sender')
+
+    def chat(self, destination, text):
+        return {ACTION: MESSAGE, SENDER: 'sender', DESTINATION: destination, TIME: time.time(), MESSAGE_TEXT: text}
+
+    def send_batch(self, messages):
+        send_message(self.sender[0], {ACTION: BATCH, TIME: time.time(), MESSAGES: messages}, self.sender[1].codec)
+        self.pump()
+
+    def stored(self, name):
+        self.database.flush()
+        return [message[MESSAGE_TEXT] for batch in self.database.stored_messages(name)
+                for message_id, message in batch]
+
+    # сообщения пакета доставляются получателям по порядку, в том числе получателю без кадрирования, ответ
+    # отправителю не нужен
+    def test_delivered(self):
+        first = self.login('first')
+        legacy = self.login('legacy', framed=False)
+        self.send_batch([self.chat('first', '1'), self.chat('legacy', '2'), self.chat('first', '3')])
+        self.assertEqual([get_message(first[0], first[1])[MESSAGE_TEXT] for _ in range(2)], ['1', '3'])
+        self.assertEqual(get_message(legacy[0])[MESSAGE_TEXT], '2')
+        self.assertNothingReceived(self.sender[0], self.sender[1])
+
+    # пакет с некорректным сообщением отклоняется целиком, корректные сообщения из него не доставляются
+    def test_mixed_rejected(self):
+        recipient = self.login('recipient')
+        for bad in ({ACTION: MESSAGE, SENDER: 'sender', DESTINATION: 'recipient', TIME: time.time()},
+                    self.chat(['recipient'], 'x'), 'x', None):
+            with self.subTest(bad=bad):
+                self.send_batch([self.chat('recipient', 'до'), bad, self.chat('recipient', 'после')])
+                self.assertEqual(get_message(self.sender[0], self.sender[1])[RESPONSE], 400)
+        self.send_batch('не список')
+        self.assertEqual(get_message(self.sender[0], self.sender[1])[RESPONSE], 400)
+        self.assertNothingReceived(recipient[0], recipient[1])
+        self.assertIs(self.server.registry.find('sender'), self.sender[3])
+
+    # размер пакета ограничен MAX_BATCH_SIZE, пустой пакет тоже некорректен
+    def test_size_limit(self):
+        recipient = self.login('recipient')
+        with mock.patch.object(server, 'MAX_BATCH_SIZE', 5):
+            for size in (6, 0):
+                self.send_batch([self.chat('recipient', str(index)) for index in range(size)])
+                self.assertEqual(get_message(self.sender[0], self.sender[1])[RESPONSE], 400)
+            self.assertNothingReceived(recipient[0], recipient[1])
+            self.send_batch([self.chat('recipient', str(index)) for index in range(5)])
+        self.assertEqual([get_message(recipient[0], recipient[1])[MESSAGE_TEXT] for _ in range(5)],
+                         [str(index) for index in range(5)])
+        self.assertNothingReceived(self.sender[0], self.sender[1])
+
+    # сообщения зарегистрированному пользователю не в сети сохраняются в БД и доставляются при входе
+    def test_offline_recipient(self):
+        self.database.user_login('offline', '127.0.0.1', 1000)
+        self.database.user_logout('offline')
+        self.database.flush()
+        online = self.login('online')
+        self.send_batch([self.chat('offline', '1'), self.chat('online', '2'), self.chat('offline', '3')])
+        self.assertEqual(get_message(online[0], online[1])[MESSAGE_TEXT], '2')
+        self.assertEqual(self.stored('offline'), ['1', '3'])
+        offline = self.login('offline')
+        for text in ('1', '3'):
+            self.pump()
+            self.assertEqual(get_message(offline[0], offline[1])[MESSAGE_TEXT], text)
+
+    # сообщения незарегистрированному получателю отбрасываются по отдельности, остальные сообщения пакета
+    # доставляются
+    def test_unknown_recipient(self):
+        recipient = self.login('recipient')
+        dropped = self.server.messages_dropped.value
+        self.send_batch([self.chat('nobody', '1'), self.chat('recipient', '2'), self.chat('nobody', '3'),
+                         self.chat('recipient', '4')])
+        self.assertEqual([get_message(recipient[0], recipient[1])[MESSAGE_TEXT] for _ in range(2)], ['2', '4'])
+        self.assertEqual(self.server.messages_dropped.value - dropped, 2)
+        self.assertEqual(self.stored('nobody'), [])
+        self.assertNothingReceived(self.sender[0], self.sender[1])
+
+
+# Группы: создание, вступление, выход и сообщения участникам
+class TestGroups(ServerTestCase):
+    def request(self, user, action, group, name=None):
+        send_message(user[0], {ACTION: action, TIME: time.time(), GROUP: group, ACCOUNT_NAME: name or user[3].name},
+                     user[1].codec if user[1] else None)
+        self.pump()
+        return get_message(user[0], user[1])[RESPONSE]
+
+    def say(self, user, group, text):
+        send_message(user[0], {ACTION: GROUP_MESSAGE, TIME: time.time(), GROUP: group, SENDER: user[3].name,
+                               MESSAGE_TEXT: text}, user[1].codec if user[1] else None)
+        self.pump()
+
+    # группу можно создать один раз, вступить можно только в существующую группу, изменять можно только
+    # своё участие
+    def test_create_join(self):
+        alice = self.login('alice')
+        bob = self.login('bob')
+        self.assertEqual(self.request(alice, CREATE_GROUP, 'group'), 200)
+        self.assertEqual(self.request(bob, CREATE_GROUP, 'group'), 400)
+        self.assertEqual(self.request(bob, JOIN_GROUP, 'missing'), 400)
+        self.assertEqual(self.request(bob, JOIN_GROUP, 'group'), 200)
+        self.assertEqual(self.request(bob, JOIN_GROUP, 'group'), 200)
+        self.assertEqual(self.request(alice, CREATE_GROUP, 'other', 'bob'), 400)
+        self.assertEqual(self.database.group_members('group'), {'alice', 'bob'})
+        self.assertIsNone(self.database.group_members('other'))
+
+    # сообщение группе получают все участники в сети, кроме отправителя, в том числе без кадрирования;
+    # пользователи не из группы его не получают
+    def test_group_message(self):
+        alice = self.login('alice')
+        bob = self.login('bob', CODEC_BINARY)
+        carol = self.login('carol', framed=False)
+        dave = self.login('dave')
+        self.assertEqual(self.request(alice, CREATE_GROUP, 'group'), 200)
+        self.assertEqual(self.request(bob, JOIN_GROUP, 'group'), 200)
+        self.assertEqual(self.request(carol, JOIN_GROUP, 'group'), 200)
+        self.say(alice, 'group', 'привет')
+        for member in (bob, carol):
+            message = get_message(member[0], member[1])
+            self.assertEqual((message[ACTION], message[GROUP], message[SENDER], message[MESSAGE_TEXT]),
+                             (GROUP_MESSAGE, 'group', 'alice', 'привет'))
+        self.assertNothingReceived(alice[0], alice[1])
+        self.assertNothingReceived(dave[0], dave[1])
+
+    # вышедший из группы участник больше не получает её сообщений и не может писать в неё, как и пользователь,
+    # не вступавший в группу
+    def test_leave_and_non_member(self):
+        alice = self.login('alice')
+        bob = self.login('bob')
+        dave = self.login('dave')
+        self.assertEqual(self.request(alice, CREATE_GROUP, 'group'), 200)
+        self.assertEqual(self.request(bob, JOIN_GROUP, 'group'), 200)
+        self.assertEqual(self.request(bob, LEAVE_GROUP, 'group'), 200)
+        self.assertEqual(self.request(bob, LEAVE_GROUP, 'group'), 400)
+        self.assertEqual(self.request(dave, LEAVE_GROUP, 'group'), 400)
+        self.say(alice, 'group', 'без bob')
+        self.assertNothingReceived(bob[0], bob[1])
+        for user in (bob, dave):
+            self.say(user, 'group', 'не участник')
+            self.assertEqual(get_message(user[0], user[1])[RESPONSE], 400)
+        self.say(dave, 'missing', 'нет группы')
+        self.assertEqual(get_message(dave[0], dave[1])[RESPONSE], 400)
+        self.assertNothingReceived(alice[0], alice[1])
+        self.assertEqual(self.database.group_members('group'), {'alice'})
+
+
+# Уведомления об изменении состояния контактов
+class TestPresence(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        for name in ('flap1', 'flap2', 'watcher', 'stranger'):
+            self.database.user_login(name, '127.0.0.1', 1000)
+            self.database.user_logout(name)
+        self.database.flush()
+        self.assertTrue(self.database.add_contact('watcher', 'flap1'))
+        self.assertTrue(self.database.add_contact('watcher', 'flap2'))
+        self.watcher = self.login('watcher')
+        self.stranger = self.login('stranger')
+
+    # частые входы и выходы контакта: клиент без кадрирования не восстанавливает сессию, поэтому каждый выход
+    # сразу меняет его состояние
+    def flap(self, name, times, stay=False):
+        for index in range(times):
+            transport, decoder, response, session = self.login(name, framed=False)
+            if not stay or index < times - 1:
+                self.server.remove_client(session)
+
+    def updates(self, user):
+        self.server.flush_presence()
+        self.server.flush_pending()
+        message = get_message(user[0], user[1])
+        self.assertEqual(message[ACTION], PRESENCE_UPDATE)
+        return {contact[ACCOUNT_NAME]: contact[STATUS] for contact in message[CONTACTS]}, len(message[CONTACTS])
+
+    # все изменения контактов до отправки сводятся в одно уведомление с последним состоянием каждого контакта,
+    # следующее уведомление отправляется не раньше чем через PRESENCE_INTERVAL
+    def test_coalesced(self):
+        with mock.patch.object(server, 'PRESENCE_INTERVAL', 0.3):
+            self.flap('flap1', 5, stay=True)
+            self.flap('flap2', 5)
+            self.assertEqual(self.updates(self.watcher), ({'flap1': ONLINE, 'flap2': OFFLINE}, 2))
+            self.assertNothingReceived(self.watcher[0], self.watcher[1])
+
+            self.flap('flap2', 3, stay=True)
+            self.server.flush_presence()
+            self.server.flush_pending()
+            self.assertNothingReceived(self.watcher[0], self.watcher[1])
+            time.sleep(0.3)
+            self.assertEqual(self.updates(self.watcher), ({'flap2': ONLINE}, 1))
+            self.assertNothingReceived(self.watcher[0], self.watcher[1])
+
+    # пользователи, у которых изменившийся пользователь не в контактах, уведомлений не получают
+    def test_non_contacts(self):
+        self.flap('flap1', 3)
+        self.assertEqual(self.updates(self.watcher)[0], {'flap1': OFFLINE})
+        self.assertNothingReceived(self.stranger[0], self.stranger[1])
+        self.assertNotIn('stranger', self.server.presence_updates)
+
+
+# Поиск по архиву сообщений
+class TestSearch(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.archive = MessageArchive(tempfile.mkdtemp())
+        self.search = SearchIndex(self.archive, interval=60)
+        self.server.archive, self.server.search = self.archive, self.search
+        self.user1 = self.login('user1')
+        self.user2 = self.login('user2')
+
+    def tearDown(self):
+        self.server.stop_searcher()
+        super().tearDown()
+        self.search.close()
+        self.archive.close()
+
+    def query(self, user, text, **options):
+        send_message(user[0], {ACTION: SEARCH, TIME: time.time(), ACCOUNT_NAME: user[3].name, QUERY: text, **options},
+                     user[1].codec)
+        self.pump()
+        # поток поиска выполняет запросы из очереди и завершается, готовые ответы ставятся в буферы клиентов
+        self.server.stop_searcher()
+        self.server.flush_pending()
+        return get_message(user[0], user[1])
+
+    # запрос выполняется не в потоке цикла сервера, ответ отправляет цикл
+    def test_search(self):
+        for text in ('встреча завтра', 'встреча отменена', 'завтра в офисе'):
+            send_message(self.user1[0], {ACTION: MESSAGE, SENDER: 'user1', DESTINATION: 'user2', TIME: time.time(),
+                                         MESSAGE_TEXT: text}, self.user1[1].codec)
+            self.pump()
+            get_message(self.user2[0], self.user2[1])
+        self.search.update()
+        threads = []
+        search = self.search.search
+
+        def record(*args):
+            threads.append(threading.current_thread())
+            return search(*args)
+        with mock.patch.object(self.search, 'search', side_effect=record):
+            response = self.query(self.user2, 'встреча', limit=1, offset=1)
+        self.assertEqual(response[RESPONSE], 202)
+        self.assertEqual([message[MESSAGE_TEXT] for message in response[MESSAGES]], ['встреча завтра'])
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.current_thread())
+
+    # клиент, отключившийся до окончания поиска, ответа не получает, остальные получают
+    def test_client_gone(self):
+        send_message(self.user1[0], {ACTION: SEARCH, TIME: time.time(), ACCOUNT_NAME: 'user1', QUERY: 'x'},
+                     self.user1[1].codec)
+        self.pump()
+        self.server.remove_client(self.user1[3])
+        self.server.stop_searcher()
+        self.assertTrue(self.server.search_results.empty())
+        self.assertEqual(self.query(self.user2, 'x')[MESSAGES], [])
+
+
+# Переполнение буфера исходящих данных медленного получателя
+class TestBackpressure(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        for name, value in (('OUTBOUND_HIGH_WATER', 64 * 1024), ('OUTBOUND_LOW_WATER', 16 * 1024)):
+            patcher = mock.patch.object(server, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.recipient = self.login('recipient', slow=True)
+        self.sender = self.login('sender')
+
+    # Отправка сообщений получателю, сервер читает их за несколько итераций.
+    def send(self, indexes):
+        for index in indexes:
+            send_message(self.sender[0], {ACTION: MESSAGE, SENDER: 'sender', DESTINATION: 'recipient',
+                                          TIME: time.time(), MESSAGE_TEXT: f'{index}:' + 'x' * 10000},
+                         self.sender[1].codec)
+        for _ in range(3):
+            self.pump()
+
+    # Чтение получателем всего, что сервер ему отправит, возвращает номера сообщений. check вызывается после
+    # каждой итерации сервера.
+    def receive(self, check=None):
+        transport, decoder = self.recipient[0], self.recipient[1]
+        transport.settimeout(0.05)
+        messages = []
+        idle = 0
+        while idle < 5:
+            self.pump(0.01)
+            if check is not None:
+                check()
+            try:
+                data = transport.recv(READ_BUFFER_SIZE)
+            except socket.timeout:
+                idle += 1
+                continue
+            if not data:
+                break
+            idle = 0
+            decoder.feed(data)
+            while decoder.frames:
+                message = decoder.codec.decode(frame_body(decoder.frames.popleft()))
+                messages.append(int(message[MESSAGE_TEXT].split(':')[0]))
+        return messages
+
+    def pending(self):
+        buffer = self.recipient[3].outbound
+        return 0 if buffer is None else buffer.size
+
+    def reading(self, session):
+        key = self.server.registry.selector.get_map().get(session)
+        return key is not None and bool(key.events & selectors.EVENT_READ)
+
+    # частичная запись: пока получатель не читает, данные копятся в буфере на сервере; при переполнении чтение
+    # от отправителя приостанавливается и возобновляется, когда буфер освободится до OUTBOUND_LOW_WATER
+    def test_pause(self):
+        sender = self.sender[3]
+        self.send(range(10))
+        self.assertGreaterEqual(self.pending(), server.OUTBOUND_HIGH_WATER)
+        self.assertIn(sender, self.server.paused)
+        self.assertFalse(self.reading(sender))
+        self.assertTrue(self.reading(self.recipient[3]))
+        self.send([10])
+
+        resumed = []
+
+        def check():
+            if sender in self.server.paused:
+                self.assertGreater(self.pending(), server.OUTBOUND_LOW_WATER)
+            elif not resumed:
+                resumed.append(self.pending())
+
+        self.assertEqual(self.receive(check), list(range(11)))
+        self.assertLessEqual(resumed[0], server.OUTBOUND_LOW_WATER)
+        self.assertTrue(self.reading(sender))
+        self.assertNotIn(sender, self.server.blocked_by.get(self.recipient[3], ()))
+
+    # при политике drop сообщения сверх OUTBOUND_HIGH_WATER отбрасываются, отправитель не приостанавливается
+    def test_drop(self):
+        dropped = self.server.messages_dropped.value
+        with mock.patch.object(server, 'OUTBOUND_POLICY', OUTBOUND_DROP):
+            self.send(range(10))
+            self.assertNotIn(self.sender[3], self.server.paused)
+            count = self.server.messages_dropped.value - dropped
+            self.assertGreater(count, 0)
+            self.assertEqual(self.receive(), list(range(10 - count)))
+
+    # при политике disconnect медленный получатель отключается, отправитель остаётся подключён
+    def test_disconnect(self):
+        with mock.patch.object(server, 'OUTBOUND_POLICY', OUTBOUND_DISCONNECT):
+            self.send(range(10))
+            self.assertIsNone(self.server.registry.find('recipient'))
+            self.assertIs(self.server.registry.find('sender'), self.sender[3])
+            self.assertNotIn(self.sender[3], self.server.paused)
+            messages = self.receive()
+        self.assertLess(len(messages), 10)
+        self.assertEqual(messages, list(range(len(messages))))
+
+
+# Восстановление сессии по токену после обрыва соединения
+class TestResume(ServerTestCase):
+    def chat(self, text):
+        return {ACTION: MESSAGE, SENDER: 'user2', DESTINATION: 'user1', TIME: time.time(), MESSAGE_TEXT: text}
+
+    def setUp(self):
+        super().setUp()
+        self.user1 = self.login('user1')
+        self.user2 = self.login('user2')
+        self.token = self.user1[2][RESUME_TOKEN]
+
+    # клиент получил только первый кадр из блока пакета: при восстановлении с last_seq=1 повторно отправляются
+    # только недостающие кадры блока; прежний сокет, обрыв которого сервер ещё не заметил, закрывается
+    def test_partial_block_replay(self):
+        send_message(self.user2[0], {ACTION: BATCH, TIME: time.time(),
+                                     MESSAGES: [self.chat(text) for text in ('1', '2', '3')]}, self.user2[1].codec)
+        self.pump()
+        self.assertEqual(get_message(self.user1[0], self.user1[1])[MESSAGE_TEXT], '1')
+        old = self.user1[3]
+
+        transport, decoder, response, session = self.login('user1', resume_token=self.token, last_seq=1)
+        self.assertEqual(response[RESUME_TOKEN], self.token)
+        self.assertIs(self.server.registry.find('user1'), session)
+        self.assertNotIn(old, self.server.registry)
+        self.assertEqual(self.user1[0].recv(READ_BUFFER_SIZE, socket.MSG_PEEK), b'')
+        self.assertEqual([get_message(transport, decoder)[MESSAGE_TEXT] for _ in range(2)], ['2', '3'])
+        self.assertNothingReceived(transport, decoder)
+
+    # last_seq вне диапазона отправленных кадров (или не число): сессия не восстанавливается, выполняется обычный
+    # вход с новым токеном, повторно ничего не отправляется
+    def test_last_seq_bounds(self):
+        send_message(self.user2[0], self.chat('1'), self.user2[1].codec)
+        self.pump()
+        token, session = self.token, self.user1[3]
+        for last_seq in (-1, 2, 'x'):
+            with self.subTest(last_seq=last_seq):
+                self.server.remove_client(session)
+                self.assertIn('user1', self.server.detached)
+                transport, decoder, response, session = self.login('user1', resume_token=token, last_seq=last_seq)
+                self.assertEqual(response[RESPONSE], 200)
+                self.assertNotEqual(response[RESUME_TOKEN], token)
+                self.assertNotIn('user1', self.server.detached)
+                self.assertNothingReceived(transport, decoder)
+                token = response[RESUME_TOKEN]
+
+    # журнал кадров для повторной отправки не превышает RESUME_LOG_BYTES байт: старые блоки вытесняются, а кадры,
+    # которые уже нельзя отправить повторно, при восстановлении пропускаются
+    def test_log_bytes_cap(self):
+        with mock.patch.object(server, 'RESUME_LOG_BYTES', 4096):
+            for index in range(50):
+                send_message(self.user2[0], self.chat(f'{index:03}' * 100), self.user2[1].codec)
+                self.pump()
+                self.assertEqual([get_message(self.user1[0], self.user1[1])[MESSAGE_TEXT]], [f'{index:03}' * 100])
+            state = self.user1[3].resume
+            self.assertEqual(state.seq, 50)
+            self.assertLessEqual(state.log_size, 4096)
+            self.assertEqual(state.log_size, sum(len(data) for first, data, count in state.log))
+            first = state.log[0][0]
+            self.assertGreater(first, 1)
+
+            transport, decoder, response, session = self.login('user1', resume_token=self.token, last_seq=0)
+            self.assertEqual(response[RESUME_TOKEN], self.token)
+            self.assertEqual([get_message(transport, decoder)[MESSAGE_TEXT] for _ in range(first, 51)],
+                             [f'{index - 1:03}' * 100 for index in range(first, 51)])
+            self.assertNothingReceived(transport, decoder)
+
+    # кадры, получение которых клиент подтвердил в ping или pong, больше не хранятся
+    def test_acknowledged(self):
+        for text in ('1', '2', '3'):
+            send_message(self.user2[0], self.chat(text), self.user2[1].codec)
+            self.pump()
+        state = self.user1[3].resume
+        self.assertEqual([first for first, data, count in state.log], [1, 2, 3])
+        # ответ сервера на ping - тоже кадр сессии, он записывается после подтверждения
+        for action, last_seq, left in ((PONG, 1, [2, 3]), (PING, 5, [2, 3, 4]), (PONG, 'x', [2, 3, 4]),
+                                       (PING, 4, [5])):
+            send_message(self.user1[0], {ACTION: action, TIME: time.time(), LAST_SEQ: last_seq}, self.user1[1].codec)
+            self.pump()
+            self.assertEqual([first for first, data, count in state.log], left)
+        self.assertEqual(state.log_size, len(state.log[0][1]))
+
+        self.assertEqual([get_message(self.user1[0], self.user1[1]).get(MESSAGE_TEXT, PONG) for _ in range(5)],
+                         ['1', '2', '3', PONG, PONG])
+        transport, decoder, response, session = self.login('user1', resume_token=self.token, last_seq=5)
+        self.assertEqual(response[RESUME_TOKEN], self.token)
+        self.assertNothingReceived(transport, decoder)
+
+    # сообщения, пришедшие, пока клиент был отключён, откладываются и доставляются после восстановления сессии
+    # вслед за недополученными кадрами
+    def test_held_messages(self):
+        send_message(self.user2[0], self.chat('1'), self.user2[1].codec)
+        self.pump()
+        self.server.remove_client(self.user1[3])
+        send_message(self.user2[0], self.chat('2'), self.user2[1].codec)
+        self.pump()
+        self.assertEqual([message[MESSAGE_TEXT] for message in self.server.detached['user1'].held], ['2'])
+        self.assertEqual(list(self.database.stored_messages('user1')), [])
+
+        transport, decoder, response, session = self.login('user1', resume_token=self.token, last_seq=0)
+        self.assertEqual(response[RESUME_TOKEN], self.token)
+        self.assertEqual([get_message(transport, decoder)[MESSAGE_TEXT] for _ in range(2)], ['1', '2'])
+        self.assertEqual(session.resume.seq, 2)
+        self.assertNotIn('user1', self.server.detached)
+
+    # если пользователь уже вошёл на другом обработчике, обрыв прежнего подключения не сохраняет сессию: сообщения
+    # ему не откладываются
+    def test_online_elsewhere(self):
+        self.server.routes['user1'] = (1, True)
+        self.server.remove_client(self.user1[3])
+        self.assertNotIn('user1', self.server.detached)
+
+
+# Доставка сообщений, сохранённых для пользователя не в сети
+class TestStoredDelivery(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.database.user_login('user1', '127.0.0.1', 1000)
+        self.database.flush()
+        self.database.store_messages('user1', [{ACTION: MESSAGE, SENDER: 'user2', DESTINATION: 'user1',
+                                                TIME: time.time(), MESSAGE_TEXT: f'{index}'} for index in range(3)])
+        # Буфер считается заполненным сразу, поэтому сообщения ставятся в него по одному.
+        patcher = mock.patch.object(server, 'OUTBOUND_HIGH_WATER', 1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def stored(self):
+        return [message[MESSAGE_TEXT] for batch in self.database.stored_messages('user1')
+                for message_id, message in batch]
+
+    # сообщение удаляется из БД только после того, как буфер клиента отправлен, следующее ставится в буфер после этого
+    def test_deleted_after_drain(self):
+        transport, decoder, response, session = self.login('user1')
+        self.assertEqual(self.stored(), ['0', '1', '2'])
+        for index, text in enumerate(('0', '1', '2')):
+            self.pump()
+            self.assertEqual(get_message(transport, decoder)[MESSAGE_TEXT], text)
+            self.assertEqual(self.stored(), ['0', '1', '2'][index + 1:])
+        self.assertNotIn('user1', self.server.stored_delivery)
+
+    # если клиент отключился, не дождавшись отправки буфера, сообщения остаются в БД до следующего входа
+    def test_client_dropped(self):
+        transport, decoder, response, session = self.login('user1', framed=False)
+        self.server.remove_client(session)
+        self.assertEqual(self.stored(), ['0', '1', '2'])
+        self.assertNotIn('user1', self.server.stored_delivery)
+        transport, decoder, response, session = self.login('user1')
+        for text in ('0', '1', '2'):
+            self.pump()
+            self.assertEqual(get_message(transport, decoder)[MESSAGE_TEXT], text)
+        self.assertEqual(self.stored(), [])
+
+    # новое сообщение, пришедшее во время доставки, доставляется после сохранённых
+    def test_order_kept(self):
+        transport, decoder, response, session = self.login('user1')
+        sender = self.login('user2')
+        send_message(sender[0], {ACTION: MESSAGE, SENDER: 'user2', DESTINATION: 'user1', TIME: time.time(),
+                                 MESSAGE_TEXT: 'новое'}, sender[1].codec)
+        for text in ('0', '1', '2', 'новое'):
+            self.pump()
+            self.assertEqual(get_message(transport, decoder)[MESSAGE_TEXT], text)
+
+# Проверка простоя подключений
+class TestHeartbeat(ServerTestCase):
+    # таймер простоя подключения срабатывает сразу, как будто от клиента давно не было данных
+    def expire(self, session):
+        session.active -= HEARTBEAT_INTERVAL + HEARTBEAT_TIMEOUT
+        self.server.timers.schedule(session, 0)
+        self.server.timers.time -= self.server.timers.tick
+        self.server.check_heartbeats()
+
+    # клиенту в режиме с кадрированием отправляется ping, не ответивший клиент отключается
+    def test_framed_client_evicted(self):
+        transport, decoder, response, session = self.login('user1')
+        self.expire(session)
+        self.assertEqual(get_message(transport, decoder)[ACTION], PING)
+        self.expire(session)
+        self.assertIsNone(self.server.registry.find('user1'))
+
+    # клиент прежней версии без кадрирования не получает ping и не отключается
+    def test_legacy_client_kept(self):
+        transport, decoder, response, session = self.login('user1', framed=False)
+        self.expire(session)
+        self.expire(session)
+        self.assertIs(self.server.registry.find('user1'), session)
+        self.assertNothingReceived(transport, None)
+
+
+# Основной цикл сервера в отдельном потоке
+class TestServerLoop(unittest.TestCase):
+    def setUp(self):
+        self.database = create_storage('sqlite:///' + os.path.join(tempfile.mkdtemp(), 'server.db3'))
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        self.server = server.Server('127.0.0.1', port, self.database)
+        self.server.daemon = True
+        self.server.start()
+        self.transports = []
+        # Если цикл сервера остановился, клиенты не должны ждать ответа вечно.
+        socket.setdefaulttimeout(5)
+        self.addCleanup(socket.setdefaulttimeout, None)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.join(5)
+        for transport in self.transports:
+            transport.close()
+        for client in list(self.server.registry):
+            self.server.remove_client(client)
+        self.server.sock.close()
+        self.database.close()
+
+    # подключений больше FD_SETSIZE (1024): сервер продолжает принимать подключения и передавать сообщения
+    def test_many_connections(self):
+        count = 1100
+        if resource.getrlimit(resource.RLIMIT_NOFILE)[0] < 2 * count + 100:
+            self.skipTest('недостаточен лимит открытых файлов')
+        for _ in range(count):
+            self.transports.append(socket.create_connection(('127.0.0.1', self.server.port)))
+        first, response, first_decoder = connect_server('127.0.0.1', self.server.port, 'first')
+        second, response, second_decoder = connect_server('127.0.0.1', self.server.port, 'second')
+        self.transports += [first, second]
+        send_message(first, {ACTION: MESSAGE, SENDER: 'first', DESTINATION: 'second', TIME: time.time(),
+                             MESSAGE_TEXT: 'привет'}, first_decoder.codec)
+        self.assertEqual(get_message(second, second_decoder)[MESSAGE_TEXT], 'привет')
+        self.assertTrue(self.server.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+import sys
+sys.path.append('../')
+import datetime
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from common.variables import *
+from server_database import create_storage
+
+
+# Тесты хранилищ данных сервера. Оба хранилища проверяются одними и теми же тестами и работают с одной схемой БД.
+class StorageTests:
+    backend = None
+
+    def setUp(self):
+        self.db_url = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'server.db3')
+        self.storage = create_storage(self.db_url, backend=self.backend)
+
+    def tearDown(self):
+        self.storage.close()
+
+    def reopen(self, backend, shared=False):
+        self.storage.close()
+        self.storage = create_storage(self.db_url, shared, backend)
+
+    # вход, повторный вход с другого адреса и выход отражаются в списках пользователей и в истории входов
+    def test_login_logout(self):
+        self.storage.user_login('user1', '127.0.0.1', 1000)
+        self.storage.user_login('user2', '127.0.0.1', 1001)
+        self.storage.user_login('user1', '127.0.0.2', 1002)
+        self.storage.user_logout('user2')
+        self.storage.flush()
+        self.assertEqual([user[:3] for user in self.storage.active_users_list()], [('user1', '127.0.0.2', 1002)])
+        self.assertEqual(sorted(user[0] for user in self.storage.users_list()), ['user1', 'user2'])
+        history = self.storage.login_history('user1')
+        self.assertEqual([(user[0], user[2], user[3]) for user in history],
+                         [('user1', '127.0.0.1', 1000), ('user1', '127.0.0.2', 1002)])
+        self.assertIsInstance(history[0][1], datetime.datetime)
+        self.assertEqual(self.storage.login_history('user3'), [])
+
+    # история по страницам и за период, в том числе после переоткрытия БД другим хранилищем без полного кэша
+    def test_history_pages(self):
+        for index in range(7):
+            self.storage.user_login(f'user{index % 2}', '127.0.0.1', index)
+        self.storage.flush()
+        self.reopen(STORAGE_SQLITE if self.backend == STORAGE_SQLALCHEMY else STORAGE_SQLALCHEMY, shared=True)
+        pages = list(self.storage.login_history_pages(page_size=3))
+        self.assertEqual([[user[3] for user in page] for page in pages], [[0, 1, 2], [3, 4, 5], [6]])
+        self.assertEqual([user[3] for page in self.storage.login_history_pages('user1', page_size=2)
+                          for user in page], [1, 3, 5])
+        middle = pages[1][0][1]
+        self.assertEqual([user[3] for user in self.storage.login_history(date_from=middle, limit=2)], [3, 4])
+        self.assertEqual([user[3] for user in self.storage.login_history(date_to=middle)], [0, 1, 2])
+        self.assertEqual(sorted(user[0] for user in self.storage.users_list()), ['user0', 'user1'])
+
+    # чтения внутри snapshot видят один снимок БД, хотя поток записи тем временем записывает новые входы; списки
+    # пользователей онлайн в течение LISTING_CACHE_TTL выдаются из кэша
+    def test_snapshot_and_listing_cache(self):
+        self.storage.user_login('user1', '127.0.0.1', 1000)
+        self.storage.flush()
+        with self.storage.snapshot():
+            self.assertEqual(len(self.storage.login_history()), 1)
+            self.storage.user_login('user2', '127.0.0.1', 1001)
+            self.storage.flush()
+            self.assertEqual(len(self.storage.login_history()), 1)
+        self.assertEqual(len(self.storage.login_history()), 2)
+
+        self.assertEqual(len(self.storage.active_users_list()), 2)
+        self.storage.user_logout('user2')
+        self.storage.flush()
+        self.assertEqual(len(self.storage.active_users_list()), 2)
+        self.storage.listings.clear()
+        self.assertEqual(len(self.storage.active_users_list()), 1)
+
+    # сообщения для пользователей не в сети выдаются пачками и удаляются после доставки, группы сохраняются в БД
+    def test_stored_messages_and_groups(self):
+        self.storage.user_login('user1', '127.0.0.1', 1000)
+        self.storage.user_login('user2', '127.0.0.1', 1001)
+        self.storage.flush()
+        self.assertFalse(self.storage.store_message('user3', {MESSAGE_TEXT: 'кому-то'}))
+        self.assertTrue(self.storage.store_messages('user1', [{MESSAGE_TEXT: f'{index}'} for index in range(5)]))
+        batches = list(self.storage.stored_messages('user1', batch_size=2))
+        self.assertEqual([[message[MESSAGE_TEXT] for message_id, message in batch] for batch in batches],
+                         [['0', '1'], ['2', '3'], ['4']])
+        self.storage.delete_stored_messages('user1', [message_id for batch in batches for message_id, message in batch])
+        self.assertEqual(list(self.storage.stored_messages('user1')), [])
+
+        self.assertTrue(self.storage.create_group('#group', 'user1'))
+        self.assertTrue(self.storage.join_group('#group', 'user2'))
+        self.assertTrue(self.storage.leave_group('#group', 'user1'))
+        self.assertFalse(self.storage.leave_group('#group', 'user1'))
+        self.storage.flush()
+        self.reopen(self.backend)
+        self.assertEqual(self.storage.group_members('#group'), {'user2'})
+
+    # сохранение и удаление сообщений выполняет поток записи: сохранённые сообщения выдаются после их записи,
+    # удаляемые не выдаются уже до удаления
+    def test_stored_messages_writer(self):
+        self.storage.user_login('user1', '127.0.0.1', 1000)
+        self.storage.flush()
+        threads = []
+        for name in ('insert_messages', 'delete_messages'):
+            def record(*args, original=getattr(self.storage, name)):
+                threads.append(threading.current_thread())
+                return original(*args)
+            patcher = mock.patch.object(self.storage, name, side_effect=record)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.assertTrue(self.storage.store_messages('user1', [{MESSAGE_TEXT: f'{index}'} for index in range(3)]))
+        ids = [message_id for batch in self.storage.stored_messages('user1') for message_id, message in batch]
+        self.assertEqual(len(ids), 3)
+        self.storage.delete_stored_messages('user1', ids[:2])
+        self.assertEqual([[message[MESSAGE_TEXT] for message_id, message in batch]
+                          for batch in self.storage.stored_messages('user1')], [['2']])
+        self.storage.flush()
+        self.assertEqual((self.storage.storing, self.storage.deleting), ({}, set()))
+        self.assertEqual(threads, [self.storage.writer, self.storage.writer])
+
+        self.reopen(STORAGE_SQLITE if self.backend == STORAGE_SQLALCHEMY else STORAGE_SQLALCHEMY)
+        self.assertEqual([message_id for batch in self.storage.stored_messages('user1')
+                          for message_id, message in batch], ids[2:])
+
+    # контакты: себя и неизвестного пользователя добавить нельзя, обратный индекс наблюдателей обновляется,
+    # после переоткрытия БД контакты загружаются заново
+    def test_contacts(self):
+        for index in range(3):
+            self.storage.user_login(f'user{index}', '127.0.0.1', index)
+        self.storage.flush()
+        self.assertFalse(self.storage.add_contact('user0', 'user0'))
+        self.assertFalse(self.storage.add_contact('user0', 'user9'))
+        self.assertTrue(self.storage.add_contact('user0', 'user1'))
+        self.assertTrue(self.storage.add_contact('user0', 'user2'))
+        self.assertTrue(self.storage.add_contact('user2', 'user1'))
+        self.assertTrue(self.storage.remove_contact('user0', 'user2'))
+        self.assertFalse(self.storage.remove_contact('user0', 'user2'))
+        self.assertEqual(self.storage.contact_watchers('user1'), {'user0', 'user2'})
+        self.assertEqual(self.storage.contact_watchers('user2'), set())
+        self.storage.flush()
+        self.reopen(self.backend)
+        self.assertEqual(self.storage.get_contacts('user0'), {'user1'})
+        self.assertEqual(self.storage.contact_watchers('user1'), {'user0', 'user2'})
+
+
+class TestServerStorage(StorageTests, unittest.TestCase):
+    backend = STORAGE_SQLALCHEMY
+
+
+class TestSqliteStorage(StorageTests, unittest.TestCase):
+    backend = STORAGE_SQLITE
+
+
+if __name__ == '__main__':
+    unittest.main()
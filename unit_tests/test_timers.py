@@ -0,0 +1,39 @@
+import sys
+sys.path.append('../')
+import unittest
+from server_timers import TimerWheel
+
+
+# Тесты колеса таймеров
+class TestTimerWheel(unittest.TestCase):
+    def setUp(self):
+        self.wheel = TimerWheel(1, 8, now=0)
+
+    # таймер срабатывает на такте, к которому истекла задержка, и только один раз
+    def test_expire(self):
+        self.wheel.schedule('a', 3)
+        self.assertEqual(self.wheel.advance(2.5), [])
+        self.assertEqual(self.wheel.advance(3), ['a'])
+        self.assertEqual(self.wheel.advance(10), [])
+        self.assertNotIn('a', self.wheel)
+
+    # таймер дальше одного оборота колеса срабатывает через нужное число оборотов
+    def test_rounds(self):
+        self.wheel.schedule('a', 20)
+        self.assertEqual(self.wheel.advance(19), [])
+        self.assertEqual(self.wheel.advance(20), ['a'])
+
+    # повторная установка переносит таймер, отменённый таймер не срабатывает
+    def test_reschedule_and_cancel(self):
+        self.wheel.schedule('a', 2)
+        self.wheel.schedule('b', 2)
+        self.wheel.schedule('a', 5)
+        self.wheel.cancel('b')
+        self.wheel.cancel('b')
+        self.assertEqual(self.wheel.advance(4), [])
+        self.assertEqual(len(self.wheel), 1)
+        self.assertEqual(self.wheel.advance(5), ['a'])
+
+
+if __name__ == '__main__':
+    unittest.main()
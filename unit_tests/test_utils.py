@@ -2,8 +2,10 @@ import sys
 sys.path.append('../')
 from common.utils import *
 from common.variables import *
+import socket
 import unittest
-from errors import NonDictInputError
+from errors import NonDictInputError, IncorrectDataRecivedError
+from common.codec import BINARY_CODEC
 
 
 # Тестовый класс для тестирования отпраки и получения, при создании требует словарь, который будет прогонятся
@@ -17,12 +19,31 @@ class TestSocket:
         json_test_message = json.dumps(self.testdict)
         self.encoded_message = json_test_message.encode(ENCODING)
         self.receved_message = message_to_send
+        return len(message_to_send)
 
     def recv(self, max_len):
         json_test_message = json.dumps(self.testdict)
         return json_test_message.encode(ENCODING)
 
 
+# Тестовый сокет для режима с кадрированием: накапливает всё отправленное и отдаёт его блоками заданного размера.
+class TestStreamSocket:
+    def __init__(self, chunk_size=READ_BUFFER_SIZE, send_limit=None):
+        self.data = b''
+        self.chunk_size = chunk_size
+        # ограничение записи за один вызов send, для проверки частичной отправки
+        self.send_limit = send_limit
+
+    def send(self, message_to_send):
+        sent = bytes(message_to_send[:self.send_limit])
+        self.data += sent
+        return len(sent)
+
+    def recv(self, max_len):
+        chunk, self.data = self.data[:min(max_len, self.chunk_size)], self.data[min(max_len, self.chunk_size):]
+        return chunk
+
+
 # Тестовый класс, собственно выполняющий тестирование.
 class Tests(unittest.TestCase):
     test_dict_send = {
@@ -58,6 +79,104 @@ class Tests(unittest.TestCase):
         # тест корректной расшифровки ошибочного словаря
         self.assertEqual(get_message(test_sock_err), self.test_dict_recv_err)
 
+    # тест отправки и приёма в режиме с кадрированием, в том числе с частичной записью в сокет
+    def test_framed_send_get(self):
+        test_socket = TestStreamSocket(send_limit=7)
+        send_message(test_socket, self.test_dict_send, JSON_CODEC)
+        send_message(test_socket, self.test_dict_recv_err, JSON_CODEC)
+        decoder = FrameDecoder()
+        self.assertEqual(get_message(test_socket, decoder), self.test_dict_send)
+        self.assertEqual(get_message(test_socket, decoder), self.test_dict_recv_err)
+
+    # тест отправки и приёма тех же словарей в двоичном кодеке
+    def test_binary_send_get(self):
+        test_socket = TestStreamSocket(chunk_size=5)
+        for message in (self.test_dict_send, self.test_dict_recv_ok, self.test_dict_recv_err):
+            send_message(test_socket, message, BINARY_CODEC)
+        decoder = FrameDecoder(BINARY_CODEC)
+        self.assertEqual(get_message(test_socket, decoder), self.test_dict_send)
+        self.assertEqual(get_message(test_socket, decoder), self.test_dict_recv_ok)
+        self.assertEqual(get_message(test_socket, decoder), self.test_dict_recv_err)
+
+    # тест декодера: несколько кадров в одном блоке и кадр, разорванный между блоками
+    def test_frame_decoder(self):
+        big_message = {ACTION: MESSAGE, MESSAGE_TEXT: 'x' * (MAX_PACKAGE_LENGTH * 10)}
+        frames = [encode_frame(json.dumps(message).encode(ENCODING)) for message in
+                  (self.test_dict_recv_ok, big_message, self.test_dict_recv_err)]
+        stream = b''.join(frames)
+        decoder = FrameDecoder()
+        self.assertEqual(decoder.feed(stream[:len(frames[0]) + 10]), 1)
+        self.assertEqual(decoder.feed(stream[len(frames[0]) + 10:]), 2)
+        self.assertEqual([decode_message(frame_body(frame)) for frame in decoder.frames],
+                         [self.test_dict_recv_ok, big_message, self.test_dict_recv_err])
+        self.assertEqual(decoder.buffer, bytearray())
+
+    # тест заголовка маршрута: есть только у сообщений пользователям и не мешает разбору самого сообщения
+    def test_frame_route(self):
+        message = {ACTION: MESSAGE, SENDER: 'user1', DESTINATION: 'user2', TIME: 1.1, MESSAGE_TEXT: 'text'}
+        test_socket = TestStreamSocket()
+        send_message(test_socket, message, JSON_CODEC)
+        send_message(test_socket, self.test_dict_send, JSON_CODEC)
+        decoder = FrameDecoder()
+        decoder.feed(test_socket.recv(READ_BUFFER_SIZE))
+        routed, plain = decoder.frames
+        self.assertEqual(frame_route(routed), ('user2', 'user1'))
+        self.assertEqual(decode_message(frame_body(routed)), message)
+        self.assertIsNone(frame_route(plain))
+        self.assertEqual(decode_message(frame_body(plain)), self.test_dict_send)
+
+    # тест отказа от кадра с недопустимой длинной
+    def test_frame_too_long(self):
+        decoder = FrameDecoder()
+        self.assertRaises(IncorrectDataRecivedError, decoder.feed, struct.pack(FRAME_HEADER, MAX_FRAME_LENGTH + 1, 0))
+
+
+    # Пара сокетов с маленькими буферами ядра: запись в неблокирующий сокет быстро становится частичной.
+    def socket_pair(self):
+        sender, receiver = socket.socketpair()
+        self.addCleanup(sender.close)
+        self.addCleanup(receiver.close)
+        sender.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        sender.setblocking(False)
+        receiver.settimeout(1)
+        return sender, receiver
+
+    # частичная запись sendmsg: недописанный остаток остаётся в буфере, размер буфера уменьшается на записанное,
+    # после чтения получателем буфер дописывается, данные приходят целиком и по порядку
+    def test_outbound_partial_sendmsg(self):
+        sender, receiver = self.socket_pair()
+        chunks = [encode_frame(bytes([index]) * 1000) for index in range(200)]
+        buffer = OutboundBuffer()
+        for chunk in chunks:
+            buffer.append(chunk)
+        total = buffer.size
+        self.assertFalse(buffer.flush(sender))
+        self.assertTrue(0 < buffer.size < total)
+        self.assertEqual(buffer.size, sum(len(chunk) for chunk in buffer.chunks))
+        received = bytearray()
+        while not buffer.flush(sender):
+            received += receiver.recv(READ_BUFFER_SIZE)
+        while len(received) < total:
+            received += receiver.recv(READ_BUFFER_SIZE)
+        self.assertEqual(bytes(received), b''.join(chunks))
+        self.assertEqual(buffer.size, 0)
+
+    # без объединения кадров сообщения отправляются по одному, частичная запись тоже дописывается
+    def test_outbound_partial_send(self):
+        sender, receiver = self.socket_pair()
+        chunks = [bytes([index]) * 5000 for index in range(50)]
+        buffer = OutboundBuffer(coalesce=False)
+        for chunk in chunks:
+            buffer.append(chunk)
+        received = bytearray()
+        while not buffer.flush(sender):
+            self.assertEqual(buffer.size, sum(len(chunk) for chunk in buffer.chunks))
+            received += receiver.recv(READ_BUFFER_SIZE)
+        while len(received) < len(chunks) * 5000:
+            received += receiver.recv(READ_BUFFER_SIZE)
+        self.assertEqual(bytes(received), b''.join(chunks))
+
 
 if __name__ == '__main__':
     unittest.main()